@@ -1,75 +1,149 @@
 import os
-import PySpin
 import sys
 import time
 import threading
-import yaml
-import ruamel.yaml
-from pathlib import Path
-import numpy as np
-import datetime
-
-def read_config(configname):
-    ruamelFile = ruamel.yaml.YAML()
-    path = Path(configname)
-    if os.path.exists(path):
-        try:
-            with open(path, 'r') as f:
-                cfg = ruamelFile.load(f)
-        except Exception as err:
-            if err.args[2] == "could not determine a constructor for the tag '!!python/tuple'":
-                with open(path, 'r') as ymlfile:
-                    cfg = yaml.load(ymlfile, Loader=yaml.SafeLoader)
-    else:
-        raise FileNotFoundError(
-            "Config file is not found. Please make sure that the file exists and/or there are no unnecessary spaces in the path of the config file!")
-    return (cfg)
-
-# Change cwd to script folder
-abspath = os.path.abspath(__file__)
-dname = os.path.dirname(abspath)
-os.chdir(dname)
-
-# Read cfg yaml file
-cfg = read_config('params.yaml')
-num_images = cfg['num_images']
-exp_time = cfg['exp_time']
-gain = cfg['gain']
-bin_val = int(1)  # bin mode (WIP)
-if cfg['file_path'] == 0:
-    im_savepath = os.path.join(dname, 'images')
-else:
-    im_savepath = cfg['file_path']
-filename = cfg['file_name'] + str(cfg['stim_run'])
-framerate = cfg['framerate']
-
-# Create webcam and aux save folder
-if not os.path.exists(im_savepath):
-    os.makedirs(im_savepath)
-os.chdir(im_savepath)
-
-# Thread process for saving .
-# offloading it to separate CPU threads allows continuation of image capture
-class ThreadWrite(threading.Thread):
-    def __init__(self, data, out):
-        threading.Thread.__init__(self)
-        self.data = data
-        self.out = out
-
-    def run(self):
-        self.data.Save(self.out)
-
-
-# Capturing is also threaded, to increase performance
+from Config import get_config, enter_image_folder, ACQUISITION_MODES
+from WriterPool import WriterPool
+from FrameRing import FrameRing
+from CameraBackend import get_system, CameraHandles, CAMERA_ERRORS, is_grab_timeout
+from Probes import PROBES, ThreadProbeReporter
+from FrameStore import open_store, STORE_FORMATS
+from Timestamps import TimestampLog, timestamp_path, clock_path, estimate_clock, save_clocks
+from FrameSync import FrameSynchronizer
+from TriggerScheduler import ThreadTriggerBroadcaster, trigger_path
+from PreviewTap import PreviewTap, wait_with_preview
+from DICEngine import DICStore, ThreadDICWorker
+from CameraSetup import CameraSnapshots, configure_nodes, bring_up
+
+# The configuration of a run comes from get_config() (see Config.py), loaded from params.yaml
+# on first use. The run's files are written in the image folder, entered by launch_acquisition.
+
+# Saving is offloaded to the shared writer pool (see WriterPool.py),
+# which allows continuation of image capture.
+def make_writer_pool():
+    config = get_config()
+    return WriterPool(config.writer_workers, config.writer_queue_depth, config.writer_full_policy, PROBES)
+
+
+# Preallocated frame ring of a configured camera, sized from its width, height and pixel format.
+# It has config.ring_slots slots by default (see Config.py), so the capture loop never waits
+# on the ring itself.
+# ring_class is FrameRing, or SharedFrameRing for a camera process (see ProcessCapture.py).
+def make_frame_ring(handles, slots=None, ring_class=FrameRing):
+    slots = slots or get_config().ring_slots
+    return ring_class.for_format(slots, handles.height, handles.width, handles.pixel_format)
+
+
+# Output formats ThreadCapture can write, see FrameStore.py
+FILE_FORMATS = STORE_FORMATS
+
+
+# Output store of a run, giving one sink per camera
+# With dic on, the frames of dic_camera are also correlated as they are written (see DICEngine.py)
+# file_format, num_frames and correlate default to file_format, num_images and dic
+def make_store(file_format=None, num_frames=None, correlate=None):
+    config = get_config()
+    file_format = file_format or config.file_format
+    num_frames = config.num_images if num_frames is None else num_frames
+    correlate = config.dic if correlate is None else correlate
+    store = open_store(file_format, config.filename, config.container_chunk_frames, config.container_compression,
+                       num_frames, config.container_compression_level, config.container_shuffle)
+    if correlate:
+        store = DICStore(store, ThreadDICWorker(config.filename, config.dic_camera, config.dic_queue,
+                                                config.dic_settings))
+    return store
+
+# Synchronizer matching the frames of the cameras before they are written (see FrameSync.py),
+# None with a single camera or sync_mode off. In auto mode hardware triggered frames are matched
+# by timestamp (cameras may start on different pulses), software triggered ones by frame ID.
+def make_sync(writer, sinks, mode=None, first_index=0, framerate=None):
+    config = get_config()
+    mode = mode or config.sync_mode
+    framerate = framerate or config.framerate
+    if mode == 'off' or len(sinks) < 2:
+        return None
+    if mode == 'auto':
+        mode = 'timestamp' if framerate == 'hardware' else 'frame_id'
+    return FrameSynchronizer(writer, sinks, mode, int(config.sync_tolerance_us * 1000), config.sync_max_pending,
+                             first_index)
+
+# Software trigger broadcaster of a run (see TriggerScheduler.py), None when hardware triggered
+# or with trigger_broadcast off (each capture thread then triggers its own camera)
+def make_trigger_broadcaster(handles, framerate=None, num_triggers=None):
+    config = get_config()
+    framerate = framerate or config.framerate
+    num_triggers = num_triggers or config.num_images
+    if framerate == 'hardware' or not config.trigger_broadcast:
+        return None
+    return ThreadTriggerBroadcaster([h.trigger_software for h in handles], framerate, num_triggers)
+
+
+# Live preview of the cameras during a run (see PreviewTap.py), None with preview off
+def make_preview_tap(num_cameras, enabled=None):
+    config = get_config()
+    if not (config.preview if enabled is None else enabled):
+        return None
+    return PreviewTap(num_cameras, config.preview_fps, config.preview_width)
+
+# Minimum time between two progress lines of the primary camera
+PROGRESS_INTERVAL_NS = 200000000
+# Wait for a software triggered frame past the next trigger slot and the exposure
+GRAB_MARGIN_MS = 200
+
+
+# Longest wait for the frame of a software trigger: the next slot of the timetable, the
+# exposure and the transfer. A frame not there by then was lost, with its trigger or on the
+# link. Hardware triggered frames come when the trigger line says, they are waited for.
+def grab_timeout_ms(framerate):
+    return int(2000 / float(framerate) + get_config().exp_time * 1000) + GRAB_MARGIN_MS
+
+
+# Capturing is also threaded, to increase performance.
+# handles are the CameraHandles of the camera, resolved at configure time,
+# sink is the camera's sink of the run's output store (see FrameStore.py), sync the
+# FrameSynchronizer shared by the cameras of the run (None: frames are written as captured),
+# broadcaster the run's ThreadTriggerBroadcaster (None: the thread triggers its own camera),
+# preview the run's PreviewTap (None: no preview).
+# num_images and framerate default to the params.yaml values. Frames are numbered from
+# first_index, a capture numbered after a previous one adds to its timestamp file.
 class ThreadCapture(threading.Thread):
-    def __init__(self, cam, camnum, nodemap):
+    def __init__(self, handles, camnum, writer, ring, sink, num_images=None, framerate=None, sync=None,
+                 broadcaster=None, preview=None, first_index=0):
         threading.Thread.__init__(self)
-        self.cam = cam
+        self.handles = handles
+        self.cam = handles.cam
         self.camnum = camnum
+        self.writer = writer
+        self.ring = ring
+        self.sink = sink
+        self.sync = sync
+        self.broadcaster = broadcaster
+        self.preview = preview
+        self.first_index = first_index
+        config = get_config()
+        self.num_images = num_images or config.num_images
+        self.framerate = framerate or config.framerate
+        self.filename = config.filename
+        # CPU seconds used by the capture loop
+        self.cpu_time = 0.0
+        # frame timestamps and device clock model of the run, see Timestamps.py
+        self.stamps = None
+        self.clock = None
 
     def run(self):
-        times = []
-        nodemap = self.cam.GetNodeMap()
+        cpu_start = time.thread_time()
+        try:
+            return self.capture()
+        finally:
+            self.cpu_time = time.thread_time() - cpu_start
+
+    def capture(self):
+        num_images = self.num_images
+        # frame timestamps, written to <file_name>_t<N>.bin unless the output holds them (raw frame log)
+        path = None if self.sink.records_timestamps else timestamp_path(self.filename, self.camnum)
+        stamps = self.stamps = TimestampLog(path, num_images, append=self.first_index > 0)
+        # stage timings of this camera, see Probes.py
+        probe = PROBES.camera(self.camnum)
 
         # num of the selected cam
         if self.camnum == 0:
@@ -77,288 +151,406 @@ class ThreadCapture(threading.Thread):
         else:
             primary = 0
 
-        self.cam.BeginAcquisition()
+        # Everything the loop needs is resolved before the first frame,
+        # so that each iteration only triggers, grabs, copies and enqueues
+        write = self.sink.write
+        trigger_software = self.handles.trigger_software
+        # software triggers come from this thread, or from the run's trigger broadcaster
+        ready = self.broadcaster.ready if self.broadcaster is not None else None
+        software_trigger = self.framerate != 'hardware' and ready is None
+        if software_trigger and trigger_software is None:
+            print('Unable to execute trigger. Aborting...')
+            return False
+        get_next_image = self.cam.GetNextImage
+        # a software triggered frame lost leaves its index empty instead of blocking the run,
+        # the loop ends once the broadcaster has stopped (an other camera failed)
+        grab_timeout = grab_timeout_ms(self.framerate) if self.framerate != 'hardware' else None
+        stopped = self.broadcaster.stopped if self.broadcaster is not None else None
+        result = True
+        frame_info = self.handles.frame_info
+        ring = self.ring
+        submit = self.writer.submit
+        sync = self.sync
+        preview = self.preview
+        pixel_format = self.handles.pixel_format
+        camnum = self.camnum
+        first_index = self.first_index
+        next_progress = 0
+        print('Camera %d serial number set to %s...' % (camnum, self.handles.serial))
+
+        self.begin_stream()
+        if ready is not None:
+            ready(camnum)
         for i in range(num_images):
             try:
+                t_start = time.monotonic_ns()
+                index = first_index + i
+
                 #  Retrieve next received image
-                if framerate == 'hardware':
-                    image_result = self.cam.GetNextImage()
+                if software_trigger:
+                    trigger_software()
+                    t_trigger = time.monotonic_ns()
+                    probe.record('trigger', t_trigger - t_start)
                 else:
-                    node_softwaretrigger_cmd = PySpin.CCommandPtr(nodemap.GetNode('TriggerSoftware'))
-                    if not PySpin.IsAvailable(node_softwaretrigger_cmd) or not PySpin.IsWritable(
-                            node_softwaretrigger_cmd):
-                        print('Unable to execute trigger. Aborting...')
-                        return False
-                    node_softwaretrigger_cmd.Execute()
-                    image_result = self.cam.GetNextImage()
-
-                node_device_serial_number = PySpin.CStringPtr(self.cam.GetTLDeviceNodeMap().GetNode('DeviceSerialNumber'))
-
-                if PySpin.IsAvailable(node_device_serial_number) and PySpin.IsReadable(node_device_serial_number):
-                    device_serial_number = node_device_serial_number.GetValue()
-                    print('Image %d serial number set to %s...' % (i, device_serial_number))
-
-
-                times.append(str(datetime.datetime.now()))
+                    t_trigger = t_start
+                try:
+                    image_result = get_next_image(grab_timeout)
+                except CAMERA_ERRORS as ex:
+                    if grab_timeout is None or not is_grab_timeout(ex):
+                        raise
+                    probe.record('timeout', time.monotonic_ns() - t_trigger)
+                    if stopped is not None and stopped.is_set():
+                        result = False
+                        break
+                    if ready is not None:
+                        ready(camnum)
+                    continue
+                t_grab = time.monotonic_ns()
+                probe.record('grab', t_grab - t_trigger)
+                if ready is not None:
+                    ready(camnum)
+                # an incomplete frame (packets lost on the link) is dropped, its index stays empty
+                if image_result.IsIncomplete():
+                    image_result.Release()
+                    probe.record('incomplete', t_grab - t_trigger)
+                    continue
+
+                # Copy the frame into the ring and give the buffer back to the driver at once
+                slot = ring.acquire()
+                frame = ring.copy_in(slot, image_result.GetNDArray())
+                frame_id, timestamp = frame_info(image_result)
+                image_result.Release()
+                if preview is not None:
+                    preview.offer(camnum, frame, pixel_format, index)
+                t_copy = time.monotonic_ns()
+                probe.record('copy', t_copy - t_grab)
+
+                # Queue frame for writing to disk, through the synchronizer when frames are matched
+                # across cameras. The slot goes back to the ring once the frame has been saved.
+                if sync is None:
+                    stamps.append(index, frame_id, timestamp, t_grab)
+                    submit(camnum, write, index, frame, frame_id, timestamp, t_grab,
+                           nbytes=frame.nbytes, release=lambda slot=slot: ring.release(slot), t_start=t_start)
+                else:
+                    sync.push(camnum, frame, frame_id, timestamp, t_grab,
+                              lambda slot=slot: ring.release(slot), t_start, stamps)
+                t_enqueue = time.monotonic_ns()
+                probe.record('enqueue', t_enqueue - t_copy)
 
-                if primary:
+                if primary and (t_enqueue >= next_progress or i + 1 == num_images):
                     print('COLLECTING IMAGE ' + str(i + 1) + ' of ' + str(num_images), end='\r')
                     sys.stdout.flush()
-
-                # Compose filename, write image to disk
-                fullfilename = '000' + str(i+1) + '_' + str(primary)+  '.tif'
-                background = ThreadWrite(image_result, fullfilename)
-                background.start()
-                image_result.Release()
+                    next_progress = t_enqueue + PROGRESS_INTERVAL_NS
+                    probe.record('print', time.monotonic_ns() - t_enqueue)
 
 
-            except PySpin.SpinnakerException as ex:
+            except CAMERA_ERRORS as ex:
                 print('Error : %s' % ex)
+                if self.broadcaster is not None:
+                    self.broadcaster.stop()
+                if sync is None:
+                    self.finish()
+                else:
+                    sync.end(camnum)
                 return False
 
-        self.cam.EndAcquisition()
-
-        # Save frametime data
-        with open(filename + '_t' + str(self.camnum) + '.txt', 'a') as t:
-            for item in times:
-                t.write(item + ',\n')
-
-def configure_cam(cam):
-    result = True
-
-    try:
-        nodemap = cam.GetNodeMap()
-        # Ensure trigger mode off
-        # The trigger must be disabled in order to configure whether the source
-        # is software or hardware.
-        node_trigger_mode = PySpin.CEnumerationPtr(nodemap.GetNode('TriggerMode'))
-        if not PySpin.IsAvailable(node_trigger_mode) or not PySpin.IsReadable(node_trigger_mode):
-            print('Unable to disable trigger mode 129 (node retrieval). Aborting...')
-            return False
-
-        node_trigger_mode_off = node_trigger_mode.GetEntryByName('Off')
-        if not PySpin.IsAvailable(node_trigger_mode_off) or not PySpin.IsReadable(node_trigger_mode_off):
-            print('Unable to disable trigger mode (enum entry retrieval). Aborting...')
-            return False
-
-        node_trigger_mode.SetIntValue(node_trigger_mode_off.GetValue())
-
-        node_trigger_source = PySpin.CEnumerationPtr(nodemap.GetNode('TriggerSource'))
-        if not PySpin.IsAvailable(node_trigger_source) or not PySpin.IsWritable(node_trigger_source):
-            print('Unable to get trigger source 163 (node retrieval). Aborting...')
-            return False
-
-        # Set primary camera trigger source to line0 (hardware trigger)
-        if framerate == 'hardware':
-            node_trigger_source_set = node_trigger_source.GetEntryByName('Line0')
+        self.end_stream()
 
+        # With a synchronizer, frames may still wait for their partners, the owner of the
+        # synchronizer calls finish once it is flushed
+        if sync is None:
+            self.finish()
         else:
-            node_trigger_source_set = node_trigger_source.GetEntryByName('Software')
-
-
-        if not PySpin.IsAvailable(node_trigger_source_set) or not PySpin.IsReadable(
-                node_trigger_source_set):
-            print('Unable to set trigger source (enum entry retrieval). Aborting...')
-            return False
-
-        node_trigger_source.SetIntValue(node_trigger_source_set.GetValue())
-        node_trigger_mode_on = node_trigger_mode.GetEntryByName('On')
-
-        if not PySpin.IsAvailable(node_trigger_mode_on) or not PySpin.IsReadable(node_trigger_mode_on):
-            print('Unable to enable trigger mode (enum entry retrieval). Aborting...')
-            return False
-
-        node_trigger_mode.SetIntValue(node_trigger_mode_on.GetValue())
-
-        # Set acquisition mode to continuous
-        node_acquisition_mode = PySpin.CEnumerationPtr(nodemap.GetNode('AcquisitionMode'))
-        if not PySpin.IsAvailable(node_acquisition_mode) or not PySpin.IsWritable(node_acquisition_mode):
-            print('Unable to set acquisition mode to continuous (enum retrieval). Aborting...')
-            return False
-
-        # Retrieve entry node from enumeration node
-        node_acquisition_mode_continuous = node_acquisition_mode.GetEntryByName('Continuous')
-        if not PySpin.IsAvailable(node_acquisition_mode_continuous) or not PySpin.IsReadable(
-                node_acquisition_mode_continuous):
-            print('Unable to set acquisition mode to continuous (entry retrieval). Aborting...')
-            return False
-
-        # Retrieve integer value from entry node
-        acquisition_mode_continuous = node_acquisition_mode_continuous.GetValue()
+            sync.end(camnum)
+        return result
 
-        # Set integer value from entry node as new value of enumeration node
-        node_acquisition_mode.SetIntValue(acquisition_mode_continuous)
-        print('Camera acquisition mode set to continuous...' )
-
-        # Retrieve Stream Parameters device nodemap
-        s_node_map = cam.GetTLStreamNodeMap()
-
-        # Retrieve Buffer Handling Mode Information
-        handling_mode = PySpin.CEnumerationPtr(s_node_map.GetNode('StreamBufferHandlingMode'))
-        if not PySpin.IsAvailable(handling_mode) or not PySpin.IsWritable(handling_mode):
-            print('Unable to set Buffer Handling mode (node retrieval). Aborting...\n')
-            return False
-
-        handling_mode_entry = PySpin.CEnumEntryPtr(handling_mode.GetCurrentEntry())
-        if not PySpin.IsAvailable(handling_mode_entry) or not PySpin.IsReadable(handling_mode_entry):
-            print('Unable to set Buffer Handling mode (Entry retrieval). Aborting...\n')
-            return False
-
-        # Set stream buffer Count Mode to manual
-        stream_buffer_count_mode = PySpin.CEnumerationPtr(s_node_map.GetNode('StreamBufferCountMode'))
-        if not PySpin.IsAvailable(stream_buffer_count_mode) or not PySpin.IsWritable(stream_buffer_count_mode):
-            print('Unable to set Buffer Count Mode (node retrieval). Aborting...\n')
-            return False
-
-        stream_buffer_count_mode_manual = PySpin.CEnumEntryPtr(stream_buffer_count_mode.GetEntryByName('Manual'))
-        if not PySpin.IsAvailable(stream_buffer_count_mode_manual) or not PySpin.IsReadable(
-                stream_buffer_count_mode_manual):
-            print('Unable to set Buffer Count Mode entry (Entry retrieval). Aborting...\n')
-            return False
-
-        stream_buffer_count_mode.SetIntValue(stream_buffer_count_mode_manual.GetValue())
-
-
-        # Access trigger overlap info
-        node_trigger_overlap = PySpin.CEnumerationPtr(nodemap.GetNode('TriggerOverlap'))
-        if not PySpin.IsAvailable(node_trigger_overlap) or not PySpin.IsWritable(node_trigger_overlap):
-            print('Unable to set trigger overlap to "Read Out". Aborting...')
-            return False
-
-        # Retrieve enumeration for trigger overlap Read Out
-        if framerate == 'hardware':
-            node_trigger_overlap_ro = node_trigger_overlap.GetEntryByName('ReadOut')
-        else:
-            node_trigger_overlap_ro = node_trigger_overlap.GetEntryByName('Off')
+    # The camera streams for the capture only, subclasses capturing from a running stream
+    # leave it as it is
+    def begin_stream(self):
+        self.cam.BeginAcquisition()
 
-        if not PySpin.IsAvailable(node_trigger_overlap_ro) or not PySpin.IsReadable(
-                node_trigger_overlap_ro):
-            print('Unable to set trigger overlap (entry retrieval). Aborting...')
-            return False
+    def end_stream(self):
+        self.cam.EndAcquisition()
 
-        # Retrieve integer value from enumeration
-        trigger_overlap_ro = node_trigger_overlap_ro.GetValue()
+    # Save the remaining frame times and fit the camera clock to the host clock
+    def finish(self):
+        self.stamps.close()
+        recorded = self.stamps.recorded()
+        self.clock = estimate_clock(recorded['timestamp'], recorded['host_time'])
+
+
+# Stream settings of the camera serial: its stream_tuning entry, or the params.yaml defaults
+def stream_settings(serial=None):
+    config = get_config()
+    settings = {'buffer_count': config.stream_buffer_count, 'handling_mode': config.stream_buffer_handling,
+                'link_limit_mbps': config.link_throughput_limit_mbps}
+    settings.update(config.stream_tuning.get(str(serial)) or {})
+    return settings
+
+
+# Steps of the region of interest, a multiple of the Width, Height and Offset increments of
+# the FLIR sensors, so the values written are the values the camera keeps
+ROI_STEP = 16
+
+
+# Sensor size of a camera, (SensorWidth, SensorHeight)
+def sensor_size(cam):
+    return cam.GetNodeValue('SensorWidth'), cam.GetNodeValue('SensorHeight')
+
+
+# Readout geometry of the camera serial on a sensor of sensor (width, height): binning,
+# decimation, and the region of interest in binned pixels, rounded down to ROI_STEP.
+# roi width/height 0: up to the sensor edge, offset_x/offset_y 'center': centred.
+def sensor_geometry(serial=None, sensor=None):
+    config = get_config()
+    geometry = {'binning': config.binning, 'decimation': config.decimation}
+    geometry.update(config.roi)
+    geometry.update(config.camera_geometry.get(str(serial)) or {})
+    step = geometry['binning'] * geometry['decimation']
+    full = [size // step // ROI_STEP * ROI_STEP for size in sensor]
+    result = {'binning': geometry['binning'], 'decimation': geometry['decimation']}
+    for axis, size, offset, maximum in ((0, 'width', 'offset_x', full[0]), (1, 'height', 'offset_y', full[1])):
+        value = min(geometry.get(size) or maximum, maximum) // ROI_STEP * ROI_STEP
+        start = geometry.get(offset) or 0
+        if start == 'center':
+            start = (maximum - value) // 2
+        result[size] = value
+        result[offset] = min(int(start), maximum - value) // ROI_STEP * ROI_STEP
+    return result
 
-        # Set trigger overlap using retrieved integer from enumeration
-        node_trigger_overlap.SetIntValue(trigger_overlap_ro)
 
-        # Access exposure auto info
-        node_exposure_auto = PySpin.CEnumerationPtr(nodemap.GetNode('ExposureAuto'))
-        if not PySpin.IsAvailable(node_exposure_auto) or not PySpin.IsWritable(node_exposure_auto):
-            print('Unable to get exposure auto. Aborting...')
+# Geometry node settings of the camera serial. Binning and decimation first, they set the
+# largest region of interest; the offsets are cleared before the region grows (see
+# CameraSetup.WRITE_PREREQUISITES).
+def geometry_settings(serial=None, sensor=None):
+    geometry = sensor_geometry(serial, sensor)
+    return [
+        ('BinningHorizontal', geometry['binning'], 'device'),
+        ('BinningVertical', geometry['binning'], 'device'),
+        ('DecimationHorizontal', geometry['decimation'], 'device'),
+        ('DecimationVertical', geometry['decimation'], 'device'),
+        ('Width', geometry['width'], 'device'),
+        ('Height', geometry['height'], 'device'),
+        ('OffsetX', geometry['offset_x'], 'device'),
+        ('OffsetY', geometry['offset_y'], 'device'),
+    ]
+
+
+# Node settings of a run for the camera serial with a sensor of sensor (width, height),
+# in the order they are written: (node, value, nodemap)
+def camera_settings(framerate=None, serial=None, sensor=None):
+    # Primary camera trigger source on line0 (hardware trigger), trigger overlap "Read Out"
+    # with the hardware trigger. The trigger is switched off while its source changes
+    # (see CameraSetup.WRITE_PREREQUISITES).
+    config = get_config()
+    hardware = (framerate or config.framerate) == 'hardware'
+    stream = stream_settings(serial)
+    settings = [
+        ('TriggerSource', 'Line0' if hardware else 'Software', 'device'),
+        ('TriggerMode', 'On', 'device'),
+        ('AcquisitionMode', 'Continuous', 'device'),
+        # stream buffer count mode to manual, the count and what happens when the buffers are full
+        ('StreamBufferCountMode', 'Manual', 'stream'),
+        ('StreamBufferCountManual', stream['buffer_count'], 'stream'),
+        ('StreamBufferHandlingMode', stream['handling_mode'], 'stream'),
+        ('TriggerOverlap', 'ReadOut' if hardware else 'Off', 'device'),
+        # exposure auto off, then the exposure time in microseconds
+        ('ExposureAuto', 'Off', 'device'),
+        ('ExposureTime', config.exp_time * 1000000, 'device'),
+        # gain auto off, then the gain
+        ('GainAuto', 'Off', 'device'),
+        ('Gain', config.gain, 'device'),
+    ]
+    if sensor is not None:
+        settings += geometry_settings(serial, sensor)
+    # bandwidth the camera may take on the USB link, in bytes per second (0: as it is)
+    if stream['link_limit_mbps']:
+        settings.append(('DeviceLinkThroughputLimit', int(stream['link_limit_mbps'] * 1e6), 'device'))
+    # Chunk data: the camera appends the frame ID and the timestamp latched at exposure
+    # start to every frame, read back through CameraHandles.frame_info
+    if config.chunk_timestamps:
+        settings += [
+            ('ChunkModeActive', True, 'device'),
+            ('ChunkEnable[FrameID]', True, 'device'),
+            ('ChunkEnable[Timestamp]', True, 'device'),
+        ]
+    return settings
+
+
+# Configure a camera for a run, writing only the nodes not already set.
+# snapshots: CameraSnapshots of the bring-up, for the camera_user_set shortcut
+def configure_cam(cam, framerate=None, snapshots=None):
+    try:
+        settings = camera_settings(framerate, cam.GetSerial(), sensor_size(cam))
+        if not configure_nodes(cam, settings, snapshots, get_config().camera_user_set):
             return False
+        print('Camera acquisition mode set to continuous...')
 
-        # Retrieve enumeration for trigger overlap Read Out
-        node_exposure_auto_off = node_exposure_auto.GetEntryByName('Off')
-        if not PySpin.IsAvailable(node_exposure_auto_off) or not PySpin.IsReadable(
-                node_exposure_auto_off):
-            print('Unable to get exposure auto "Off" (entry retrieval). Aborting...')
-            return False
+    # General exception
+    except CAMERA_ERRORS as ex:
+        print('Error (237): %s' % ex)
+        return False
 
-        # Set exposure auto to off
-        node_exposure_auto.SetIntValue(node_exposure_auto_off.GetValue())
-        #cam.ExposureAuto.SetValue(PySpin.ExposureAuto_Off)
+    return True
 
-        # Access exposure info
-        node_exposure_time = PySpin.CFloatPtr(nodemap.GetNode('ExposureTime'))
-        if not PySpin.IsAvailable(node_exposure_time) or not PySpin.IsWritable(node_exposure_time):
-            print('Unable to get exposure time. Aborting...')
-            return False
 
-        # Set value
-        node_exposure_time.SetValue(exp_time * 1000000)
-        cam.GainAuto.SetValue(PySpin.GainAuto_Off)
-        cam.Gain.SetValue(gain)
+# Initialize and configure the cameras, all at once. Returns their CameraHandles.
+def bring_up_cameras(cam_list, framerate=None, workers=None):
+    config = get_config()
+    workers = config.bring_up_workers if workers is None else workers
+    snapshots = CameraSnapshots(config.camera_cache_path)
+    t_start = time.monotonic()
 
-    # General exception
-    except PySpin.SpinnakerException as ex:
-        print('Error (237): %s' % ex)
-        return False
+    def setup(cam):
+        cam.Init()
+        if not configure_cam(cam, framerate, snapshots):
+            print('Unable to configure camera %s' % cam.GetSerial())
+        return CameraHandles(cam)
 
-    return result
+    handles = bring_up(cam_list, setup, workers)
+    snapshots.save()
+    snapshots.print_stats(len(cam_list), time.monotonic() - t_start)
+    return handles
 
 
-def print_device_info(nodemap, cam_num):
+def print_device_info(cam, cam_num):
     # This function prints the device information of the camera
 
     print('Printing device information for camera %d... \n' % cam_num)
 
     try:
         result = True
-        node_device_information = PySpin.CCategoryPtr(nodemap.GetNode('DeviceInformation'))
+        device_info = cam.GetDeviceInfo()
 
-        if PySpin.IsAvailable(node_device_information) and PySpin.IsReadable(node_device_information):
-            features = node_device_information.GetFeatures()
-            for feature in features:
-                node_feature = PySpin.CValuePtr(feature)
-                print('%s: %s' % (node_feature.GetName(),
-                                  node_feature.ToString() if PySpin.IsReadable(node_feature) else 'Node not readable'))
+        if device_info:
+            for name, value in device_info:
+                print('%s: %s' % (name, value))
 
         else:
             print('Device control information not available.')
         print()
 
-    except PySpin.SpinnakerException as ex:
+    except CAMERA_ERRORS as ex:
         print('Error: %s' % ex)
         return False
 
     return result
 
 def run_multiple_cameras(cam_list):
+    config = get_config()
+    filename = config.filename
     thread = []
+    writer = make_writer_pool()
+    store = make_store()
+    PROBES.reset()
+    reporter = None
+    if config.probe_live_interval:
+        reporter = ThreadProbeReporter(PROBES, filename + '_probes.json', config.probe_live_interval)
+        reporter.start()
     #result = True
 
     #print('*** DEVICE INFORMATION ***\n')
 
+    handles = bring_up_cameras(cam_list)
+    rings, sinks = [], []
     for i, cam in enumerate(cam_list):
-        cam.Init()
-        configure_cam(cam)
-        nodemap = cam.GetNodeMap()
-        # Retrieve TL device nodemap
-        nodemap_tldevice = cam.GetTLDeviceNodeMap()
+        rings.append(make_frame_ring(handles[i]))
+        sinks.append(store.sink(i, handles[i]))
 
         # Print device information
-        #result &= print_device_info(nodemap_tldevice, i)
+        #result &= print_device_info(cam, i)
+
+    # Frames are matched across the cameras before they are written
+    sync = make_sync(writer, sinks)
+    # Software triggers are fired to all the cameras at once, on the framerate timetable
+    broadcaster = make_trigger_broadcaster(handles)
+    tap = make_preview_tap(len(cam_list))
 
+    for i, cam in enumerate(cam_list):
         #cam.BeginAcquisition()
         print('Camera %d started acquiring images...' % i)
 
-        thread.append(ThreadCapture(cam, i, nodemap))
+        thread.append(ThreadCapture(handles[i], i, writer, rings[i], sinks[i], sync=sync, broadcaster=broadcaster,
+                                    preview=tap))
         thread[i].start()
+    if broadcaster is not None:
+        broadcaster.start()
 
+    if tap is not None:
+        wait_with_preview(thread, tap, [h.serial for h in handles])
     for t in thread:
         t.join()
+    if broadcaster is not None:
+        broadcaster.stop()
+        broadcaster.join()
+        broadcaster.print_stats()
+        broadcaster.dump(filename + '_triggers.json', trigger_path(filename))
+
+    finish_run(thread, writer, store, sync, reporter)
 
     for i, cam in enumerate(cam_list):
         #reset_trigger(cam)
         cam.DeInit()
 
 
+# End of a run, once the capture threads (or the frame receivers of the camera processes, see
+# ProcessCapture.py) have stopped: frames still waiting for a partner are orphans, the queued
+# frames are written, then the stage timings and the device clock of every camera are saved
+def finish_run(threads, writer, store, sync, reporter=None):
+    filename = get_config().filename
+    if sync is not None:
+        sync.flush()
+        for t in threads:
+            t.finish()
+        sync.print_stats()
+        sync.dump(filename + '_sync.json')
+
+    # Write the queued frames before releasing the cameras
+    writer.close()
+    store.close()
+    writer.print_stats()
+
+    # Dump the stage timings of the run
+    if reporter is not None:
+        reporter.stop()
+    PROBES.print_summary()
+    PROBES.dump(filename + '_probes.json')
+
+    # Device clock of every camera against the host clock, to pair frames across cameras
+    clocks = {i: t.clock for i, t in enumerate(threads)}
+    print_clocks(clocks)
+    save_clocks(clock_path(filename), clocks)
+
+
+def print_clocks(clocks):
+    for i, clock in sorted(clocks.items()):
+        if clock is None:
+            print('Camera %d clock: not enough frames to fit' % i)
+        else:
+            print('Camera %d clock: drift %.2f ppm, host latency jitter %.1f us over %d frames' %
+                  (i, clock.drift_ppm, clock.residual_ns / 1e3, clock.samples))
+
+
 # Trigger reset
 def reset_trigger(cam):
-    nodemap = cam.GetNodeMap()
     try:
-        result = True
-        node_trigger_mode = PySpin.CEnumerationPtr(nodemap.GetNode('TriggerMode'))
-        if not PySpin.IsAvailable(node_trigger_mode) or not PySpin.IsReadable(node_trigger_mode):
-            print('Unable to disable trigger mode 630 (node retrieval). Aborting...')
-            return False
-
-        node_trigger_mode_off = node_trigger_mode.GetEntryByName('Off')
-        if not PySpin.IsAvailable(node_trigger_mode_off) or not PySpin.IsReadable(node_trigger_mode_off):
-            print('Unable to disable trigger mode (enum entry retrieval). Aborting...')
-            return False
+        result = cam.SetNodeValue('TriggerMode', 'Off')
 
-        node_trigger_mode.SetIntValue(node_trigger_mode_off.GetValue())
-
-    except PySpin.SpinnakerException as ex:
+    except CAMERA_ERRORS as ex:
         print('Error : %s' % ex)
         result = False
 
     return result
 
-def launch_acquisition():
+# service: Arduino trigger service sending start / stop to an async run (see arduino.py)
+def launch_acquisition(service=None):
     # launch the AcquisitionMultipleCamera code
+    config = get_config()
+    # num_images: 0 captures until stopped, which only the async controller can do
+    if config.num_images == 0 and config.acquisition_mode != 'async':
+        print('num_images: 0 needs acquisition_mode: async, %s takes a number of frames' % config.acquisition_mode)
+        return False
+    enter_image_folder(config)
 
     try:
         test_file = open('test.txt', 'w+')
@@ -372,8 +564,8 @@ def launch_acquisition():
 
     result = True
 
-    # Retrieve singleton reference to system object
-    system = PySpin.System.GetInstance()
+    # Retrieve singleton reference to system object of the configured camera backend
+    system = get_system(config.camera_backend, config.simulation)
 
     # Get current library version
     version = system.GetLibraryVersion()
@@ -382,16 +574,13 @@ def launch_acquisition():
     # Retrieve list of cameras from the system
     cam_list = system.GetCameras()
 
-    num_cameras = cam_list.GetSize()
+    num_cameras = len(cam_list)
 
     print('Number of cameras detected: %d' % num_cameras)
 
     # Finish if there are no cameras
     if num_cameras == 0:
 
-        # Clear camera list before releasing system
-        cam_list.Clear()
-
         # Release system instance
         system.ReleaseInstance()
 
@@ -402,10 +591,21 @@ def launch_acquisition():
     # Run example on all cameras
     print('Running example for all cameras...')
 
-    run_multiple_cameras(cam_list)
+    # the capture processes and the async controller are only imported by the runs using them
+    if config.acquisition_mode == 'processes':
+        import ProcessCapture
+        result = ProcessCapture.run_camera_processes(cam_list)
+    elif config.acquisition_mode == 'async':
+        import AsyncController
+        result = AsyncController.run_async_acquisition(cam_list, service)
+    elif config.acquisition_mode == 'threads':
+        run_multiple_cameras(cam_list)
+    else:
+        print('Unknown acquisition_mode %r, expected one of %s' % (config.acquisition_mode, ACQUISITION_MODES))
+        result = False
 
     # Clear camera list before releasing system
-    cam_list.Clear()
+    del cam_list
 
     # Release system instance
     system.ReleaseInstance()
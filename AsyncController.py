@@ -0,0 +1,429 @@
+import asyncio
+import json
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import AcquisitionMultipleCamera as acq
+from Config import get_config
+from CameraBackend import CAMERA_ERRORS, is_grab_timeout
+from Probes import PROBES, ThreadProbeReporter
+from Timestamps import TimestampLog, timestamp_path, estimate_clock
+from TriggerScheduler import TriggerTimetable
+from PreviewTap import show_preview
+from PretriggerBuffer import PretriggerWriter, frames_for
+
+# Asyncio acquisition controller (acquisition_mode: async).
+# One event loop coordinates the cameras, the writer pool and the commands of the run. The
+# blocking Spinnaker calls run in a single thread executor per camera (so calls to one camera
+# never overlap), the event loop only awaits them, so it stays free to react to commands.
+# Grabs wait at most GRAB_TIMEOUT_MS for a frame, a stop takes effect within that time even
+# when no trigger comes.
+#
+# Software triggered runs go in rounds, like the trigger broadcaster: the triggers of all the
+# cameras are fired back to back at the next slot of the framerate timetable, then the next
+# round waits for the frame of every camera. Hardware triggered cameras are grabbed by one task
+# each.
+#
+# Commands: start, stop, pause, resume, status and trigger. They come from post() (thread safe,
+# for the Arduino or any other thread), from the keyboard (one command per line) and, with control_port
+# set in params.yaml, from TCP clients on localhost, which get the status as a JSON line after
+# every command. The run starts at once with controller_autostart, otherwise on start; it ends
+# after num_images frames (0: on stop). Paused cameras are not triggered, frames arriving from
+# hardware triggers while paused are not written. With preview on, the preview windows are
+# refreshed by the event loop too, ESC in a window stops the run.
+#
+# Continuous recording (pretrigger_seconds): the run goes on until stop, the frames only reach
+# the disk around events, see PretriggerBuffer.py. An event is the trigger command ('trigger
+# <source>' to label it, e.g. from the Arduino) or SPACE in a preview window; the events are
+# saved to <file_name>_events.json. Frame numbers keep counting from the start of the run, and
+# only the last STAMPS_KEPT frame times of each camera stay in memory.
+
+COMMANDS = ('start', 'stop', 'pause', 'resume', 'status', 'trigger')
+GRAB_TIMEOUT_MS = 50
+STAMPS_KEPT = 1 << 16
+
+
+# Camera of the run: its handles, ring and sink, and the per-frame work done in its executor
+class CameraTask:
+    def __init__(self, camnum, handles, ring, sink, num_images):
+        self.camnum = camnum
+        self.handles = handles
+        self.cam = handles.cam
+        self.ring = ring
+        self.sink = sink
+        self.probe = PROBES.camera(camnum)
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix='camera%d' % camnum)
+        # frame timestamps, written to <file_name>_t<N>.bin unless the output holds them (raw frame log)
+        path = None if sink.records_timestamps else timestamp_path(get_config().filename, camnum)
+        self.stamps = TimestampLog(path, num_images, limit=0 if num_images else STAMPS_KEPT)
+        self.clock = None
+        self.captured = 0
+        self.skipped = 0
+        self.timeouts = 0
+        self.incomplete = 0
+
+    # Grab the next frame and queue it for writing (through sync when frames are matched) as
+    # frame index, or drop it when write is False; preview is the run's PreviewTap. Runs in the
+    # camera's executor, returns False when no frame came within GRAB_TIMEOUT_MS.
+    def grab(self, index, writer, sync, write=True, t_start=None, preview=None):
+        t_wait = time.monotonic_ns()
+        try:
+            image_result = self.cam.GetNextImage(GRAB_TIMEOUT_MS)
+        except CAMERA_ERRORS as ex:
+            if is_grab_timeout(ex):
+                self.timeouts += 1
+                return False
+            raise
+        t_grab = time.monotonic_ns()
+        self.probe.record('grab', t_grab - t_wait)
+        if not write:
+            image_result.Release()
+            self.skipped += 1
+            return True
+        # an incomplete frame (packets lost on the link) is dropped, its index stays empty
+        if image_result.IsIncomplete():
+            image_result.Release()
+            self.probe.record('incomplete', t_grab - t_wait)
+            self.incomplete += 1
+            return True
+        if t_start is None:
+            t_start = t_wait
+
+        # Copy the frame into the ring and give the buffer back to the driver at once
+        ring = self.ring
+        slot = ring.acquire()
+        frame = ring.copy_in(slot, image_result.GetNDArray())
+        frame_id, timestamp = self.handles.frame_info(image_result)
+        image_result.Release()
+        if preview is not None:
+            preview.offer(self.camnum, frame, self.handles.pixel_format, index)
+        t_copy = time.monotonic_ns()
+        self.probe.record('copy', t_copy - t_grab)
+
+        if sync is None:
+            self.stamps.append(index, frame_id, timestamp, t_grab)
+            writer.submit(self.camnum, self.sink.write, index, frame, frame_id, timestamp, t_grab,
+                          nbytes=frame.nbytes, release=lambda slot=slot: ring.release(slot), t_start=t_start)
+        else:
+            sync.push(self.camnum, frame, frame_id, timestamp, t_grab,
+                      lambda slot=slot: ring.release(slot), t_start, self.stamps)
+        self.probe.record('enqueue', time.monotonic_ns() - t_copy)
+        self.captured += 1
+        return True
+
+    # Save the remaining frame times and fit the camera clock to the host clock
+    def finish(self):
+        self.stamps.close()
+        recorded = self.stamps.recorded()
+        self.clock = estimate_clock(recorded['timestamp'], recorded['host_time'])
+
+
+class AcquisitionController:
+    # Arguments left to None take their params.yaml value
+    def __init__(self, cam_list, num_images=None, framerate=None, autostart=None, control_port=None):
+        config = get_config()
+        self.cam_list = list(cam_list)
+        self.num_images = config.num_images if num_images is None else num_images
+        self.framerate = config.framerate if framerate is None else framerate
+        self.autostart = config.controller_autostart if autostart is None else autostart
+        self.control_port = config.control_port if control_port is None else control_port
+        self.state = 'idle'
+        self.tasks = []
+        self.loop = None
+        self.commands = None
+        # commands posted before the event loop runs, queued once it does
+        self.post_lock = threading.Lock()
+        self.early_commands = []
+        # frames go to writer, the writer pool or the PretriggerWriter in front of it
+        self.pool = None
+        self.writer = None
+        self.pretrigger = None
+        self.events = set()
+        self.sync = None
+        self.preview = None
+        self.rounds = 0
+        self.t_begin = None
+        self.result = True
+
+    # Queue a command, from any thread
+    def post(self, command):
+        with self.post_lock:
+            if self.loop is None:
+                self.early_commands.append(command)
+                return
+        self.loop.call_soon_threadsafe(self.commands.put_nowait, command)
+
+    def status(self):
+        elapsed = (time.monotonic_ns() - self.t_begin) / 1e9 if self.t_begin else 0.0
+        written = self.pool.stats() if self.pool is not None else {}
+        return {
+            'state': self.state,
+            'elapsed_s': elapsed,
+            'num_images': self.num_images,
+            'queue_depth': self.pool.queue_depth() if self.pool is not None else 0,
+            'events': len(self.pretrigger.events) if self.pretrigger is not None else 0,
+            'cameras': [{
+                'camera': task.camnum,
+                'captured': task.captured,
+                'written': written.get(task.camnum, {}).get('written', 0),
+                'skipped': task.skipped,
+                'timeouts': task.timeouts,
+                'incomplete': task.incomplete,
+                'fps': task.captured / elapsed if elapsed > 0 else 0.0,
+            } for task in self.tasks],
+        }
+
+    def print_status(self):
+        s = self.status()
+        print('%s, %.1f s: %s, writer queue %d' % (s['state'], s['elapsed_s'], ', '.join(
+            'camera %d %d captured %d written' % (c['camera'], c['captured'], c['written']) for c in s['cameras']),
+            s['queue_depth']))
+
+    def command(self, command):
+        command, _, argument = command.partition(' ')
+        if command == 'start' and self.state == 'idle':
+            self.state = 'running'
+            self.t_begin = time.monotonic_ns()
+            self.started.set()
+        elif command == 'stop' and self.state != 'stopping':
+            self.state = 'stopping'
+            self.started.set()
+            self.resumed.set()
+        elif command == 'pause' and self.state == 'running':
+            self.state = 'paused'
+            self.resumed.clear()
+        elif command == 'resume' and self.state == 'paused':
+            self.state = 'running'
+            self.resumed.set()
+        elif command == 'status':
+            self.print_status()
+        elif command == 'trigger':
+            self.trigger(argument.strip() or 'command')
+        elif command not in COMMANDS:
+            print('Unknown command %r, expected one of %s' % (command, COMMANDS))
+
+    # Record an event of the continuous recording, the history is queued in the default executor
+    def trigger(self, source):
+        if self.pretrigger is None:
+            print('Trigger ignored, continuous recording is off (pretrigger_seconds)')
+        elif self.state in ('running', 'paused'):
+            print('Event from %s' % source)
+            event = self.loop.run_in_executor(None, self.pretrigger.trigger, source)
+            self.events.add(event)
+            event.add_done_callback(self.events.discard)
+
+    async def _handle_commands(self):
+        while True:
+            self.command(await self.commands.get())
+
+    # One command per line, answered with the status as a JSON line
+    async def _serve_client(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                command = line.decode(errors='replace').strip()
+                if command:
+                    self.command(command)
+                writer.write((json.dumps(self.status()) + '\n').encode())
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def _read_keyboard(self):
+        for line in sys.stdin:
+            if line.strip():
+                self.post(line.strip())
+
+    def _done(self, index):
+        return self.state == 'stopping' or (self.num_images and index >= self.num_images)
+
+    def _progress(self, index, next_progress):
+        now = time.monotonic_ns()
+        if now >= next_progress or index == self.num_images:
+            if self.num_images:
+                print('COLLECTING IMAGE ' + str(index) + ' of ' + str(self.num_images), end='\r')
+            else:
+                print('COLLECTING IMAGE ' + str(index), end='\r')
+            sys.stdout.flush()
+            return now + acq.PROGRESS_INTERVAL_NS
+        return next_progress
+
+    # Fire the software trigger of every camera at the next slot, in the trigger executor
+    def _fire(self, timetable):
+        timetable.wait()
+        fired = time.monotonic_ns()
+        before = fired
+        for task in self.tasks:
+            task.handles.trigger_software()
+            after = time.monotonic_ns()
+            task.probe.record('trigger', after - before)
+            before = after
+        return fired
+
+    async def _software_rounds(self, trigger_executor):
+        period = int(1e9 / float(self.framerate))
+        timetable = None
+        index = 0
+        next_progress = 0
+        while not self._done(index):
+            if not self.resumed.is_set():
+                # the timetable starts again after a pause
+                timetable = None
+                await self.resumed.wait()
+                continue
+            if timetable is None:
+                timetable = TriggerTimetable(period)
+            t_start = await self.loop.run_in_executor(trigger_executor, self._fire, timetable)
+            await asyncio.gather(*(self.loop.run_in_executor(task.executor, task.grab, index, self.writer, self.sync,
+                                                             True, t_start, self.preview) for task in self.tasks))
+            index += 1
+            self.rounds = index
+            next_progress = self._progress(index, next_progress)
+
+    async def _hardware_camera(self, task, primary):
+        index = 0
+        next_progress = 0
+        while not self._done(index):
+            write = self.state == 'running'
+            got = await self.loop.run_in_executor(task.executor, task.grab, index, self.writer, self.sync, write,
+                                                  None, self.preview)
+            if got and write:
+                index += 1
+                if primary:
+                    next_progress = self._progress(index, next_progress)
+
+    # Preview windows, shown from the event loop (the thread owning them). ESC in a window stops
+    # the run, SPACE triggers an event of the continuous recording.
+    async def _show_preview(self, titles):
+        import cv2
+        interval = self.preview.period_ns / 2e9
+        try:
+            while True:
+                show_preview(self.preview, titles)
+                key = cv2.waitKey(1)
+                if key == 27:
+                    self.command('stop')
+                elif key == 32 and self.pretrigger is not None:
+                    self.command('trigger keyboard')
+                await asyncio.sleep(interval)
+        finally:
+            cv2.destroyAllWindows()
+
+    async def _call_all(self, method):
+        await asyncio.gather(*(self.loop.run_in_executor(task.executor, getattr(task.cam, method))
+                               for task in self.tasks))
+
+    async def run(self):
+        self.commands = asyncio.Queue()
+        with self.post_lock:
+            self.loop = asyncio.get_running_loop()
+            for command in self.early_commands:
+                self.commands.put_nowait(command)
+        self.started = asyncio.Event()
+        self.resumed = asyncio.Event()
+        self.resumed.set()
+
+        config = get_config()
+        self.pool = self.writer = acq.make_writer_pool()
+        store = acq.make_store(num_frames=self.num_images)
+        PROBES.reset()
+        reporter = None
+        if config.probe_live_interval:
+            reporter = ThreadProbeReporter(PROBES, config.filename + '_probes.json', config.probe_live_interval)
+            reporter.start()
+
+        # Continuous recording: the frames of the last pretrigger_seconds wait in the rings
+        slots = config.ring_slots
+        if config.pretrigger_seconds:
+            rate = config.hardware_framerate if self.framerate == 'hardware' else float(self.framerate)
+            self.pretrigger = PretriggerWriter(self.pool, len(self.cam_list), frames_for(config.pretrigger_seconds, rate),
+                                               frames_for(config.posttrigger_seconds, rate))
+            self.writer = self.pretrigger
+            slots += self.pretrigger.pre_frames
+            print('Continuous recording: %d frames before and %d after each trigger'
+                  % (self.pretrigger.pre_frames, self.pretrigger.post_frames))
+
+        handles = acq.bring_up_cameras(self.cam_list, self.framerate)
+        sinks = []
+        for i, cam in enumerate(self.cam_list):
+            sinks.append(store.sink(i, handles[i]))
+            self.tasks.append(CameraTask(i, handles[i], acq.make_frame_ring(handles[i], slots), sinks[i], self.num_images))
+            print('Camera %d serial number set to %s...' % (i, handles[i].serial))
+        # Frames are matched across the cameras before they are written
+        self.sync = acq.make_sync(self.writer, sinks, framerate=self.framerate)
+        software = self.framerate != 'hardware'
+        if software and any(h.trigger_software is None for h in handles):
+            print('Unable to execute trigger. Aborting...')
+            self.state = 'stopping'
+            self.result = False
+
+        commands = asyncio.ensure_future(self._handle_commands())
+        self.preview = acq.make_preview_tap(len(self.tasks))
+        preview = None
+        if self.preview is not None:
+            preview = asyncio.ensure_future(self._show_preview([h.serial for h in handles]))
+        server = None
+        if self.control_port:
+            server = await asyncio.start_server(self._serve_client, '127.0.0.1', self.control_port)
+            print('Listening for commands on port %d' % self.control_port)
+        if sys.stdin is not None and sys.stdin.isatty():
+            threading.Thread(target=self._read_keyboard, daemon=True).start()
+
+        await self._call_all('BeginAcquisition')
+        if self.autostart and self.state == 'idle':
+            self.command('start')
+        elif self.state == 'idle':
+            print('Waiting for the start command (%s)...' % ', '.join(COMMANDS))
+        await self.started.wait()
+
+        trigger_executor = ThreadPoolExecutor(1, thread_name_prefix='trigger')
+        try:
+            if software:
+                await self._software_rounds(trigger_executor)
+            else:
+                await asyncio.gather(*(self._hardware_camera(task, task.camnum == 0) for task in self.tasks))
+        except CAMERA_ERRORS as ex:
+            print('Error : %s' % ex)
+            self.result = False
+        self.state = 'stopping'
+        print()
+
+        await self._call_all('EndAcquisition')
+        trigger_executor.shutdown()
+        for task in self.tasks:
+            task.executor.shutdown()
+        commands.cancel()
+        if preview is not None:
+            preview.cancel()
+        if server is not None:
+            server.close()
+            await server.wait_closed()
+
+        if self.pretrigger is not None:
+            # the events still queueing their history go first, then the frames held are dropped
+            await asyncio.gather(*self.events)
+            self.pretrigger.discard()
+            self.pretrigger.print_stats()
+            self.pretrigger.dump(config.filename + '_events.json')
+        if self.sync is None:
+            for task in self.tasks:
+                task.finish()
+        acq.finish_run(self.tasks, self.pool, store, self.sync, reporter)
+        self.state = 'done'
+        for cam in self.cam_list:
+            cam.DeInit()
+        return self.result
+
+
+# acquisition_mode: async counterpart of run_multiple_cameras. service is the Arduino trigger
+# service sending its commands to the run (see arduino.py), if any.
+def run_async_acquisition(cam_list, service=None):
+    controller = AcquisitionController(cam_list)
+    if service is not None:
+        service.attach(controller)
+    return asyncio.run(controller.run())
@@ -0,0 +1,267 @@
+import argparse
+import contextlib
+import itertools
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from FrameSync import SYNC_MODES
+from AcquisitionMultipleCamera import ACQUISITION_MODES
+
+# acquisition modes of the sweep, the async controller runs on commands rather than a frame count
+BENCHMARK_MODES = tuple(mode for mode in ACQUISITION_MODES if mode != 'async')
+
+# End-to-end benchmark of the acquisition pipeline (ThreadCapture or camera processes, frame rings and writer pool)
+# against a simulated or recorded camera source.
+# Every configuration of the sweep runs in its own process, so that peak RSS and CPU
+# figures are not polluted by the previous runs. Results are written as JSON.
+#
+#   python Benchmark.py --cameras 1 2 --resolution 1280x1024 640x512 --framerate 30 60 --out bench.json
+
+
+def parse_resolution(text):
+    width, height = text.lower().split('x')
+    return int(width), int(height)
+
+
+# Capture threads of this process: returns the threads, synchronizer, trigger broadcaster,
+# wall and CPU seconds of the run
+def run_threads(config, cam_list, writer, store, trigger, slots):
+    import AcquisitionMultipleCamera as acq
+
+    handles = acq.bring_up_cameras(cam_list, trigger)
+    rings, sinks = [], []
+    for i, cam in enumerate(cam_list):
+        rings.append(acq.make_frame_ring(handles[i], slots))
+        sinks.append(store.sink(i, handles[i]))
+    sync = acq.make_sync(writer, sinks, config['sync'], framerate=trigger)
+    broadcaster = acq.make_trigger_broadcaster(handles, trigger, config['num_images'])
+    threads = [acq.ThreadCapture(handles[i], i, writer, rings[i], sinks[i], config['num_images'], trigger, sync,
+                                 broadcaster)
+               for i in range(len(cam_list))]
+
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    if broadcaster is not None:
+        broadcaster.start()
+    for t in threads:
+        t.join()
+    if broadcaster is not None:
+        broadcaster.stop()
+        broadcaster.join()
+    if sync is not None:
+        sync.flush()
+        for t in threads:
+            t.finish()
+    writer.close()
+    store.close()
+    wall = time.perf_counter() - start
+    cpu = time.process_time() - cpu_start
+
+    for cam in cam_list:
+        cam.DeInit()
+    return threads, sync, broadcaster, wall, cpu
+
+
+# One camera process per camera (see ProcessCapture.py), timed from the first trigger slot.
+# The CPU time of the camera processes is counted as capture time.
+def run_processes(config, cam_list, writer, store, trigger, settings, slots):
+    import ProcessCapture
+
+    procs = ProcessCapture.start_camera_processes([cam.GetSerial() for cam in cam_list], config['num_images'],
+                                                  trigger, config['source'], settings, quiet=True)
+    started = ProcessCapture.capture_with_processes(procs, writer, store, config['sync'], trigger, slots)
+    if started is None:
+        raise RuntimeError('Unable to start the camera processes')
+    rings, sync = started
+
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    for proc in procs:
+        proc.join()
+    if sync is not None:
+        sync.flush()
+        for proc in procs:
+            proc.finish()
+    writer.close()
+    store.close()
+    wall = time.perf_counter() - start
+    cpu = time.process_time() - cpu_start
+
+    for proc in procs:
+        proc.close()
+    for ring in rings:
+        ring.close()
+    return procs, sync, None, wall, cpu
+
+
+# Run one configuration in this process and return its result dict
+def run_one(config):
+    import AcquisitionMultipleCamera as acq
+    from CameraBackend import get_system
+    from WriterPool import WriterPool
+    from Probes import PROBES
+    from Config import get_config
+
+    params = get_config()
+    if config['file_format'] not in acq.FILE_FORMATS:
+        raise ValueError('Unsupported file format %r, expected one of %s' % (config['file_format'], acq.FILE_FORMATS))
+
+    settings = dict(params.simulation)
+    settings.update({
+        'num_cameras': config['cameras'],
+        'width': config['width'],
+        'height': config['height'],
+        'framerate': config['framerate'],
+        'bit_depth': config['bit_depth'],
+    })
+    if config.get('recording_path'):
+        settings['recording_path'] = config['recording_path']
+
+    workdir = tempfile.mkdtemp(prefix='dic_bench_')
+    os.chdir(workdir)
+    system = get_system(config['source'], settings)
+    cam_list = system.GetCameras()[:config['cameras']]
+    trigger = 'hardware' if config['trigger'] == 'hardware' else config['framerate']
+
+    try:
+        writer = WriterPool(config['workers'], config['queue_depth'], config['policy'], PROBES)
+        store = acq.make_store(config['file_format'], config['num_images'])
+        slots = config['queue_depth'] + config['workers'] + params.sync_max_pending + 1
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            if config.get('mode') == 'processes':
+                threads, sync, broadcaster, wall, cpu = run_processes(config, cam_list, writer, store, trigger, settings,
+                                                                     slots)
+            else:
+                threads, sync, broadcaster, wall, cpu = run_threads(config, cam_list, writer, store, trigger, slots)
+    finally:
+        system.ReleaseInstance()
+        os.chdir(tempfile.gettempdir())
+        if not config.get('keep'):
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    stats = writer.stats()
+    per_camera = []
+    for i, cam in enumerate(cam_list):
+        s = stats.get(i, {})
+        per_camera.append({
+            'camera': i,
+            'written': s.get('written', 0),
+            'dropped_writer': s.get('dropped', 0),
+            'lost_camera': getattr(threads[i], 'lost_frames', getattr(cam, 'lost_frames', 0)),
+            'orphans': sync.orphan_count[i] if sync is not None else 0,
+            'sustained_fps': s.get('written', 0) / wall if wall > 0 else 0.0,
+            'write_mb_per_s': s.get('mb_per_s', 0.0),
+            'peak_queue_depth': s.get('peak_queue_depth', 0),
+            'latency_ms': s.get('latency_ms', {}),
+        })
+
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        maxrss *= 1024
+
+    return {
+        'config': config,
+        'wall_s': wall,
+        'sustained_fps': sum(c['written'] for c in per_camera) / wall if wall > 0 else 0.0,
+        'dropped_frames': sum(c['dropped_writer'] + c['lost_camera'] + c['orphans'] for c in per_camera),
+        'peak_rss_mb': maxrss / 1e6,
+        'cpu_s': {
+            'capture': sum(t.cpu_time for t in threads),
+            'writer': writer.cpu_time,
+            'process': cpu,
+        },
+        'cameras': per_camera,
+        'sync': sync.stats() if sync is not None else None,
+        'trigger': broadcaster.stats() if broadcaster is not None else None,
+        'stages': PROBES.snapshot(),
+    }
+
+
+def sweep(args):
+    keys = ('mode', 'cameras', 'resolution', 'framerate', 'trigger', 'file_format', 'workers', 'queue_depth', 'policy',
+            'sync')
+    values = (args.mode, args.cameras, args.resolution, args.framerate, args.trigger, args.file_format,
+              args.workers, args.queue_depth, args.policy, args.sync)
+    for combination in itertools.product(*values):
+        config = dict(zip(keys, combination))
+        config['width'], config['height'] = parse_resolution(config.pop('resolution'))
+        config.update({
+            'num_images': args.num_images,
+            'bit_depth': args.bit_depth,
+            'source': args.source,
+            'recording_path': args.recording_path,
+            'keep': args.keep,
+        })
+        yield config
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the acquisition pipeline on a simulated or recorded camera source.')
+    parser.add_argument('--mode', nargs='+', default=['threads'], choices=BENCHMARK_MODES)
+    parser.add_argument('--cameras', type=int, nargs='+', default=[2])
+    parser.add_argument('--resolution', nargs='+', default=['1280x1024'], help='WIDTHxHEIGHT')
+    parser.add_argument('--framerate', type=float, nargs='+', default=[30.0])
+    parser.add_argument('--trigger', nargs='+', default=['hardware'], choices=['hardware', 'software'])
+    parser.add_argument('--file-format', nargs='+', default=['tif'])
+    parser.add_argument('--workers', type=int, nargs='+', default=[4])
+    parser.add_argument('--queue-depth', type=int, nargs='+', default=[64])
+    parser.add_argument('--policy', nargs='+', default=['block'])
+    parser.add_argument('--sync', nargs='+', default=['auto'], choices=SYNC_MODES)
+    parser.add_argument('--num-images', type=int, default=300)
+    parser.add_argument('--bit-depth', type=int, default=8)
+    parser.add_argument('--source', default='simulated', choices=['simulated', 'recorded'])
+    parser.add_argument('--recording-path', default=None, help='acquisition directory replayed by the recorded source')
+    parser.add_argument('--keep', action='store_true', help='keep the written frames')
+    parser.add_argument('--out', default='bench_results.json')
+    parser.add_argument('--run-one', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.run_one is not None:
+        print(json.dumps(run_one(json.loads(args.run_one))))
+        return True
+
+    results = []
+    for config in sweep(args):
+        proc = subprocess.run([sys.executable, os.path.abspath(__file__), '--run-one', json.dumps(config)],
+                              capture_output=True, text=True)
+        if proc.returncode != 0:
+            print('Run failed for %s:\n%s' % (config, proc.stderr))
+            results.append({'config': config, 'error': proc.stderr.strip().splitlines()[-1:]})
+            continue
+        result = json.loads(proc.stdout.strip().splitlines()[-1])
+        results.append(result)
+        lat = [c['latency_ms'].get('p99', 0.0) for c in result['cameras']]
+        print('%s, %d cam %dx%d @ %s (%s, %s, %d workers, depth %d, %s): %.1f fps, %d dropped, p99 latency %.1f ms, peak RSS %.0f MB'
+              % (config['mode'], config['cameras'], config['width'], config['height'], config['framerate'], config['trigger'],
+                 config['file_format'], config['workers'], config['queue_depth'], config['policy'],
+                 result['sustained_fps'], result['dropped_frames'], max(lat or [0.0]), result['peak_rss_mb']))
+
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'host': {
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'cpu_count': os.cpu_count(),
+        },
+        'results': results,
+    }
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('Results written to %s' % os.path.abspath(args.out))
+    return all('error' not in r for r in results)
+
+
+if __name__ == '__main__':
+    if main():
+        sys.exit(0)
+    else:
+        sys.exit(1)
@@ -0,0 +1,1031 @@
+import functools
+import os
+import threading
+import time
+from collections import deque, namedtuple
+import numpy as np
+
+# The Spinnaker SDK is imported by load_pyspin, when a Spinnaker system is opened or a frame
+# is saved as TIFF, so the runs, worker processes and tools using the other backends never
+# load it.
+PySpin = None
+_pyspin_tried = False
+
+
+# Error raised by the camera backends. The PySpin.SpinnakerException of the Spinnaker camera and image calls
+# are raised again as CameraError (keeping their errorcode), catch CAMERA_ERRORS to handle them.
+class CameraError(Exception):
+    pass
+
+
+CAMERA_ERRORS = (CameraError,)
+
+
+# PySpin module, imported on the first call, or None when it is not installed
+def load_pyspin():
+    global PySpin, _pyspin_tried
+    if not _pyspin_tried:
+        _pyspin_tried = True
+        try:
+            import PySpin
+        except ImportError:
+            PySpin = None
+    return PySpin
+
+
+# CameraError of a SpinnakerException
+def spinnaker_error(ex):
+    error = CameraError(str(ex))
+    error.errorcode = getattr(ex, 'errorcode', None)
+    return error
+
+
+# Decorator of the Spinnaker calls, raising their SpinnakerException as CameraError
+def spinnaker_call(method):
+    @functools.wraps(method)
+    def call(*args, **kwargs):
+        try:
+            return method(*args, **kwargs)
+        except PySpin.SpinnakerException as ex:
+            raise spinnaker_error(ex) from ex
+    return call
+
+LibraryVersion = namedtuple('LibraryVersion', 'major minor type build')
+
+# Nodemaps reachable through GetNodeValue / SetNodeValue
+NODEMAPS = ('device', 'tldevice', 'stream')
+
+
+# Camera interface used by the acquisition, trigger, display and writer paths.
+# It covers the Spinnaker calls the code actually uses:
+#   Init / DeInit / BeginAcquisition / EndAcquisition
+#   GetNextImage(timeout_ms) -> image with GetNDArray, GetWidth, GetHeight, IsIncomplete,
+#                               GetFrameID, GetTimeStamp, GetChunkData, GetPixelFormatName
+#                               and Release
+#   TriggerSoftware()
+#   GetNodeValue / SetNodeValue / ExecuteNode / ResolveCommand on the 'device', 'tldevice'
+#   and 'stream' nodemaps
+# SpinnakerCamera wraps a PySpin camera, SimulatedCamera produces synthetic speckle frames.
+class Camera:
+    def GetSerial(self):
+        return str(self.GetNodeValue('DeviceSerialNumber', 'tldevice'))
+
+    def TriggerSoftware(self):
+        return self.ExecuteNode('TriggerSoftware')
+
+    # Callable executing a command node, resolved once so per-frame code does no node lookup.
+    # Returns None if the node does not exist.
+    def ResolveCommand(self, name, nodemap='device'):
+        raise NotImplementedError
+
+    # (name, value) pairs of the device information category, for print_device_info
+    def GetDeviceInfo(self):
+        info = []
+        for name in ('DeviceVendorName', 'DeviceModelName', 'DeviceSerialNumber', 'DeviceVersion'):
+            try:
+                info.append((name, self.GetNodeValue(name, 'tldevice')))
+            except CAMERA_ERRORS:
+                info.append((name, 'Node not readable'))
+        return info
+
+
+# Camera backed by the Spinnaker SDK
+class SpinnakerCamera(Camera):
+    def __init__(self, cam):
+        self.cam = cam
+
+    @spinnaker_call
+    def Init(self):
+        self.cam.Init()
+
+    @spinnaker_call
+    def DeInit(self):
+        self.cam.DeInit()
+
+    @spinnaker_call
+    def BeginAcquisition(self):
+        self.cam.BeginAcquisition()
+
+    @spinnaker_call
+    def EndAcquisition(self):
+        self.cam.EndAcquisition()
+
+    @spinnaker_call
+    def IsStreaming(self):
+        return self.cam.IsStreaming()
+
+    @spinnaker_call
+    def GetNextImage(self, timeout_ms=None):
+        if timeout_ms is None:
+            return SpinnakerImage(self.cam.GetNextImage())
+        return SpinnakerImage(self.cam.GetNextImage(timeout_ms))
+
+    def _nodemap(self, nodemap):
+        if nodemap == 'device':
+            return self.cam.GetNodeMap()
+        if nodemap == 'tldevice':
+            return self.cam.GetTLDeviceNodeMap()
+        if nodemap == 'stream':
+            return self.cam.GetTLStreamNodeMap()
+        raise ValueError('Unknown nodemap %r, expected one of %s' % (nodemap, NODEMAPS))
+
+    def GetNode(self, name, nodemap='device'):
+        return self._nodemap(nodemap).GetNode(name)
+
+    @spinnaker_call
+    def GetNodeValue(self, name, nodemap='device'):
+        node = self.GetNode(name, nodemap)
+        if node is None or not PySpin.IsAvailable(node) or not PySpin.IsReadable(node):
+            raise CameraError('Node %s is not readable' % name)
+
+        kind = node.GetPrincipalInterfaceType()
+        if kind == PySpin.intfIEnumeration:
+            return PySpin.CEnumerationPtr(node).GetCurrentEntry().GetSymbolic()
+        if kind == PySpin.intfIInteger:
+            return PySpin.CIntegerPtr(node).GetValue()
+        if kind == PySpin.intfIFloat:
+            return PySpin.CFloatPtr(node).GetValue()
+        if kind == PySpin.intfIBoolean:
+            return PySpin.CBooleanPtr(node).GetValue()
+        return PySpin.CValuePtr(node).ToString()
+
+    @spinnaker_call
+    def SetNodeValue(self, name, value, nodemap='device'):
+        node = self.GetNode(name, nodemap)
+        if node is None or not PySpin.IsAvailable(node) or not PySpin.IsWritable(node):
+            print('Unable to set %s (node retrieval). Aborting...' % name)
+            return False
+
+        kind = node.GetPrincipalInterfaceType()
+        if kind == PySpin.intfIEnumeration:
+            node = PySpin.CEnumerationPtr(node)
+            entry = node.GetEntryByName(value)
+            if not PySpin.IsAvailable(entry) or not PySpin.IsReadable(entry):
+                print('Unable to set %s to %s (enum entry retrieval). Aborting...' % (name, value))
+                return False
+            node.SetIntValue(entry.GetValue())
+        elif kind == PySpin.intfIInteger:
+            # integer nodes only take multiples of their increment within their range
+            node = PySpin.CIntegerPtr(node)
+            minimum, increment = node.GetMin(), max(node.GetInc(), 1)
+            value = minimum + (int(value) - minimum) // increment * increment
+            node.SetValue(min(max(value, minimum), node.GetMax()))
+        elif kind == PySpin.intfIFloat:
+            PySpin.CFloatPtr(node).SetValue(float(value))
+        elif kind == PySpin.intfIBoolean:
+            PySpin.CBooleanPtr(node).SetValue(bool(value))
+        else:
+            PySpin.CValuePtr(node).FromString(str(value))
+        return True
+
+    @spinnaker_call
+    def ExecuteNode(self, name, nodemap='device'):
+        node = PySpin.CCommandPtr(self.GetNode(name, nodemap))
+        if not PySpin.IsAvailable(node) or not PySpin.IsWritable(node):
+            print('Unable to execute %s. Aborting...' % name)
+            return False
+        node.Execute()
+        return True
+
+    @spinnaker_call
+    def ResolveCommand(self, name, nodemap='device'):
+        node = PySpin.CCommandPtr(self.GetNode(name, nodemap))
+        if not PySpin.IsAvailable(node):
+            print('Unable to get %s (node retrieval).' % name)
+            return None
+        return spinnaker_call(node.Execute)
+
+    @spinnaker_call
+    def GetDeviceInfo(self):
+        info = []
+        node_device_information = PySpin.CCategoryPtr(self.cam.GetTLDeviceNodeMap().GetNode('DeviceInformation'))
+        if PySpin.IsAvailable(node_device_information) and PySpin.IsReadable(node_device_information):
+            for feature in node_device_information.GetFeatures():
+                node_feature = PySpin.CValuePtr(feature)
+                info.append((node_feature.GetName(),
+                             node_feature.ToString() if PySpin.IsReadable(node_feature) else 'Node not readable'))
+        return info
+
+
+# Image returned by SpinnakerCamera.GetNextImage, a PySpin image whose calls raise CameraError
+class SpinnakerImage:
+    def __init__(self, image):
+        self.image = image
+
+    @spinnaker_call
+    def GetNDArray(self):
+        return self.image.GetNDArray()
+
+    @spinnaker_call
+    def GetWidth(self):
+        return self.image.GetWidth()
+
+    @spinnaker_call
+    def GetHeight(self):
+        return self.image.GetHeight()
+
+    @spinnaker_call
+    def GetPixelFormatName(self):
+        return self.image.GetPixelFormatName()
+
+    @spinnaker_call
+    def GetFrameID(self):
+        return self.image.GetFrameID()
+
+    @spinnaker_call
+    def GetTimeStamp(self):
+        return self.image.GetTimeStamp()
+
+    @spinnaker_call
+    def GetChunkData(self):
+        return SpinnakerChunkData(self.image.GetChunkData())
+
+    @spinnaker_call
+    def IsIncomplete(self):
+        return self.image.IsIncomplete()
+
+    @spinnaker_call
+    def GetImageStatus(self):
+        return self.image.GetImageStatus()
+
+    @spinnaker_call
+    def Release(self):
+        self.image.Release()
+
+
+class SpinnakerChunkData:
+    def __init__(self, chunk):
+        self.chunk = chunk
+
+    @spinnaker_call
+    def GetFrameID(self):
+        return self.chunk.GetFrameID()
+
+    @spinnaker_call
+    def GetTimestamp(self):
+        return self.chunk.GetTimestamp()
+
+
+class SpinnakerSystem:
+    @spinnaker_call
+    def __init__(self):
+        self.system = PySpin.System.GetInstance()
+        self.cam_list = None
+        self.cameras = []
+
+    def GetLibraryVersion(self):
+        version = self.system.GetLibraryVersion()
+        return LibraryVersion(version.major, version.minor, version.type, version.build)
+
+    @spinnaker_call
+    def GetCameras(self):
+        self.cam_list = self.system.GetCameras()
+        self.cameras = [SpinnakerCamera(cam) for cam in self.cam_list]
+        return list(self.cameras)
+
+    def ReleaseInstance(self):
+        # Every camera reference has to be dropped before the system can be released
+        for camera in self.cameras:
+            camera.cam = None
+        self.cameras = []
+        if self.cam_list is not None:
+            self.cam_list.Clear()
+            self.cam_list = None
+        self.system.ReleaseInstance()
+
+
+# Default settings of the simulated backend, overridden by the 'simulation' section of params.yaml
+SIMULATION_DEFAULTS = {
+    'num_cameras': 2,
+    'width': 1280,            # sensor size, frames are smaller with a region of interest or binning
+    'height': 1024,
+    'bit_depth': 8,
+    'framerate': 30,          # rate of the free running / hardware triggered stream
+    'speckle_size': 3.0,      # speckle grain size in pixels
+    'motion': (0.0, 0.0),     # rigid motion of the pattern in pixels per frame (x, y)
+    'noise': 0.0,             # standard deviation of the additive noise, in grey levels
+    'jitter_us': 0.0,         # standard deviation of the frame arrival time
+    'drop_rate': 0.0,         # probability for a frame to be lost in transfer
+    'incomplete_rate': 0.0,   # probability for a frame to be delivered incomplete
+    'clock_offset_ns': 0,     # device clock offset to the host monotonic clock
+    'clock_drift_ppm': 0.0,   # device clock drift to the host monotonic clock
+    'seed': 0,
+    'trigger_epoch_ns': None, # first hardware trigger pulse, host monotonic ns (None: first camera start)
+    'init_ms': 0.0,           # time Init takes (opening the device and its nodemaps)
+    'node_latency_us': 0.0,   # round trip of a node read, write or command
+    'link_bandwidth_mbps': 0.0, # USB bus shared by the cameras, MB/s (0: transfers take no time)
+    'device_buffer_frames': 4,  # frames the camera holds while they wait for the link
+}
+
+
+# Synthetic speckle pattern, a low pass filtered random field stretched to the given bit depth
+def speckle_pattern(height, width, speckle_size, bit_depth, rng):
+    field = rng.random((height, width))
+    fy = np.fft.fftfreq(height)[:, None]
+    fx = np.fft.rfftfreq(width)[None, :]
+    lowpass = np.exp(-2 * (np.pi * speckle_size / 2) ** 2 * (fx ** 2 + fy ** 2))
+    field = np.fft.irfft2(np.fft.rfft2(field) * lowpass, s=(height, width))
+    field -= field.min()
+    field /= field.max()
+    maxval = 2 ** bit_depth - 1
+    dtype = np.uint8 if bit_depth <= 8 else np.uint16
+    return (maxval * (0.1 + 0.8 * field)).astype(dtype)
+
+
+# Image returned by SimulatedCamera.GetNextImage, mirroring the PySpin image calls we use
+class SimulatedImage:
+    def __init__(self, camera, buffer_index, frame_id, timestamp, incomplete):
+        self.camera = camera
+        self.buffer_index = buffer_index
+        self.frame_id = frame_id
+        self.timestamp = timestamp
+        self.incomplete = incomplete
+        self.data = camera._buffers[buffer_index]
+
+    def GetNDArray(self):
+        return self.data
+
+    def GetData(self):
+        return self.data.reshape(-1)
+
+    def GetWidth(self):
+        return self.data.shape[1]
+
+    def GetHeight(self):
+        return self.data.shape[0]
+
+    def GetBufferSize(self):
+        return self.data.nbytes
+
+    def GetPixelFormatName(self):
+        return self.camera.nodes['PixelFormat']
+
+    def GetFrameID(self):
+        return self.frame_id
+
+    def GetTimeStamp(self):
+        return self.timestamp
+
+    def GetChunkData(self):
+        return SimulatedChunkData(self.camera, self.frame_id, self.timestamp)
+
+    def IsIncomplete(self):
+        return self.incomplete
+
+    def GetImageStatus(self):
+        return 1 if self.incomplete else 0
+
+    def ConvertToBGR8(self):
+        data = self.data
+        if data.dtype != np.uint8:
+            data = (data >> (8 * data.itemsize - 8)).astype(np.uint8)
+        return np.repeat(data[:, :, None], 3, axis=2)
+
+    def Release(self):
+        if self.buffer_index is not None:
+            self.camera._release_buffer(self.buffer_index)
+            self.buffer_index = None
+
+
+# Chunk data appended to a frame when ChunkModeActive is on, with the chunks enabled
+# through ChunkSelector / ChunkEnable
+class SimulatedChunkData:
+    def __init__(self, camera, frame_id, timestamp):
+        self.enabled = camera.chunk_enabled if camera.nodes['ChunkModeActive'] else {}
+        self.frame_id = frame_id
+        self.timestamp = timestamp
+
+    def _check(self, chunk):
+        if not self.enabled.get(chunk):
+            raise CameraError('Chunk %s is not enabled' % chunk)
+
+    def GetFrameID(self):
+        self._check('FrameID')
+        return self.frame_id
+
+    def GetTimestamp(self):
+        self._check('Timestamp')
+        return self.timestamp
+
+
+# Camera producing speckle frames at a configured resolution, frame rate and bit depth,
+# with injectable jitter, incomplete frames and dropped frames.
+# Software triggered frames are ready one exposure time after TriggerSoftware. In free
+# running or hardware triggered mode frames arrive at the simulated frame rate; frames
+# the consumer is too slow for are lost once all the stream buffers are full.
+class SimulatedCamera(Camera):
+    def __init__(self, serial, settings=None, index=0, trigger_line=None):
+        self.settings = dict(SIMULATION_DEFAULTS)
+        self.settings.update(settings or {})
+        s = self.settings
+        # trigger pulses shared by the cameras of the system in hardware triggered mode
+        self.trigger_line = trigger_line
+        # timing and noise differ between cameras, the speckle pattern (the specimen) is shared
+        self.rng = np.random.default_rng([int(s['seed']), index])
+        self.nodes = {
+            # device nodemap
+            'TriggerMode': 'Off',
+            'TriggerSource': 'Software',
+            'TriggerOverlap': 'Off',
+            'AcquisitionMode': 'Continuous',
+            'ExposureAuto': 'Continuous',
+            'ExposureTime': 10000.0,
+            'GainAuto': 'Continuous',
+            'Gain': 0.0,
+            'SensorWidth': int(s['width']),
+            'SensorHeight': int(s['height']),
+            'WidthMax': int(s['width']),
+            'HeightMax': int(s['height']),
+            'BinningHorizontal': 1,
+            'BinningVertical': 1,
+            'DecimationHorizontal': 1,
+            'DecimationVertical': 1,
+            'Width': int(s['width']),
+            'Height': int(s['height']),
+            'OffsetX': 0,
+            'OffsetY': 0,
+            'PixelFormat': 'Mono8' if s['bit_depth'] <= 8 else 'Mono16',
+            'ChunkModeActive': False,
+            'ChunkSelector': 'FrameID',
+            'ChunkEnable': False,
+            'DeviceLinkThroughputLimit': 380000000,
+            'UserSetSelector': 'Default',
+            'UserSetDefault': 'Default',
+            # TL device nodemap
+            'DeviceSerialNumber': str(serial),
+            'DeviceVendorName': 'DIC-Cameras',
+            'DeviceModelName': 'Simulated speckle camera',
+            'DeviceVersion': '1.0',
+            # TL stream nodemap
+            'StreamBufferHandlingMode': 'OldestFirst',
+            'StreamBufferCountMode': 'Auto',
+            'StreamBufferCountManual': 10,
+        }
+        self.node_nodemaps = dict.fromkeys(self.nodes, 'device')
+        for name in ('DeviceSerialNumber', 'DeviceVendorName', 'DeviceModelName', 'DeviceVersion'):
+            self.node_nodemaps[name] = 'tldevice'
+        for name in ('StreamBufferHandlingMode', 'StreamBufferCountMode', 'StreamBufferCountManual'):
+            self.node_nodemaps[name] = 'stream'
+        self.enum_entries = {
+            'TriggerMode': ('Off', 'On'),
+            'TriggerSource': ('Software', 'Line0', 'Line1', 'Line2', 'Line3'),
+            'TriggerOverlap': ('Off', 'ReadOut'),
+            'AcquisitionMode': ('Continuous', 'SingleFrame', 'MultiFrame'),
+            'ExposureAuto': ('Off', 'Once', 'Continuous'),
+            'GainAuto': ('Off', 'Once', 'Continuous'),
+            'PixelFormat': ('Mono8', 'Mono16'),
+            'ChunkSelector': ('FrameID', 'Timestamp', 'ExposureTime', 'Gain'),
+            'StreamBufferHandlingMode': ('OldestFirst', 'OldestFirstOverwrite', 'NewestOnly', 'NewestFirst'),
+            'StreamBufferCountMode': ('Auto', 'Manual'),
+            'UserSetSelector': ('Default', 'UserSet0', 'UserSet1'),
+            'UserSetDefault': ('Default', 'UserSet0', 'UserSet1'),
+        }
+        # numeric nodes clamped to their range like the Spinnaker integer nodes, the geometry
+        # nodes to the range left by the others (see _node_range)
+        self.node_ranges = {'DeviceLinkThroughputLimit': (10000000, 380000000), 'StreamBufferCountManual': (1, 1000),
+                            'BinningHorizontal': (1, 4), 'BinningVertical': (1, 4),
+                            'DecimationHorizontal': (1, 4), 'DecimationVertical': (1, 4)}
+        # increments of the geometry nodes, written values are rounded down to them
+        self.node_increments = {'Width': 16, 'Height': 2, 'OffsetX': 4, 'OffsetY': 2}
+        self.read_only = {'DeviceSerialNumber', 'DeviceVendorName', 'DeviceModelName', 'DeviceVersion',
+                          'SensorWidth', 'SensorHeight', 'WidthMax', 'HeightMax'}
+        # nodes locked while streaming, like on the real sensor
+        self.stream_locked = {'Width', 'Height', 'OffsetX', 'OffsetY', 'BinningHorizontal', 'BinningVertical',
+                              'DecimationHorizontal', 'DecimationVertical', 'PixelFormat',
+                              'StreamBufferHandlingMode', 'StreamBufferCountMode', 'StreamBufferCountManual',
+                              'ChunkModeActive', 'DeviceLinkThroughputLimit'}
+        # ChunkEnable value of every ChunkSelector entry
+        self.chunk_enabled = {}
+        # device nodemap settings saved by UserSetSave, Default holds the factory settings
+        self.user_sets = {'Default': self._user_set()}
+
+        self.initialized = False
+        self.streaming = False
+        self.pattern = None
+        self.lost_frames = 0
+        # SimulatedLink of the system, None: frames take no time to transfer
+        self.link = None
+        self.link_free = 0
+        self.link_delay = 0
+        self.cond = threading.Condition()
+        self._triggers = deque()
+        self._buffers = []
+        self._free_buffers = deque()
+
+    def Init(self):
+        if self.settings['init_ms']:
+            time.sleep(self.settings['init_ms'] / 1000)
+        self.initialized = True
+
+    def DeInit(self):
+        if self.streaming:
+            self.EndAcquisition()
+        self.initialized = False
+
+    def _check_initialized(self):
+        if not self.initialized:
+            raise CameraError('Camera %s is not initialized' % self.nodes['DeviceSerialNumber'])
+
+    def IsStreaming(self):
+        return self.streaming
+
+    def _buffer_count(self):
+        if self.nodes['StreamBufferCountMode'] == 'Manual':
+            return max(1, int(self.nodes['StreamBufferCountManual']))
+        return 10
+
+    def _bit_depth(self):
+        if self.nodes['PixelFormat'] == 'Mono8':
+            return 8
+        return max(9, int(self.settings['bit_depth']))
+
+    def BeginAcquisition(self):
+        self._check_initialized()
+        if self.streaming:
+            raise CameraError('Camera is already streaming')
+        s = self.settings
+        height, width = self.nodes['Height'], self.nodes['Width']
+        dtype = self._prepare_source(height, width)
+        self._buffers = [np.empty((height, width), dtype=dtype) for _ in range(self._buffer_count())]
+        self._free_buffers = deque(range(len(self._buffers)))
+        self._triggers.clear()
+        self.period_ns = int(1e9 / s['framerate'])
+        self.frame_index = 0
+        # origin of the device clock, and exposure start of the first frame: the next pulse
+        # of the shared trigger line when hardware triggered, else now (free running)
+        self.host_epoch = time.monotonic_ns()
+        self.frame_epoch = self.host_epoch
+        if self.trigger_line is not None and self._hardware_triggered():
+            self.frame_epoch = self.trigger_line.next_pulse(self.host_epoch, self.period_ns)
+        self.link_free = 0
+        self.link_delay = 0
+        if self.link is not None:
+            self.link.join(self)
+        self.streaming = True
+
+    # Build the frame source for the given geometry, returns the pixel dtype
+    def _prepare_source(self, height, width):
+        s = self.settings
+        # the pattern covers the whole sensor, and is larger so that the simulated motion can
+        # slide over it
+        mx, my = s['motion']
+        margin = int(np.ceil(max(abs(mx), abs(my)) * 64)) + 1
+        self.margin = margin
+        self.pattern = speckle_pattern(self.nodes['SensorHeight'] + 2 * margin, self.nodes['SensorWidth'] + 2 * margin,
+                                       s['speckle_size'], self._bit_depth(), np.random.default_rng(int(s['seed'])))
+        return self.pattern.dtype
+
+    # Fill a stream buffer with frame number index: the region of interest of the sensor,
+    # decimated (rows and columns skipped) then binned (neighbours averaged)
+    def _render(self, data, index):
+        n = self.nodes
+        mx, my = self.settings['motion']
+        bx, by = n['BinningHorizontal'], n['BinningVertical']
+        sx, sy = bx * n['DecimationHorizontal'], by * n['DecimationVertical']
+        ox = int(round(mx * index)) % (2 * self.margin) + n['OffsetX'] * sx
+        oy = int(round(my * index)) % (2 * self.margin) + n['OffsetY'] * sy
+        height, width = data.shape
+        window = self.pattern[oy:oy + height * sy, ox:ox + width * sx]
+        if sx == 1 and sy == 1:
+            np.copyto(data, window)
+            return
+        window = window[::sy // by, ::sx // bx]
+        if bx * by > 1:
+            window = window.reshape(height, by, width, bx).mean(axis=(1, 3))
+        np.copyto(data, window, casting='unsafe')
+
+    # Range of a numeric node, (minimum, maximum) or None. The region of interest stays on
+    # the sensor: Width and OffsetX share WidthMax, the sensor width after binning and decimation.
+    def _node_range(self, name):
+        n = self.nodes
+        if name == 'Width':
+            return self.node_increments['Width'], n['WidthMax'] - n['OffsetX']
+        if name == 'Height':
+            return self.node_increments['Height'], n['HeightMax'] - n['OffsetY']
+        if name == 'OffsetX':
+            return 0, n['WidthMax'] - n['Width']
+        if name == 'OffsetY':
+            return 0, n['HeightMax'] - n['Height']
+        return self.node_ranges.get(name)
+
+    # Binning and decimation changed: the maximum geometry follows, and the region of
+    # interest shrinks to fit, like on the real sensor
+    def _update_geometry(self):
+        n = self.nodes
+        n['WidthMax'] = n['SensorWidth'] // (n['BinningHorizontal'] * n['DecimationHorizontal'])
+        n['HeightMax'] = n['SensorHeight'] // (n['BinningVertical'] * n['DecimationVertical'])
+        for size, offset, maximum in (('Width', 'OffsetX', 'WidthMax'), ('Height', 'OffsetY', 'HeightMax')):
+            step = self.node_increments[size]
+            n[size] = min(n[size], n[maximum] // step * step)
+            n[offset] = min(n[offset], n[maximum] - n[size])
+
+    def EndAcquisition(self):
+        if not self.streaming:
+            raise CameraError('Camera is not streaming')
+        with self.cond:
+            self.streaming = False
+            self.cond.notify_all()
+        if self.link is not None:
+            self.link.leave(self)
+
+    # Device clock reading at the given host monotonic time
+    def device_time(self, host_ns):
+        s = self.settings
+        return int((host_ns - self.host_epoch) * (1 + s['clock_drift_ppm'] * 1e-6)) + int(s['clock_offset_ns'])
+
+    def TriggerSoftware(self):
+        try:
+            self._trigger_software()
+        except CameraError:
+            print('Unable to execute TriggerSoftware. Aborting...')
+            return False
+        return True
+
+    # Raises like the Spinnaker command node when the camera is not software triggered
+    def _trigger_software(self):
+        self._check_initialized()
+        if not self._software_triggered():
+            raise CameraError('TriggerSoftware is not writable, the camera is not software triggered')
+        with self.cond:
+            self._triggers.append(time.monotonic_ns())
+            self.cond.notify_all()
+
+    def ResolveCommand(self, name, nodemap='device'):
+        if name == 'TriggerSoftware' and nodemap == 'device':
+            return self._trigger_software
+        print('Unable to get %s (node retrieval).' % name)
+        return None
+
+    def _software_triggered(self):
+        return self.nodes['TriggerMode'] == 'On' and self.nodes['TriggerSource'] == 'Software'
+
+    def _hardware_triggered(self):
+        return self.nodes['TriggerMode'] == 'On' and self.nodes['TriggerSource'] != 'Software'
+
+    def _wait_until(self, deadline_ns):
+        delay = deadline_ns - time.monotonic_ns()
+        if delay > 0:
+            time.sleep(delay / 1e9)
+
+    def GetNextImage(self, timeout_ms=None):
+        if not self.streaming:
+            raise CameraError('Camera is not streaming')
+        start = time.monotonic_ns()
+        deadline = None if timeout_ms is None else start + int(timeout_ms * 1e6)
+        s = self.settings
+
+        while True:
+            if self._software_triggered():
+                with self.cond:
+                    while not self._triggers and self.streaming:
+                        remaining = None if deadline is None else (deadline - time.monotonic_ns()) / 1e9
+                        if remaining is not None and remaining <= 0:
+                            raise CameraError('Failed waiting for EventData on NEW_BUFFER_DATA event')
+                        self.cond.wait(remaining)
+                    if not self.streaming:
+                        raise CameraError('Acquisition stopped')
+                    trigger = self._triggers.popleft()
+                arrival = trigger + int(self.nodes['ExposureTime'] * 1000)
+                exposure_start = trigger
+                index = self.frame_index
+                self.frame_index += 1
+            else:
+                index = self.frame_index
+                now = time.monotonic_ns()
+                # frames still on their way over the link are not in the buffers yet
+                latest = (now - self.frame_epoch - self.link_delay) // self.period_ns
+                # frames that arrived while every buffer was in use are lost
+                backlog = latest - index + 1
+                if backlog > len(self._buffers):
+                    if self.nodes['StreamBufferHandlingMode'] in ('NewestOnly', 'NewestFirst'):
+                        skipped = backlog - 1
+                    else:
+                        skipped = backlog - len(self._buffers)
+                    self.lost_frames += skipped
+                    index += skipped
+                self.frame_index = index + 1
+                exposure_start = self.frame_epoch + index * self.period_ns
+                jitter = int(self.rng.normal(0, s['jitter_us'] * 1000)) if s['jitter_us'] else 0
+                arrival = exposure_start + int(self.nodes['ExposureTime'] * 1000) + abs(jitter)
+
+            if self.link is not None:
+                arrival = self._transfer(arrival)
+                if arrival is None:
+                    self.lost_frames += 1
+                    continue
+                self.link_delay = arrival - exposure_start
+
+            if deadline is not None and arrival > deadline:
+                self._wait_until(deadline)
+                raise CameraError('Failed waiting for EventData on NEW_BUFFER_DATA event')
+            self._wait_until(arrival)
+
+            if s['drop_rate'] and self.rng.random() < s['drop_rate']:
+                self.lost_frames += 1
+                continue
+            break
+
+        buffer_index = self._take_buffer(deadline)
+        data = self._buffers[buffer_index]
+        self._render(data, index)
+        if s['noise']:
+            noisy = data + self.rng.normal(0, s['noise'], data.shape)
+            np.copyto(data, np.clip(noisy, 0, np.iinfo(data.dtype).max), casting='unsafe')
+
+        incomplete_rate = s['incomplete_rate'] + (self.link.packet_loss() if self.link is not None else 0.0)
+        incomplete = bool(incomplete_rate) and self.rng.random() < incomplete_rate
+        if incomplete:
+            data[self.rng.integers(data.shape[0]):] = 0
+        return SimulatedImage(self, buffer_index, index, self.device_time(exposure_start), incomplete)
+
+    # Arrival time of a frame read out at ready (host ns) over the link, frames going one at a
+    # time at the throughput the camera gets. None when the frame waited for the link longer
+    # than the camera can hold frames (device_buffer_frames frame periods), it is lost.
+    def _transfer(self, ready):
+        start = max(ready, self.link_free)
+        period = self.period_ns if not self._software_triggered() else 0
+        if period and start - ready > self.settings['device_buffer_frames'] * period:
+            return None
+        nbytes = self._buffers[0].nbytes if self._buffers else 0
+        self.link_free = start + int(nbytes * 1e9 / self.link.throughput(self))
+        return self.link_free
+
+    def _take_buffer(self, deadline):
+        with self.cond:
+            while not self._free_buffers:
+                remaining = None if deadline is None else (deadline - time.monotonic_ns()) / 1e9
+                if remaining is not None and remaining <= 0:
+                    raise CameraError('No free stream buffer, release the images you hold')
+                self.cond.wait(remaining)
+            return self._free_buffers.popleft()
+
+    def _release_buffer(self, buffer_index):
+        with self.cond:
+            self._free_buffers.append(buffer_index)
+            self.cond.notify_all()
+
+    def _node_access(self):
+        if self.settings['node_latency_us']:
+            time.sleep(self.settings['node_latency_us'] / 1e6)
+
+    # Settings of the device nodemap a user set holds
+    def _user_set(self):
+        nodes = {name: value for name, value in self.nodes.items() if self.node_nodemaps[name] == 'device'
+                 and name not in self.read_only and not name.startswith('UserSet')}
+        return nodes, dict(self.chunk_enabled)
+
+    def GetNodeValue(self, name, nodemap='device'):
+        self._node_access()
+        if name not in self.nodes or self.node_nodemaps[name] != nodemap:
+            raise CameraError('Node %s is not readable' % name)
+        if name == 'ChunkEnable':
+            return self.chunk_enabled.get(self.nodes['ChunkSelector'], False)
+        return self.nodes[name]
+
+    def SetNodeValue(self, name, value, nodemap='device'):
+        self._node_access()
+        if name not in self.nodes or self.node_nodemaps[name] != nodemap or name in self.read_only \
+                or (self.streaming and name in self.stream_locked):
+            print('Unable to set %s (node retrieval). Aborting...' % name)
+            return False
+        entries = self.enum_entries.get(name)
+        if entries is not None and value not in entries:
+            print('Unable to set %s to %s (enum entry retrieval). Aborting...' % (name, value))
+            return False
+        if isinstance(self.nodes[name], bool):
+            value = value in (True, 1, 'True', 'true', '1')
+        elif entries is None:
+            value = type(self.nodes[name])(value)
+        if name in self.node_increments:
+            value = value // self.node_increments[name] * self.node_increments[name]
+        limits = self._node_range(name)
+        if limits is not None:
+            minimum, maximum = limits
+            value = min(max(value, minimum), maximum)
+        if name == 'ChunkEnable':
+            self.chunk_enabled[self.nodes['ChunkSelector']] = value
+        self.nodes[name] = value
+        if name.startswith('Binning') or name.startswith('Decimation'):
+            self._update_geometry()
+        return True
+
+    def ExecuteNode(self, name, nodemap='device'):
+        if name == 'TriggerSoftware' and nodemap == 'device':
+            return self.TriggerSoftware()
+        self._node_access()
+        selected = self.nodes['UserSetSelector']
+        if name == 'UserSetSave' and nodemap == 'device' and selected != 'Default' and not self.streaming:
+            self.user_sets[selected] = self._user_set()
+            return True
+        if name == 'UserSetLoad' and nodemap == 'device' and selected in self.user_sets and not self.streaming:
+            nodes, chunk_enabled = self.user_sets[selected]
+            self.nodes.update(nodes)
+            self.chunk_enabled = dict(chunk_enabled)
+            self._update_geometry()
+            return True
+        print('Unable to execute %s. Aborting...' % name)
+        return False
+
+
+# Camera replaying recorded frames (a (n, height, width) array) with the timing model
+# of SimulatedCamera, looping over the recording
+class RecordedCamera(SimulatedCamera):
+    def __init__(self, serial, frames, settings=None, index=0, trigger_line=None):
+        SimulatedCamera.__init__(self, serial, settings, index, trigger_line)
+        self.recording = frames
+        self.nodes['Height'], self.nodes['Width'] = frames.shape[1:3]
+        self.nodes['SensorHeight'], self.nodes['SensorWidth'] = frames.shape[1:3]
+        self.nodes['HeightMax'], self.nodes['WidthMax'] = frames.shape[1:3]
+        self.nodes['PixelFormat'] = 'Mono8' if frames.dtype == np.uint8 else 'Mono16'
+        # the recording is replayed as it is, its geometry is fixed
+        self.read_only |= {'Width', 'Height', 'OffsetX', 'OffsetY', 'BinningHorizontal', 'BinningVertical',
+                           'DecimationHorizontal', 'DecimationVertical', 'PixelFormat'}
+
+    def _prepare_source(self, height, width):
+        return self.recording.dtype
+
+    def _render(self, data, index):
+        np.copyto(data, self.recording[index % len(self.recording)])
+
+
+# Frames of each camera of an acquisition directory written by ThreadCapture ('NNNN_k.tif').
+# The first camera writes the '_1' files and the second the '_0' files, the others their
+# camera number (see FrameStore.tiff_suffix), cameras are returned in that order.
+def load_recording(path, max_frames=None):
+    import re
+    import cv2
+    files = {}
+    for name in os.listdir(path):
+        match = re.match(r'^(\d+)_(\d+)\.tiff?$', name)
+        if match:
+            files.setdefault(int(match.group(2)), []).append((int(match.group(1)), name))
+
+    recordings = []
+    for suffix in sorted(files, key=lambda suffix: 1 - suffix if suffix < 2 else suffix):
+        names = [name for _, name in sorted(files[suffix])][:max_frames]
+        frames = []
+        for name in names:
+            frame = cv2.imread(os.path.join(path, name), cv2.IMREAD_UNCHANGED)
+            if frame.ndim == 3:
+                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            frames.append(frame)
+        recordings.append(np.stack(frames))
+    return recordings
+
+
+# Hardware trigger signal wired to all the simulated cameras: a pulse train at the simulated
+# frame rate, starting when the first camera begins acquiring, or at epoch (host monotonic ns)
+# when given, so cameras simulated in different processes see the same pulses
+class SimulatedTriggerLine:
+    def __init__(self, epoch=None):
+        self.lock = threading.Lock()
+        self.epoch = epoch
+
+    # Time of the first pulse at or after host_ns
+    def next_pulse(self, host_ns, period_ns):
+        with self.lock:
+            if self.epoch is None:
+                self.epoch = host_ns
+        return self.epoch + -(-(host_ns - self.epoch) // period_ns) * period_ns
+
+
+# USB bus shared by the simulated cameras of a system, bandwidth in bytes per second.
+# A camera sends at most at its DeviceLinkThroughputLimit. When the limits of the streaming
+# cameras add up to more than the bus, the bandwidth is shared in proportion and packets
+# collide: frames are delivered incomplete with the probability of the excess.
+# Cameras simulated in other processes (processes mode) each get a bus of their own.
+class SimulatedLink:
+    def __init__(self, bandwidth):
+        self.bandwidth = float(bandwidth)
+        self.lock = threading.Lock()
+        self.cameras = []
+
+    def join(self, camera):
+        with self.lock:
+            if camera not in self.cameras:
+                self.cameras.append(camera)
+
+    def leave(self, camera):
+        with self.lock:
+            if camera in self.cameras:
+                self.cameras.remove(camera)
+
+    def _demand(self):
+        return sum(float(camera.nodes['DeviceLinkThroughputLimit']) for camera in self.cameras)
+
+    # bytes per second camera gets
+    def throughput(self, camera):
+        limit = max(float(camera.nodes['DeviceLinkThroughputLimit']), 1.0)
+        with self.lock:
+            demand = self._demand()
+        if demand > self.bandwidth:
+            return limit * self.bandwidth / demand
+        return limit
+
+    def packet_loss(self):
+        with self.lock:
+            demand = self._demand()
+        return max(0.0, 1.0 - self.bandwidth / demand) if demand else 0.0
+
+
+class SimulatedSystem:
+    def __init__(self, settings=None):
+        self.settings = dict(SIMULATION_DEFAULTS)
+        self.settings.update(settings or {})
+        self.trigger_line = SimulatedTriggerLine(self.settings['trigger_epoch_ns'])
+        bandwidth = self.settings['link_bandwidth_mbps']
+        self.link = SimulatedLink(bandwidth * 1e6) if bandwidth else None
+
+    def _connect(self, cameras):
+        for camera in cameras:
+            camera.link = self.link
+        return cameras
+
+    def GetLibraryVersion(self):
+        return LibraryVersion(0, 0, 0, 0)
+
+    def GetCameras(self):
+        return self._connect([SimulatedCamera('SIM%05d' % i, self.settings, i, self.trigger_line)
+                              for i in range(int(self.settings['num_cameras']))])
+
+    def ReleaseInstance(self):
+        pass
+
+
+# Replays a recorded acquisition, settings['recording_path'] is the acquisition directory
+class RecordedSystem(SimulatedSystem):
+    def GetCameras(self):
+        recordings = load_recording(self.settings['recording_path'], self.settings.get('max_frames'))
+        return self._connect([RecordedCamera('REC%05d' % i, frames, self.settings, i, self.trigger_line)
+                              for i, frames in enumerate(recordings)])
+
+
+# True for the error GetNextImage raises when no frame arrived within its timeout
+# (SPINNAKER_ERR_TIMEOUT, the simulated cameras raise the same message)
+def is_grab_timeout(ex):
+    return getattr(ex, 'errorcode', None) == -1011 or 'EventData' in str(ex)
+
+
+# Frame ID and device timestamp of an image. With chunk mode on they come from the chunk data
+# the camera appends to the frame (timestamp latched at exposure start), otherwise from the
+# transport layer buffer.
+def chunk_frame_info(image):
+    chunk = image.GetChunkData()
+    return chunk.GetFrameID(), chunk.GetTimestamp()
+
+
+def buffer_frame_info(image):
+    return image.GetFrameID(), image.GetTimeStamp()
+
+
+# Per camera handles resolved once at configure time and shared by all the capture and
+# display paths: serial number, frame geometry, pixel format, the software trigger command
+# and the frame ID / timestamp reader.
+# The per-frame loops use these instead of looking the nodes up again for every frame.
+class CameraHandles:
+    def __init__(self, cam):
+        self.cam = cam
+        self.serial = cam.GetSerial()
+        self.width = cam.GetNodeValue('Width')
+        self.height = cam.GetNodeValue('Height')
+        self.pixel_format = cam.GetNodeValue('PixelFormat')
+        self.trigger_software = cam.ResolveCommand('TriggerSoftware')
+        try:
+            chunk_mode = cam.GetNodeValue('ChunkModeActive')
+        except CAMERA_ERRORS:
+            chunk_mode = False
+        self.frame_info = chunk_frame_info if chunk_mode else buffer_frame_info
+
+
+# Camera system of the configured backend, 'spinnaker', 'simulated' or 'recorded'
+def get_system(backend='spinnaker', settings=None):
+    if backend == 'simulated':
+        return SimulatedSystem(settings)
+    if backend == 'recorded':
+        return RecordedSystem(settings)
+    if backend == 'spinnaker':
+        if load_pyspin() is None:
+            raise ImportError('PySpin is not installed, install the Spinnaker SDK or use camera_backend: simulated')
+        return SpinnakerSystem()
+    raise ValueError('Unknown camera backend %r, expected spinnaker, simulated or recorded' % backend)
+
+
+# Debayered BGR8 copy of an image, for display
+def convert_to_bgr8(image):
+    if isinstance(image, SimulatedImage):
+        return image.ConvertToBGR8()
+    image_converted = image.image.Convert(PySpin.PixelFormat_BGR8, PySpin.DIRECTIONAL_FILTER)
+    bgr = np.frombuffer(image_converted.GetData(), dtype=np.uint8)
+    return bgr.reshape((image.GetHeight(), image.GetWidth(), 3))
+
+
+# Write a frame to a TIFF file. With Spinnaker the frame is wrapped in a Spinnaker
+# image so the file is identical to what Image.Save produces from the driver buffer.
+def save_tiff(frame, pixel_format, out):
+    if load_pyspin() is not None:
+        height, width = frame.shape[:2]
+        image = PySpin.Image.Create(width, height, 0, 0, getattr(PySpin, 'PixelFormat_' + pixel_format), frame)
+        image.Save(out)
+    else:
+        import cv2
+        cv2.imwrite(out, frame)
@@ -0,0 +1,165 @@
+import json
+import math
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from CameraBackend import CAMERA_ERRORS
+
+# Camera bring-up: the node settings of a run are applied as a diff, and the cameras are
+# initialized and configured concurrently.
+# Each node access is a round trip to the camera over USB, so configuring node by node,
+# one camera after the other, takes longer with every camera. configure_nodes reads the
+# nodes of the settings (reads are served from the node cache of the driver once the
+# camera is open) and only writes the ones whose value differs, which after the first
+# run is usually none. bring_up runs the bring-up of all the cameras at once in threads.
+#
+# CameraSnapshots keeps, per camera serial number, the node values after the last
+# configuration in camera_cache (a json file next to params.yaml). With camera_user_set
+# (UserSet0 or UserSet1), a configuration that wrote nodes is also saved into that user set
+# of the camera, made its power-up default: the camera then comes up configured, and when
+# the snapshot shows the user set holds the settings of the run it is loaded with one
+# command before the diff, restoring nodes changed by another tool.
+
+# Settings entries are (node, value, nodemap). Node 'Name[Entry]' is the node Name with its
+# selector at Entry, e.g. 'ChunkEnable[Timestamp]'.
+SELECTORS = {'ChunkEnable': 'ChunkSelector'}
+# Node written first, with the value it needs, before a node only writable in that state
+# (a region of interest only grows up to the sensor edge from its offset)
+WRITE_PREREQUISITES = {'TriggerSource': ('TriggerMode', 'Off'), 'Width': ('OffsetX', 0), 'Height': ('OffsetY', 0)}
+USER_SETS = ('UserSet0', 'UserSet1')
+
+
+# Values compare equal when the camera rounded the written one to its resolution
+def same_value(current, value):
+    if isinstance(current, bool) or isinstance(value, bool):
+        return current == value
+    if isinstance(current, (int, float)) and isinstance(value, (int, float)):
+        return math.isclose(current, value, rel_tol=1e-3, abs_tol=1e-6)
+    return str(current) == str(value)
+
+
+def _select(cam, node, nodemap):
+    name, _, entry = node.partition('[')
+    if entry and not cam.SetNodeValue(SELECTORS[name], entry[:-1], nodemap):
+        raise LookupError(node)
+    return name
+
+
+def read_node(cam, node, nodemap='device'):
+    try:
+        return cam.GetNodeValue(_select(cam, node, nodemap), nodemap)
+    except CAMERA_ERRORS + (LookupError,):
+        return None
+
+
+def write_node(cam, node, value, nodemap='device'):
+    try:
+        return cam.SetNodeValue(_select(cam, node, nodemap), value, nodemap)
+    except LookupError:
+        return False
+
+
+class CameraSnapshots:
+    # path: json file of the snapshots, None to keep them for this run only
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.snapshots = {}
+        if path and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.snapshots = json.load(f)
+            except ValueError:
+                print('Camera cache %s is not readable, starting a new one' % path)
+        self.writes = 0
+        self.skipped = 0
+        self.user_set_loads = 0
+
+    def get(self, serial):
+        with self.lock:
+            return self.snapshots.get(serial)
+
+    def put(self, serial, snapshot, writes, skipped, loaded):
+        with self.lock:
+            self.snapshots[serial] = snapshot
+            self.writes += writes
+            self.skipped += skipped
+            self.user_set_loads += loaded
+
+    def save(self):
+        if self.path:
+            with self.lock:
+                with open(self.path, 'w') as f:
+                    json.dump(self.snapshots, f, indent=2)
+
+    def print_stats(self, num_cameras, seconds):
+        print('%d cameras ready in %.2f s: %d nodes written, %d already set, %d user sets loaded'
+              % (num_cameras, seconds, self.writes, self.skipped, self.user_set_loads))
+
+
+# True when the snapshot shows user_set holds settings
+def holds_settings(snapshot, settings, user_set):
+    if not snapshot or not user_set or snapshot.get('user_set') != user_set:
+        return False
+    values = snapshot.get('nodes', {})
+    return all(node in values and same_value(values[node], value) for node, value, nodemap in settings)
+
+
+# Apply settings to an initialized camera, writing only the nodes that differ.
+# Returns False when a node could not be written.
+def configure_nodes(cam, settings, snapshots=None, user_set=''):
+    snapshots = snapshots if snapshots is not None else CameraSnapshots()
+    serial = cam.GetSerial()
+    snapshot = snapshots.get(serial)
+    loaded = 0
+    if holds_settings(snapshot, settings, user_set):
+        if cam.SetNodeValue('UserSetSelector', user_set) and cam.ExecuteNode('UserSetLoad'):
+            loaded = 1
+
+    current = {}
+    writes = 0
+    skipped = 0
+    for node, value, nodemap in settings:
+        if node not in current:
+            current[node] = read_node(cam, node, nodemap)
+        if current[node] is not None and same_value(current[node], value):
+            skipped += 1
+            continue
+        prerequisite = WRITE_PREREQUISITES.get(node)
+        if prerequisite is not None:
+            name, state = prerequisite
+            if current.get(name) != state:
+                if not write_node(cam, name, state):
+                    return False
+                current[name] = state
+                writes += 1
+        if not write_node(cam, node, value, nodemap):
+            return False
+        current[node] = value
+        writes += 1
+
+    # user set holding the settings: unchanged when nothing was written, saved again when
+    # the settings changed or the configured one does not hold them yet
+    saved = snapshot.get('user_set', '') if snapshot else ''
+    if writes or not holds_settings(snapshot, settings, saved):
+        saved = ''
+    if user_set in USER_SETS and (writes or not holds_settings(snapshot, settings, user_set)):
+        # the device nodemap settings come back at power-up
+        if cam.SetNodeValue('UserSetSelector', user_set) and cam.ExecuteNode('UserSetSave'):
+            cam.SetNodeValue('UserSetDefault', user_set)
+            saved = user_set
+    snapshots.put(serial, {'nodes': {node: current[node] for node, value, nodemap in settings}, 'user_set': saved},
+                  writes, skipped, loaded)
+    return True
+
+
+# Run setup(cam) for every camera at once, with workers threads (0: one per camera).
+# Returns the results in camera order.
+def bring_up(cam_list, setup, workers=0):
+    if not cam_list:
+        return []
+    workers = workers or len(cam_list)
+    if workers == 1:
+        return [setup(cam) for cam in cam_list]
+    with ThreadPoolExecutor(workers, thread_name_prefix='bring-up') as executor:
+        return list(executor.map(setup, cam_list))
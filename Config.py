@@ -0,0 +1,222 @@
+import os
+import threading
+from DICEngine import DIC_DEFAULTS
+from FrameCodec import SHUFFLES
+from FrameStore import STORE_FORMATS
+from FrameSync import SYNC_MODES
+from WriterPool import FULL_POLICIES
+
+# Configuration of the acquisition, read from params.yaml next to the scripts.
+# Every key is declared in CONFIG_FIELDS with its default and its kind and checked when the
+# file is loaded, so a wrong value stops the start-up with the key named instead of failing
+# in the middle of a run. get_config() gives the configuration of the process, loaded on its
+# first call: importing a module reads, creates and changes nothing, and the capture
+# processes and command line tools only load what they use. enter_image_folder() creates
+# the image folder and moves into it when a run starts.
+#   config = get_config()
+#   config.num_images, config.filename, config.im_savepath ...
+# Kinds: int, float (int accepted), bool, str, dict, list, RATE (a frame rate in fps or
+# 'hardware'), or the tuple of the values allowed.
+
+CONFIG_DIR = os.path.dirname(os.path.abspath(__file__))
+CONFIG_PATH = os.path.join(CONFIG_DIR, 'params.yaml')
+
+RATE = 'rate'
+REQUIRED = object()
+KIND_NAMES = {int: 'an integer', float: 'a number', bool: 'true or false', str: 'a string', dict: 'a mapping',
+              list: 'a list', RATE: "a frame rate or 'hardware'"}
+
+# threads: one capture thread per camera in this process,
+# processes: one process per camera (see ProcessCapture.py),
+# async: cameras driven by an asyncio controller taking commands (see AsyncController.py)
+ACQUISITION_MODES = ('threads', 'processes', 'async')
+CAMERA_BACKENDS = ('spinnaker', 'simulated', 'recorded')
+ARDUINO_BACKENDS = ('firmata', 'simulated')
+STREAM_BUFFER_MODES = ('OldestFirst', 'OldestFirstOverwrite', 'NewestOnly', 'NewestFirst')
+COMPRESSIONS = ('none', 'lz4', 'zstd', 'blosclz', 'zlib', 'gzip', 'lzf', 'default')
+
+CONFIG_FIELDS = {
+    'num_images': (REQUIRED, int),
+    'exp_time': (REQUIRED, float),
+    'file_path': (REQUIRED, None),
+    'file_name': (REQUIRED, str),
+    'stim_run': (REQUIRED, None),
+    'gain': (REQUIRED, float),
+    'framerate': (REQUIRED, RATE),
+    'input_v': (5, float),
+    'writer_workers': (4, int),
+    'writer_queue_depth': (64, int),
+    'writer_full_policy': ('block', FULL_POLICIES),
+    'camera_backend': ('spinnaker', CAMERA_BACKENDS),
+    'simulation': ({}, dict),
+    'probe_live_interval': (0, float),
+    'file_format': ('tif', STORE_FORMATS),
+    'container_chunk_frames': (16, int),
+    'container_compression': ('none', COMPRESSIONS),
+    'container_compression_level': (5, int),
+    'container_shuffle': ('auto', SHUFFLES),
+    'chunk_timestamps': (True, bool),
+    'sync_mode': ('auto', SYNC_MODES),
+    'sync_tolerance_us': (2000, float),
+    'sync_max_pending': (8, int),
+    'trigger_broadcast': (True, bool),
+    'acquisition_mode': ('threads', ACQUISITION_MODES),
+    'preview': (False, bool),
+    'preview_fps': (10, float),
+    'preview_width': (320, int),
+    'controller_autostart': (True, bool),
+    'control_port': (0, int),
+    'pretrigger_seconds': (0, float),
+    'posttrigger_seconds': (2, float),
+    'hardware_framerate': (30, float),
+    'arduino_backend': ('firmata', ARDUINO_BACKENDS),
+    'arduino_port': ('COM6', str),
+    'arduino_channels': ([0], list),
+    'arduino_sample_rate': (500, float),
+    'arduino_vref': (5.0, float),
+    'arduino_start_volts': (4.5, float),
+    'arduino_stop_volts': (1.0, float),
+    'arduino_trigger_pin': (0, int),
+    'arduino_simulation': ({}, dict),
+    'dic': (False, bool),
+    'dic_camera': (0, int),
+    'dic_queue': (4, int),
+    'camera_cache': ('camera_cache.json', str),
+    'camera_user_set': ('', ('', 'UserSet0', 'UserSet1')),
+    'bring_up_workers': (0, int),
+    'stream_buffer_count': (10, int),
+    'stream_buffer_handling': ('OldestFirst', STREAM_BUFFER_MODES),
+    'link_throughput_limit_mbps': (0, float),
+    'stream_tuning': ({}, dict),
+    'binning': (1, (1, 2, 4)),
+    'decimation': (1, (1, 2, 4)),
+    'roi': ({}, dict),
+    'camera_geometry': ({}, dict),
+}
+# DIC settings, dic_<name>
+for _name, _value in DIC_DEFAULTS.items():
+    CONFIG_FIELDS['dic_' + _name] = (_value, float if isinstance(_value, float) else int)
+
+# Smallest value of the numeric keys
+CONFIG_MINIMUMS = {
+    'num_images': 0, 'exp_time': 0, 'writer_workers': 0, 'writer_queue_depth': 1, 'probe_live_interval': 0,
+    'container_chunk_frames': 1, 'container_compression_level': 0, 'sync_tolerance_us': 0,
+    'sync_max_pending': 1, 'preview_fps': 0, 'preview_width': 1, 'control_port': 0, 'pretrigger_seconds': 0,
+    'posttrigger_seconds': 0, 'hardware_framerate': 0, 'arduino_sample_rate': 0, 'dic_camera': 0, 'dic_queue': 1,
+    'bring_up_workers': 0, 'stream_buffer_count': 1, 'link_throughput_limit_mbps': 0,
+}
+
+
+class ConfigError(ValueError):
+    pass
+
+
+# Value of key checked against its kind, ints given for floats become floats
+def check_value(key, value, kind):
+    if kind is None:
+        return value
+    if isinstance(kind, tuple):
+        if value not in kind:
+            raise ConfigError('%s: %r is not one of %s' % (key, value, ', '.join(repr(v) for v in kind)))
+        return value
+    name = KIND_NAMES[kind]
+    if kind is RATE:
+        if value == 'hardware':
+            return value
+        kind = float
+    if kind is float and isinstance(value, int) and not isinstance(value, bool):
+        value = float(value)
+    elif kind in (dict, list) and value is None:
+        value = kind()
+    if not isinstance(value, kind) or (kind is int and isinstance(value, bool)):
+        raise ConfigError('%s: %r is not %s' % (key, value, name))
+    minimum = CONFIG_MINIMUMS.get(key)
+    if minimum is not None and value < minimum:
+        raise ConfigError('%s: %r is below %r' % (key, value, minimum))
+    return value
+
+
+class Config:
+    def __init__(self, values, path=CONFIG_PATH):
+        self.path = path
+        # folder of params.yaml and the scripts
+        self.dname = os.path.dirname(os.path.abspath(path))
+        for key, value in values.items():
+            setattr(self, key, value)
+        if self.file_path == 0:
+            self.im_savepath = os.path.join(self.dname, 'images')
+        else:
+            self.im_savepath = str(self.file_path)
+        self.filename = self.file_name + str(self.stim_run)
+        # 0: one writer per core, for compressed containers
+        self.writer_workers = self.writer_workers or os.cpu_count() or 1
+        self.dic_settings = {key: getattr(self, 'dic_' + key) for key in DIC_DEFAULTS}
+        # node snapshots of the cameras, next to params.yaml (see CameraSetup.py)
+        self.camera_cache_path = os.path.join(self.dname, self.camera_cache) if self.camera_cache else None
+
+    # Frame slots of a camera ring: a camera never has more frames in flight than the writer
+    # queue can hold plus one per worker, the ones waiting in the synchronizer and the one
+    # being captured
+    @property
+    def ring_slots(self):
+        return self.writer_queue_depth + self.writer_workers + self.sync_max_pending + 1
+
+
+# Mapping of a yaml file. Older files may hold !!python/tuple values, read as tuples.
+def read_yaml(path):
+    import yaml
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+    class ConfigLoader(loader):
+        pass
+
+    ConfigLoader.add_constructor('tag:yaml.org,2002:python/tuple',
+                                 lambda self, node: tuple(self.construct_sequence(node)))
+    if not os.path.exists(path):
+        raise FileNotFoundError('Config file %s not found. Please make sure that the file exists and/or there are '
+                                'no unnecessary spaces in its path!' % path)
+    with open(path) as f:
+        return yaml.load(f, Loader=ConfigLoader) or {}
+
+
+# Checked configuration of a params.yaml file. Raises ConfigError naming the wrong key.
+def load_config(path=CONFIG_PATH):
+    cfg = read_yaml(path)
+    values = {}
+    for key, (default, kind) in CONFIG_FIELDS.items():
+        if key in cfg:
+            value = check_value(key, cfg[key], kind)
+        elif default is REQUIRED:
+            raise ConfigError('%s: missing from %s' % (key, path))
+        else:
+            value = default
+        # the defaults are shared, every configuration gets its own dicts and lists
+        if isinstance(value, (dict, list)):
+            value = type(value)(value)
+        values[key] = value
+    for key in cfg:
+        if key not in CONFIG_FIELDS:
+            print('Unknown key %s in %s, ignored' % (key, path))
+    return Config(values, path)
+
+
+_config = None
+_config_lock = threading.Lock()
+
+
+# Configuration of the process, loaded from params.yaml on the first call
+def get_config():
+    global _config
+    with _config_lock:
+        if _config is None:
+            _config = load_config()
+        return _config
+
+
+# Create the image folder of the run and make it the working directory, where the frames and
+# the run files are written
+def enter_image_folder(config=None):
+    config = config or get_config()
+    if not os.path.exists(config.im_savepath):
+        os.makedirs(config.im_savepath)
+    os.chdir(config.im_savepath)
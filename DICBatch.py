@@ -0,0 +1,303 @@
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+from multiprocessing import shared_memory
+import numpy as np
+from DICEngine import DIC_DEFAULTS, DICEngine, strains, to_gray
+from FrameReader import open_acquisition
+
+# Batch digital image correlation of a recorded acquisition on all the cores (see DICEngine.py
+# for the correlation itself). Any recording FrameReader opens can be correlated, the
+# 'NNNN_{0,1}.tif' files of the threads mode included:
+#   python DICBatch.py images image_ --processes 8
+#
+# The frames of a camera, from the reference frame on, are cut into blocks of block_frames
+# frames and the subset grid into bands of tile_rows grid rows, and the (block, band) tiles are
+# spread over a pool of processes. The reference subsets, their steepest descent images and
+# inverse Hessians (the part of IC-GN computed from the reference) are computed once here and
+# put in one shared memory block (SharedState), which every process maps instead of computing
+# or receiving its own copy; a tile correlates its subsets only.
+#
+# A block starts from the solution of its first frame (keyframe), so the blocks of a band do not
+# wait for each other: a first pass correlates the keyframes, band by band, each one from the
+# keyframe before, every subset being searched for again within +/- search pixels, then the
+# blocks are correlated incrementally frame by frame. The motion between two keyframes has to
+# stay within search pixels.
+#
+# Results go to <file_name>_dic.zarr, one group per camera holding u, v (displacements), exx,
+# eyy, exy (Green-Lagrange strains) and zncc, each shaped (frames, grid rows, grid columns) and
+# chunked by tile, NaN for the subsets without texture, with index and host_time per frame.
+# Each tile writes exactly one chunk and is marked in the done array once written: a run killed
+# halfway, started again with the same settings, only correlates the tiles not done. The group
+# attributes give the settings, the scale (2: Bayer frames correlated binned) and the grid.
+
+BATCH_FIELDS = ('u', 'v', 'exx', 'eyy', 'exy', 'zncc')
+BATCH_DEFAULTS = {
+    'block_frames': 32,
+    'tile_rows': 8,
+}
+
+
+def batch_path(filename):
+    return filename + '_dic.zarr'
+
+
+# Arrays in one shared memory block. The parent creates it from a dict of arrays and passes
+# spec() to the pool processes, which map the same block with attach().
+class SharedState:
+    def __init__(self, state=None, spec=None):
+        self.owner = spec is None
+        if self.owner:
+            self.layout = []
+            offset = 0
+            for name, array in state.items():
+                array = np.asarray(array)
+                self.layout.append((name, array.shape, array.dtype.str, offset))
+                offset += (array.nbytes + 63) // 64 * 64
+            self.shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+        else:
+            name, self.layout = spec
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.arrays = {name: np.ndarray(shape, dtype=dtype, buffer=self.shm.buf, offset=offset)
+                       for name, shape, dtype, offset in self.layout}
+        if self.owner:
+            for name, array in state.items():
+                self.arrays[name][...] = array
+
+    # Everything attach needs, picklable
+    def spec(self):
+        return (self.shm.name, self.layout)
+
+    @classmethod
+    def attach(cls, spec):
+        return cls(spec=spec)
+
+    # Unmap the block, the creating process also frees it
+    def close(self):
+        self.arrays = None
+        try:
+            self.shm.close()
+        except BufferError:
+            # an engine still holds views, the mapping goes away with the process
+            pass
+        if self.owner:
+            self.shm.unlink()
+
+
+# Subsets (a slice of the grid, row major) of band band
+def band_subsets(grid_shape, tile_rows, band):
+    rows, columns = grid_shape
+    return slice(band * tile_rows * columns, min((band + 1) * tile_rows, rows) * columns)
+
+
+def _zarr_array(zarr, path, shape, chunks, dtype, fill_value=0):
+    # zarr 2 opens new arrays with open_array, zarr 3 creates them with create_array
+    if zarr.__version__.startswith('2'):
+        return zarr.open_array(path, mode='w', shape=shape, chunks=chunks, dtype=dtype, fill_value=fill_value)
+    return zarr.create_array(path, shape=shape, chunks=chunks, dtype=dtype, fill_value=fill_value, overwrite=True)
+
+
+# Output group of a camera, created for the tiles of settings, or kept as it is when it already
+# holds a run with the same settings (resume)
+def open_camera_group(zarr, out, camnum, header, settings, block_frames, tile_rows, indices, host_time):
+    path = os.path.join(out, 'cam%d' % camnum)
+    attributes = dict(header)
+    attributes.update({'settings': settings, 'block_frames': block_frames, 'tile_rows': tile_rows,
+                       'frames': len(indices)})
+    if os.path.exists(path):
+        group = zarr.open_group(path, mode='r+')
+        previous = dict(group.attrs)
+        if all(previous.get(key) == attributes[key]
+               for key in ('settings', 'block_frames', 'tile_rows', 'frames', 'reference_index', 'grid_shape')):
+            return group, True
+        print('DIC camera %d: %s holds a run with other settings, starting over' % (camnum, path))
+    group = zarr.open_group(path, mode='w')
+    group.attrs.update(attributes)
+    rows, columns = header['grid_shape']
+    n = len(indices)
+    blocks = -(-n // block_frames)
+    bands = -(-rows // tile_rows)
+    for name in BATCH_FIELDS:
+        _zarr_array(zarr, path + '/' + name, (n, rows, columns), (block_frames, tile_rows, columns), np.float32,
+                    np.nan)
+    _zarr_array(zarr, path + '/keyframes', (blocks, rows * columns, 6), (blocks, tile_rows * columns, 6),
+                np.float64, np.nan)
+    _zarr_array(zarr, path + '/keyframes_done', (bands,), (bands,), bool, False)
+    _zarr_array(zarr, path + '/done', (blocks, bands), (blocks, bands), bool, False)
+    _zarr_array(zarr, path + '/index', (n,), (max(n, 1),), np.int64)[:] = indices
+    _zarr_array(zarr, path + '/host_time', (n,), (max(n, 1),), np.int64)[:] = host_time
+    return zarr.open_group(path, mode='r+'), False
+
+
+# State of a pool process: the acquisition, the shared reference states and the output groups
+_worker = None
+
+
+class BatchWorker:
+    # cameras: {camnum: (SharedState spec, image shape)}
+    def __init__(self, path, filename, out, cameras, settings, block_frames, tile_rows):
+        import zarr
+        self.acquisition = open_acquisition(path, filename)
+        self.settings = settings
+        self.block_frames = block_frames
+        self.tile_rows = tile_rows
+        self.states = {camnum: (SharedState.attach(spec), shape) for camnum, (spec, shape) in cameras.items()}
+        self.groups = {camnum: zarr.open_group(os.path.join(out, 'cam%d' % camnum), mode='r+') for camnum in cameras}
+        self.indices = {camnum: self.groups[camnum]['index'][:] for camnum in cameras}
+
+    def engine(self, camnum, band):
+        shared, shape = self.states[camnum]
+        subsets = band_subsets(shared.arrays['grid_shape'], self.tile_rows, band)
+        return DICEngine.from_state(shared.arrays, shape, subsets, **self.settings), subsets
+
+    def image(self, camnum, position):
+        frames = self.acquisition[camnum]
+        return to_gray(frames.read(int(self.indices[camnum][position])), frames.pixel_format)[0]
+
+    # Keyframes of a band: the first frame of every block, each from the one before
+    def keyframes(self, camnum, band):
+        engine, subsets = self.engine(camnum, band)
+        blocks = self.groups[camnum]['keyframes'].shape[0]
+        keyframes = np.zeros((blocks, len(engine), 6))
+        for block in range(1, blocks):
+            engine.seed(keyframes[block - 1], search=True)
+            keyframes[block] = engine.correlate(self.image(camnum, block * self.block_frames))[0]
+        self.groups[camnum]['keyframes'][:, subsets] = keyframes
+        return camnum, band, engine.searches
+
+    # Frames of a block for the subsets of a band, from the keyframe of the block
+    def block(self, camnum, block, band):
+        engine, subsets = self.engine(camnum, band)
+        group = self.groups[camnum]
+        first = block * self.block_frames
+        stop = min(first + self.block_frames, len(self.indices[camnum]))
+        engine.seed(group['keyframes'][block, subsets])
+        params = np.empty((stop - first, len(engine), 6))
+        zncc = np.empty((stop - first, len(engine)))
+        for position in range(first, stop):
+            params[position - first], zncc[position - first] = engine.correlate(self.image(camnum, position))
+        params[:, ~engine.usable] = np.nan
+        zncc[:, ~engine.usable] = np.nan
+        exx, eyy, exy = strains(params)
+        columns = int(engine.grid_shape[1])
+        rows = slice(subsets.start // columns, subsets.stop // columns)
+        fields = {'u': params[..., 0], 'v': params[..., 3], 'exx': exx, 'eyy': eyy, 'exy': exy, 'zncc': zncc}
+        for name in BATCH_FIELDS:
+            group[name][first:stop, rows] = fields[name].reshape(stop - first, -1, columns).astype(np.float32)
+        return camnum, block, band, engine.searches
+
+
+def _init_worker(*args):
+    global _worker
+    _worker = BatchWorker(*args)
+
+
+def _keyframes_task(task):
+    return _worker.keyframes(*task)
+
+
+def _block_task(task):
+    return _worker.block(*task)
+
+
+# Correlate the frames of cameras (all by default) of an acquisition from frame reference on,
+# with processes processes (one per core by default). Returns the path of the output store.
+def correlate_acquisition(path, filename=None, cameras=None, settings=None, reference=0, stop=None, out=None,
+                          block_frames=BATCH_DEFAULTS['block_frames'], tile_rows=BATCH_DEFAULTS['tile_rows'],
+                          processes=None):
+    import zarr
+    full_settings = dict(DIC_DEFAULTS)
+    full_settings.update(settings or {})
+    settings = full_settings
+    if out is None:
+        out = batch_path(os.path.join(path, filename or ''))
+    zarr.open_group(out, mode='a')
+
+    shared = {}
+    keyframe_tasks = []
+    block_tasks = []
+    with open_acquisition(path, filename) as acquisition:
+        for camnum in (sorted(acquisition.cameras) if cameras is None else cameras):
+            frames = acquisition[camnum]
+            indices = frames.indices(reference, stop)
+            if not indices:
+                print('DIC camera %d: no frame from %d on' % (camnum, reference))
+                continue
+            image, scale = to_gray(frames.read(indices[0]), frames.pixel_format)
+            engine = DICEngine(image, **settings)
+            header = engine.header(scale, camnum, indices[0])
+            # grid row and column coordinates rather than those of every subset
+            header['y'] = engine.ys[::engine.grid_shape[1]].tolist()
+            header['x'] = engine.xs[:engine.grid_shape[1]].tolist()
+            group, resumed = open_camera_group(zarr, out, camnum, header, settings, block_frames, tile_rows,
+                                               indices, np.asarray(frames.host_time)[indices])
+            keyframes_done = group['keyframes_done'][:]
+            done = group['done'][:]
+            keyframe_tasks += [(camnum, band) for band in np.flatnonzero(~keyframes_done)]
+            block_tasks += [(camnum, block, band) for block, band in zip(*np.nonzero(~done))]
+            print('DIC camera %d: %d frames, %d subsets, %d of %d tiles %s' % (
+                camnum, len(indices), len(engine), done.sum() if resumed else 0, done.size,
+                'done, resuming' if resumed else 'to correlate'))
+            shared[camnum] = (SharedState(engine.state()), engine.shape)
+    if not shared:
+        return None
+
+    keyframe_tasks = [(int(camnum), int(band)) for camnum, band in keyframe_tasks]
+    block_tasks = [(int(camnum), int(block), int(band)) for camnum, block, band in block_tasks]
+    groups = {camnum: zarr.open_group(os.path.join(out, 'cam%d' % camnum), mode='r+') for camnum in shared}
+    processes = processes or os.cpu_count() or 1
+    t_start = time.monotonic()
+    searches = 0
+    # spawned like the camera processes (see ProcessCapture.py)
+    context = multiprocessing.get_context('spawn')
+    cameras = {camnum: (state.spec(), shape) for camnum, (state, shape) in shared.items()}
+    try:
+        with context.Pool(processes, _init_worker, (path, filename, out, cameras, settings, block_frames,
+                                                    tile_rows)) as pool:
+            for camnum, band, count in pool.imap_unordered(_keyframes_task, keyframe_tasks):
+                # the tiles of a band need all its keyframes
+                groups[camnum]['keyframes_done'][band] = True
+                searches += count
+            for n, (camnum, block, band, count) in enumerate(pool.imap_unordered(_block_task, block_tasks)):
+                groups[camnum]['done'][block, band] = True
+                searches += count
+                if (n + 1) % max(1, len(block_tasks) // 20) == 0 or n + 1 == len(block_tasks):
+                    elapsed = time.monotonic() - t_start
+                    print('DIC: %d/%d tiles, %.0f s, %.0f s left' % (
+                        n + 1, len(block_tasks), elapsed, elapsed / (n + 1) * (len(block_tasks) - n - 1)))
+    finally:
+        for state, shape in shared.values():
+            state.close()
+    print('DIC: %d keyframe bands and %d tiles correlated on %d processes in %.1f s, %d subset searches, results '
+          'in %s' % (len(keyframe_tasks), len(block_tasks), processes, time.monotonic() - t_start, searches, out))
+    return out
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Correlate the frames of a recorded acquisition on all the cores.')
+    parser.add_argument('path', help='acquisition directory, e.g. images')
+    parser.add_argument('filename', nargs='?', default=None, help='acquisition base name, e.g. image_')
+    parser.add_argument('--cameras', type=int, nargs='+', default=None, help='cameras to correlate (default all)')
+    parser.add_argument('--reference', type=int, default=0, help='index of the reference frame')
+    parser.add_argument('--stop', type=int, default=None)
+    parser.add_argument('--out', default=None, help='output zarr store (default <path>/<filename>_dic.zarr)')
+    parser.add_argument('--processes', type=int, default=None, help='pool size (default one per core)')
+    for key, value in BATCH_DEFAULTS.items():
+        parser.add_argument('--' + key.replace('_', '-'), type=int, default=value)
+    for key, value in DIC_DEFAULTS.items():
+        parser.add_argument('--' + key.replace('_', '-'), type=type(value), default=value)
+    args = parser.parse_args(argv)
+
+    settings = {key: getattr(args, key) for key in DIC_DEFAULTS}
+    out = correlate_acquisition(args.path, args.filename, args.cameras, settings, args.reference, args.stop,
+                                args.out, args.block_frames, args.tile_rows, args.processes)
+    return out is not None
+
+
+if __name__ == '__main__':
+    if main():
+        sys.exit(0)
+    else:
+        sys.exit(1)
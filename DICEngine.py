@@ -0,0 +1,508 @@
+import argparse
+import json
+import os
+import queue
+import sys
+import threading
+import time
+import numpy as np
+
+# Incremental digital image correlation of the frames of one camera against a reference frame.
+# The reference is divided into square subsets of subset pixels, step pixels apart. For every
+# frame each subset gets a first order shape function (u, du/dx, du/dy, v, dv/dx, dv/dy), found
+# with the inverse compositional Gauss-Newton method (IC-GN) on the zero-normalized sum of
+# squared differences: the reference gradients and Hessians are computed once, an iteration is
+# one bilinear resampling of the subsets in the new frame and a 6x6 solve per subset, all the
+# subsets together in NumPy.
+#
+# A frame starts from the solution of the previous one, extrapolated at constant velocity, so a
+# couple of iterations are enough while the motion is smooth. Subsets whose correlation (ZNCC)
+# ends below min_zncc, and all of them on the first frame, are searched for first by FFT cross
+# correlation within +/- search pixels of the previous solution, which gives the integer
+# displacement IC-GN starts from.
+#
+# Live correlation (dic: true in params.yaml): the sink of camera dic_camera hands every frame
+# it writes to a ThreadDICWorker, which correlates it in its own thread; frames arriving while
+# dic_queue frames are waiting are skipped, never the capture. The first frame written is the
+# reference. Results go to <file_name>_dic<N>.bin, one record per frame (read_dic), with the
+# subset grid in <file_name>_dic<N>.json. Recorded acquisitions are correlated the same way:
+#   python DICEngine.py images image_ --camera 0
+# or on all the cores with DICBatch.py.
+# Bayer frames are correlated on 2x2 binned grey levels, displacements are then given in
+# binned pixels (scale 2 in the header).
+
+DIC_DEFAULTS = {
+    'subset': 31,
+    'step': 16,
+    'search': 16,
+    'min_zncc': 0.8,
+    'max_iterations': 20,
+    'tolerance': 1e-3,
+}
+
+
+def dic_path(filename, camnum):
+    return filename + '_dic' + str(camnum) + '.bin'
+
+
+def dic_header_path(filename, camnum):
+    return filename + '_dic' + str(camnum) + '.json'
+
+
+def dic_dtype(num_subsets):
+    return np.dtype([
+        ('index', '<i8'),
+        ('host_time', '<i8'),
+        ('params', '<f4', (num_subsets, 6)),
+        ('zncc', '<f4', (num_subsets,)),
+        ('iterations', '<u1', (num_subsets,)),
+    ])
+
+
+# Grey levels of a frame as float32, and the pixel size of the result in frame pixels
+def to_gray(frame, pixel_format=''):
+    if pixel_format.startswith('Bayer'):
+        h, w = frame.shape[0] // 2 * 2, frame.shape[1] // 2 * 2
+        f = frame[:h, :w].astype(np.float32)
+        return (f[0::2, 0::2] + f[0::2, 1::2] + f[1::2, 0::2] + f[1::2, 1::2]) * 0.25, 2
+    if frame.ndim == 3:
+        return frame.astype(np.float32).mean(axis=2), 1
+    return frame.astype(np.float32), 1
+
+
+# Fourth order central differences, zero on the two outer pixels
+def gradients(image):
+    gy = np.zeros_like(image)
+    gx = np.zeros_like(image)
+    gy[2:-2] = (image[:-4] - 8 * image[1:-3] + 8 * image[3:-1] - image[4:]) / 12
+    gx[:, 2:-2] = (image[:, :-4] - 8 * image[:, 1:-3] + 8 * image[:, 3:-1] - image[:, 4:]) / 12
+    return gy, gx
+
+
+# The four corners of every pixel cell of image, so that a bilinear interpolation gathers
+# one 16 byte record per sample instead of four pixels
+def bilinear_table(image):
+    h, w = image.shape
+    table = np.empty((h - 1, w - 1, 4), dtype=np.float32)
+    table[..., 0] = image[:-1, :-1]
+    table[..., 1] = image[:-1, 1:]
+    table[..., 2] = image[1:, :-1]
+    table[..., 3] = image[1:, 1:]
+    return table
+
+
+# Image of a bilinear_table sampled at (y, x), positions clamped to the image. y and x are
+# float32 arrays, overwritten.
+def bilinear(table, y, x):
+    h, w = table.shape[:2]
+    np.clip(y, 0, h - 0.001, out=y)
+    np.clip(x, 0, w - 0.001, out=x)
+    y0 = y.astype(np.int32)
+    x0 = x.astype(np.int32)
+    y -= y0
+    x -= x0
+    i = y0 * w
+    i += x0
+    corners = np.take(table.reshape(-1, 4), i, axis=0)
+    a = corners[..., 0]
+    b = corners[..., 1] - a
+    c = corners[..., 2] - a
+    d = corners[..., 3] - a
+    d -= b
+    d -= c
+    d *= x
+    c += d
+    c *= y
+    b *= x
+    b += a
+    b += c
+    return b
+
+
+# Affine matrices of shape function parameters (n, 6) -> (n, 3, 3), and back
+def warp_matrices(p):
+    m = np.zeros((len(p), 3, 3))
+    m[:, 0, 0] = 1 + p[:, 1]
+    m[:, 0, 1] = p[:, 2]
+    m[:, 0, 2] = p[:, 0]
+    m[:, 1, 0] = p[:, 4]
+    m[:, 1, 1] = 1 + p[:, 5]
+    m[:, 1, 2] = p[:, 3]
+    m[:, 2, 2] = 1
+    return m
+
+
+def warp_params(m):
+    return np.stack([m[:, 0, 2], m[:, 0, 0] - 1, m[:, 0, 1], m[:, 1, 2], m[:, 1, 0], m[:, 1, 1] - 1], axis=1)
+
+
+# Green-Lagrange strains (exx, eyy, exy) of shape function parameters (..., 6)
+def strains(params):
+    ux, uy, vx, vy = params[..., 1], params[..., 2], params[..., 4], params[..., 5]
+    exx = ux + 0.5 * (ux ** 2 + vx ** 2)
+    eyy = vy + 0.5 * (uy ** 2 + vy ** 2)
+    exy = 0.5 * (uy + vx + ux * uy + vx * vy)
+    return exx, eyy, exy
+
+
+class DICEngine:
+    def __init__(self, reference, subset=31, step=16, search=16, min_zncc=0.8, max_iterations=20, tolerance=1e-3):
+        reference = np.asarray(reference, dtype=np.float32)
+        subset |= 1
+        half = subset // 2
+
+        # subset centres, far enough from the border for the gradients
+        margin = half + 2
+        h, w = reference.shape
+        ys, xs = np.meshgrid(np.arange(margin, h - margin, step), np.arange(margin, w - margin, step), indexing='ij')
+        state = {'grid_shape': np.array(ys.shape), 'ys': ys.ravel(), 'xs': xs.ravel()}
+        # local coordinates of the pixels of a subset
+        dy, dx = np.mgrid[-half:half + 1, -half:half + 1]
+        state['dy'] = dy.ravel().astype(np.float32)
+        state['dx'] = dx.ravel().astype(np.float32)
+
+        # reference subsets, zero mean, their norms, steepest descent images and inverse Hessians
+        rows = state['ys'][:, None] + dy.ravel()[None, :]
+        cols = state['xs'][:, None] + dx.ravel()[None, :]
+        f = reference[rows, cols]
+        state['f'] = f = f - f.mean(axis=1, keepdims=True)
+        state['f_norm'] = np.sqrt((f ** 2).sum(axis=1))
+        gy, gx = gradients(reference)
+        fx = gx[rows, cols]
+        fy = gy[rows, cols]
+        # (n, 6, pixels), the layout of the batched products of the iterations
+        jacobian = np.stack([fx, fx * state['dx'], fx * state['dy'], fy, fy * state['dx'], fy * state['dy']], axis=1)
+        state['jacobian'] = jacobian
+        hessian = np.einsum('nik,njk->nij', jacobian, jacobian, dtype=np.float64)
+        # textureless subsets have a singular Hessian, they are left out of the update
+        state['usable'] = (np.linalg.matrix_rank(hessian) == 6) & (state['f_norm'] > 0)
+        hessian[~state['usable']] = np.eye(6)
+        state['inverse_hessian'] = np.linalg.inv(hessian)
+        self._start(state, reference.shape, subset, search, min_zncc, max_iterations, tolerance)
+
+    # Engine over the subsets subsets (a slice) of a reference given by the state() of its engine,
+    # e.g. shared between processes
+    @classmethod
+    def from_state(cls, state, shape, subsets=slice(None), subset=31, step=16, search=16, min_zncc=0.8,
+                   max_iterations=20, tolerance=1e-3):
+        engine = cls.__new__(cls)
+        state = {name: array if name in cls.SHARED_STATE else array[subsets] for name, array in state.items()}
+        engine._start(state, shape, subset | 1, search, min_zncc, max_iterations, tolerance)
+        return engine
+
+    # Everything computed from the reference, the arrays correlate works with
+    def state(self):
+        return {name: getattr(self, name) for name in self.STATE}
+
+    STATE = ('grid_shape', 'ys', 'xs', 'dy', 'dx', 'f', 'f_norm', 'jacobian', 'usable', 'inverse_hessian')
+    # state not per subset
+    SHARED_STATE = ('grid_shape', 'dy', 'dx')
+
+    def _start(self, state, shape, subset, search, min_zncc, max_iterations, tolerance):
+        for name in self.STATE:
+            setattr(self, name, state[name])
+        self.shape = tuple(shape)
+        self.subset = subset
+        self.half = subset // 2
+        self.search = search
+        self.min_zncc = min_zncc
+        self.max_iterations = max_iterations
+        self.tolerance = tolerance
+
+        self.params = np.zeros((len(self.ys), 6))
+        self.previous = self.params
+        self.zncc = np.where(self.usable, 1.0, 0.0)
+        self.iterations = np.zeros(len(self.ys), dtype=np.uint8)
+        self.frames = 0
+        self.searches = 0
+
+    def __len__(self):
+        return len(self.ys)
+
+    # Start from the solution params of a frame already correlated. With search, the next frame
+    # is far from it and every subset is searched for first, within +/- search pixels of params.
+    def seed(self, params, search=False):
+        self.params[:] = params
+        self.previous = self.params.copy()
+        self.frames = 0 if search else 1
+
+    # Integer displacement of the subsets which by FFT cross correlation, within +/- search
+    # pixels of their current displacement
+    def search_subsets(self, image, which):
+        r = self.search
+        n = self.subset
+        size = n + 2 * r
+        pad = self.half + r
+        padded = np.pad(image, pad, mode='edge')
+        u = np.rint(self.params[which, 0]).astype(np.intp)
+        v = np.rint(self.params[which, 3]).astype(np.intp)
+        # top left corner of the search windows in the padded image
+        top = np.clip(self.ys[which] + v - self.half - r + pad, 0, padded.shape[0] - size)
+        left = np.clip(self.xs[which] + u - self.half - r + pad, 0, padded.shape[1] - size)
+        span = np.arange(size)
+        windows = padded[top[:, None, None] + span[None, :, None], left[:, None, None] + span[None, None, :]]
+
+        f = self.f[which].reshape(-1, n, n)
+        corr = np.fft.irfft2(np.conj(np.fft.rfft2(f, s=(size, size))) * np.fft.rfft2(windows), s=(size, size))
+        corr = corr[:, :2 * r + 1, :2 * r + 1]
+        # energy of the window under the subset at every shift, from integral images
+        def box(a):
+            integral = np.zeros((len(a), size + 1, size + 1))
+            integral[:, 1:, 1:] = a.cumsum(axis=1).cumsum(axis=2)
+            return (integral[:, n:, n:] - integral[:, :-n, n:] - integral[:, n:, :-n] + integral[:, :-n, :-n])[
+                :, :2 * r + 1, :2 * r + 1]
+        total = box(windows.astype(np.float64))
+        energy = box(windows.astype(np.float64) ** 2) - total ** 2 / (n * n)
+        zncc = corr / (self.f_norm[which, None, None] * np.sqrt(np.maximum(energy, 1e-12)))
+        best = zncc.reshape(len(which), -1).argmax(axis=1)
+        sy, sx = np.divmod(best, 2 * r + 1)
+
+        params = np.zeros((len(which), 6))
+        params[:, 0] = left + sx - pad - (self.xs[which] - self.half)
+        params[:, 3] = top + sy - pad - (self.ys[which] - self.half)
+        self.params[which] = params
+        self.searches += len(which)
+
+    # Subsets which of an image (its bilinear_table) at their current shape: zero mean grey
+    # levels and their norms
+    def warped(self, table, which):
+        dy, dx = self.dy, self.dx
+        p = self.params[which].astype(np.float32)
+        y = (self.ys[which, None] + p[:, 3:4]).astype(np.float32) + dy + p[:, 4:5] * dx + p[:, 5:6] * dy
+        x = (self.xs[which, None] + p[:, 0:1]).astype(np.float32) + dx + p[:, 1:2] * dx + p[:, 2:3] * dy
+        g = bilinear(table, y, x)
+        g -= g.mean(axis=1, keepdims=True)
+        return g, np.maximum(np.sqrt(np.einsum('nk,nk->n', g, g)), 1e-12)
+
+    # Inverse compositional Gauss-Newton refinement of the subsets which. The ZNCC of a subset
+    # is the one of its last iteration, less than tolerance away from the final shape.
+    def refine(self, table, which):
+        scale = self.half
+        active = which
+        iterations = np.zeros(len(self.ys), dtype=np.uint8)
+        for iteration in range(self.max_iterations):
+            if not len(active):
+                break
+            g, g_norm = self.warped(table, active)
+            f = self.f[active]
+            f_norm = self.f_norm[active]
+            self.zncc[active] = np.einsum('nk,nk->n', f, g) / (f_norm * g_norm)
+            g *= (-f_norm / g_norm)[:, None]
+            g += f
+            b = np.matmul(self.jacobian[active], g[:, :, None])[:, :, 0]
+            dp = -np.matmul(self.inverse_hessian[active], b[:, :, None].astype(np.float64))[:, :, 0]
+            # W(p) <- W(p) o W(dp)^-1
+            p = self.params[active]
+            self.params[active] = warp_params(warp_matrices(p) @ np.linalg.inv(warp_matrices(dp)))
+            iterations[active] += 1
+            change = dp[:, 0] ** 2 + dp[:, 3] ** 2 + scale ** 2 * (dp[:, 1] ** 2 + dp[:, 2] ** 2 + dp[:, 4] ** 2
+                                                                   + dp[:, 5] ** 2)
+            active = active[change >= self.tolerance ** 2]
+        self.iterations[which] = iterations[which]
+
+    # Correlate a new frame, returns the shape parameters (n, 6) and ZNCC (n) of the subsets
+    def correlate(self, image):
+        image = np.asarray(image, dtype=np.float32)
+        table = bilinear_table(image)
+        usable = np.flatnonzero(self.usable)
+        solution = self.params.copy()
+        if self.frames == 0:
+            self.search_subsets(image, usable)
+        elif self.frames > 1:
+            # constant velocity guess from the last two frames
+            self.params += self.params - self.previous
+        self.previous = solution
+        self.refine(table, usable)
+        lost = usable[self.zncc[usable] < self.min_zncc]
+        if len(lost):
+            # search again from the previous solution
+            self.params[lost] = solution[lost]
+            self.search_subsets(image, lost)
+            self.refine(table, lost)
+        self.frames += 1
+        return self.params, self.zncc
+
+    def header(self, scale=1, camera=0, reference_index=0):
+        return {
+            'camera': camera,
+            'reference_index': int(reference_index),
+            'scale': scale,
+            'subset': self.subset,
+            'image_shape': list(self.shape),
+            'grid_shape': [int(n) for n in self.grid_shape],
+            'y': self.ys.tolist(),
+            'x': self.xs.tolist(),
+            'params': ['u', 'du/dx', 'du/dy', 'v', 'dv/dx', 'dv/dy'],
+        }
+
+
+# Correlation records of a camera, appended to <filename>_dic<N>.bin
+class DICLog:
+    def __init__(self, filename, engine, scale=1, camera=0, reference_index=0):
+        with open(dic_header_path(filename, camera), 'w') as f:
+            json.dump(engine.header(scale, camera, reference_index), f)
+        self.record = np.zeros(1, dtype=dic_dtype(len(engine)))
+        self.file = open(dic_path(filename, camera), 'wb')
+
+    def append(self, index, host_time, engine):
+        record = self.record[0]
+        record['index'] = index
+        record['host_time'] = host_time
+        record['params'] = engine.params
+        record['zncc'] = engine.zncc
+        record['iterations'] = engine.iterations
+        self.file.write(self.record.tobytes())
+
+    def close(self):
+        self.file.close()
+
+
+def read_dic(filename, camnum=0):
+    with open(dic_header_path(filename, camnum)) as f:
+        header = json.load(f)
+    return header, np.fromfile(dic_path(filename, camnum), dtype=dic_dtype(len(header['y'])))
+
+
+# Correlates the frames of camera camnum offered by its sink, in its own thread
+class ThreadDICWorker(threading.Thread):
+    def __init__(self, filename, camnum=0, depth=4, settings=None):
+        threading.Thread.__init__(self, daemon=True)
+        self.filename = filename
+        self.camnum = camnum
+        self.settings = dict(DIC_DEFAULTS)
+        self.settings.update(settings or {})
+        self.queue = queue.Queue(depth)
+        self.engine = None
+        self.log = None
+        self.correlated = 0
+        self.skipped = 0
+        self.failed = 0
+        self.busy_ns = 0
+
+    # Called from a writer worker with each frame written, while the frame is still in its ring
+    def offer(self, index, frame, pixel_format, host_time):
+        try:
+            self.queue.put_nowait((index, np.array(frame), pixel_format, host_time))
+        except queue.Full:
+            self.skipped += 1
+            return False
+        return True
+
+    # A frame failing to correlate (frame too small for the subsets, singular update) is
+    # reported and counted, the worker goes on with the next ones so close() never waits on
+    # a full queue
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            try:
+                self.process(*item)
+            except Exception as ex:
+                if not self.failed:
+                    print('DIC camera %d: frame %d failed: %s' % (self.camnum, item[0], ex))
+                self.failed += 1
+        if self.log is not None:
+            self.log.close()
+
+    # Correlate one frame, the first one becomes the reference
+    def process(self, index, frame, pixel_format, host_time):
+        t_start = time.monotonic_ns()
+        image, scale = to_gray(frame, pixel_format)
+        if self.engine is None:
+            self.engine = DICEngine(image, **self.settings)
+            self.log = DICLog(self.filename, self.engine, scale, self.camnum, index)
+        else:
+            self.engine.correlate(image)
+            self.correlated += 1
+        self.log.append(index, host_time, self.engine)
+        self.busy_ns += time.monotonic_ns() - t_start
+
+    def close(self):
+        self.queue.put(None)
+        self.join()
+
+    def print_stats(self):
+        if self.engine is None:
+            print('DIC camera %d: no frame, %d failed' % (self.camnum, self.failed))
+            return
+        engine = self.engine
+        zncc = engine.zncc[engine.usable]
+        print('DIC camera %d: %d frames correlated, %d skipped, %d failed, %.1f ms per frame, %d subsets, last frame '
+              'median ZNCC %.3f with %d subsets below %.2f'
+              % (self.camnum, self.correlated, self.skipped, self.failed,
+                 self.busy_ns / 1e6 / max(self.correlated + 1, 1),
+                 len(engine), np.median(zncc) if len(zncc) else 0.0, (zncc < engine.min_zncc).sum(), engine.min_zncc))
+
+
+# Sink passing the frames it writes on to a ThreadDICWorker
+class DICSink:
+    def __init__(self, sink, worker, pixel_format):
+        self.sink = sink
+        self.worker = worker
+        self.pixel_format = pixel_format
+        self.records_timestamps = sink.records_timestamps
+
+    def write(self, index, frame, frame_id, timestamp, host_time):
+        self.sink.write(index, frame, frame_id, timestamp, host_time)
+        self.worker.offer(index, frame, self.pixel_format, host_time)
+
+    def close(self):
+        self.sink.close()
+
+
+# Output store correlating the frames of worker.camnum as they are written
+class DICStore:
+    def __init__(self, store, worker):
+        self.store = store
+        self.worker = worker
+        worker.start()
+
+    def sink(self, camnum, handles):
+        sink = self.store.sink(camnum, handles)
+        if camnum != self.worker.camnum:
+            return sink
+        return DICSink(sink, self.worker, handles.pixel_format)
+
+    def close(self):
+        self.store.close()
+        self.worker.close()
+        self.worker.print_stats()
+
+
+# Correlate the recorded frames of a camera (FrameReader CameraFrames), the first one being the reference
+def correlate_frames(frames, filename, camnum=0, settings=None, start=0, stop=None):
+    worker = ThreadDICWorker(filename, camnum, 1, settings)
+    # the work of the live worker, without its thread
+    for index in frames.indices(start, stop):
+        worker.process(index, frames.read(index), frames.pixel_format, int(frames.host_time[index]))
+    if worker.log is not None:
+        worker.log.close()
+    return worker
+
+
+def main(argv=None):
+    from FrameReader import open_acquisition
+    parser = argparse.ArgumentParser(description='Correlate the frames of a recorded acquisition against its first frame.')
+    parser.add_argument('path', help='acquisition directory, e.g. images')
+    parser.add_argument('filename', nargs='?', default=None, help='acquisition base name, e.g. image_')
+    parser.add_argument('--camera', type=int, default=0)
+    parser.add_argument('--start', type=int, default=0, help='index of the reference frame')
+    parser.add_argument('--stop', type=int, default=None)
+    for key, value in DIC_DEFAULTS.items():
+        parser.add_argument('--' + key.replace('_', '-'), type=type(value), default=value)
+    args = parser.parse_args(argv)
+
+    settings = {key: getattr(args, key) for key in DIC_DEFAULTS}
+    base = os.path.join(args.path, args.filename or '')
+    with open_acquisition(args.path, args.filename) as acquisition:
+        worker = correlate_frames(acquisition[args.camera], base, args.camera, settings, args.start, args.stop)
+    worker.print_stats()
+    return True
+
+
+if __name__ == '__main__':
+    if main():
+        sys.exit(0)
+    else:
+        sys.exit(1)
@@ -1,138 +1,165 @@
 import sys
-import os
-import PySpin
 import numpy as np
 import cv2
-import yaml
-from pathlib import Path
-import ruamel.yaml
-from ThreadFile import ThreadCapture_DisplayCameras, read_config
-
-# Change cwd to script folder
-abspath = os.path.abspath(__file__)
-dname = os.path.dirname(abspath)
-os.chdir(dname)
-
-# Read cfg yaml file
-cfg = read_config('params.yaml')
-num_images = cfg['num_images']
-exp_time = cfg['exp_time']
-gain = cfg['gain']
-bin_val = int(1)  # bin mode (WIP)
-if cfg['file_path'] == 0:
-    im_savepath = os.path.join(dname, 'images')
-else:
-    im_savepath = os.path.join(dname, 'images')
-filename = cfg['file_name'] + str(cfg['stim_run'])
-framerate = cfg['framerate']
-
-# Create webcam and aux save folder
-if not os.path.exists(im_savepath):
-    os.makedirs(im_savepath)
-os.chdir(im_savepath)
-
+from ThreadFile import ThreadCapture_DisplayCameras
+from CameraBackend import get_system, CameraHandles, CAMERA_ERRORS
+from PreviewTap import show_preview
+from Probes import PROBES
+from Timestamps import clock_path, estimate_clock, save_clocks
+from AcquisitionMultipleCamera import make_writer_pool, make_frame_ring, make_store, make_sync, \
+    make_trigger_broadcaster, make_preview_tap, print_clocks, geometry_settings, sensor_size
+from CameraSetup import configure_nodes
+from Config import get_config, enter_image_folder
 
 
 def set_trigger_mode_software(cam):
-    cam.TriggerMode.SetValue(PySpin.TriggerMode_Off)
-    cam.TriggerSource.SetValue(PySpin.TriggerSource_Software)
-    cam.TriggerMode.SetValue(PySpin.TriggerMode_On)
+    cam.SetNodeValue('TriggerMode', 'Off')
+    cam.SetNodeValue('TriggerSource', 'Software')
+    cam.SetNodeValue('TriggerMode', 'On')
     print("set trigger mode software")
 
 
 def reset_trigger_mode_software(cam):
-    cam.TriggerMode.SetValue(PySpin.TriggerMode_Off)
+    cam.SetNodeValue('TriggerMode', 'Off')
     print("reset trigger mode")
 
 
 
 def AcquireAndDisplay(cam_list, system, cameras):
+    config = get_config()
+    filename = config.filename
+    rings = []
+    handles = []
 
 
-    print("Number of cameras detected: {}".format(cam_list.GetSize()))
+    print("Number of cameras detected: {}".format(len(cam_list)))
 
-    if cam_list.GetSize() == 0:
+    if len(cam_list) == 0:
         print('Not enough cameras!')
         input('Done! Press Enter to exit...')
         system.ReleaseInstance()
         del system
         sys.exit()
 
-    for i in range(cam_list.GetSize()):
-        cam = cam_list.GetByIndex(i)
-        print("camera {} serial: {}".format(i, cam.GetUniqueID()))
+    for i in range(len(cam_list)):
+        cam = cam_list[i]
         cam.Init()
-        cam.AcquisitionMode.SetValue(PySpin.AcquisitionMode_Continuous)
+        cam.SetNodeValue('AcquisitionMode', 'Continuous')
         set_trigger_mode_software(cam)
+        # region of interest and binning of params.yaml, the rings and preview follow the frame size
+        if not configure_nodes(cam, geometry_settings(cam.GetSerial(), sensor_size(cam))):
+            print('Unable to set the region of interest of camera %d' % i)
+        # node pointers, serial and geometry resolved once for the preview and capture loops
+        handles.append(CameraHandles(cam))
+        print("camera {} serial: {}".format(i, handles[i].serial))
+        rings.append(make_frame_ring(handles[i]))
         cam.BeginAcquisition()
         cameras.append(cam)
 
 
     count = 0
-    frame = {}
+    writer = make_writer_pool()
+    store = make_store()
+    sinks = [store.sink(i, h) for i, h in enumerate(handles)]
+    # timestamps of all the captures of each camera, for the clock fit
+    stamps = [[] for h in handles]
+    # downsampled preview frames, from the preview triggers between captures and from the
+    # capture threads during a capture, so the preview goes on while recording
+    tap = make_preview_tap(len(handles), True)
+    titles = [h.serial for h in handles]
+    # capture threads, synchronizer and trigger broadcaster of the capture running
+    capture = None
 
     while 1:
 
         key = cv2.waitKey(1)
 
+        if capture is not None and not any(t.is_alive() for t in capture[0]):
+            finish_capture(*capture, stamps)
+            capture = None
+
         if key == 27: # ESC
+            if capture is not None:
+                for t in capture[0]:
+                    t.join()
+                finish_capture(*capture, stamps)
             cv2.destroyAllWindows()
+            writer.close()
+            store.close()
+            writer.print_stats()
+            PROBES.print_summary()
+            PROBES.dump(filename + '_probes.json')
+            clocks = {}
+            for i, recorded in enumerate(stamps):
+                if recorded:
+                    recorded = np.concatenate(recorded)
+                    clocks[i] = estimate_clock(recorded['timestamp'], recorded['host_time'])
+            print_clocks(clocks)
+            save_clocks(clock_path(filename), clocks)
             break
-        elif key == 32: # SPACE
+        elif key == 32 and capture is None: # SPACE
             print("take picture")
             thread = []
+            # frames of this capture are matched across the cameras and numbered after the previous ones
+            sync = make_sync(writer, sinks, first_index=count)
+            broadcaster = make_trigger_broadcaster(handles)
 
             for i, cam in enumerate(cam_list):
 
                 #cam.BeginAcquisition()
                 print('Camera %d started acquiring images...' % i)
 
-                thread.append(ThreadCapture_DisplayCameras(cam, i, count))
+                thread.append(ThreadCapture_DisplayCameras(handles[i], i, count, writer, rings[i], sinks[i], sync,
+                                                           broadcaster, tap))
                 thread[i].start()
-
-            for t in thread:
-                t.join()
-            count += num_images
-            '''for key, value in frame.items():
-                for i, cam in enumerate(cameras):
-                    cv2.imwrite("{:04}_{}.jpg".format(count,0), value)
-                count = count + 1'''
-
-
-        for j, cam in enumerate(cameras):
-            try:
-                cam.TriggerSoftware()
-                i = cam.GetNextImage()
-
-                # retrieve id cams
-                node_device_serial_number = PySpin.CStringPtr(cam.GetTLDeviceNodeMap().GetNode('DeviceSerialNumber'))
-                device_serial_number = node_device_serial_number.GetValue()
-                #print('Camera %d serial number set to %s...' % (j, device_serial_number))
-
-                #print(i.GetWidth(), i.GetHeight(), i.GetBitsPerPixel())
-
-                if i.IsIncomplete():
-                    pass
-                else:
-                    cam_id = cam.GetUniqueID()
-                    image_converted = i.Convert(PySpin.PixelFormat_BGR8, PySpin.DIRECTIONAL_FILTER)
-                    image_data = image_converted.GetData()
-                    cvi = np.frombuffer(image_data, dtype=np.uint8)
-                    cvi = cvi.reshape((i.GetHeight(),i.GetWidth(),3))
-                    frame[cam_id] = cvi
-                    res = cv2.resize(cvi, (int(1280/4),int(1024/4)))
-                    line = cv2.line(res, (int(1280/8), 0), (int(1280/8),int(1024/4)), (0, 0, 255), 2)
-                    line = cv2.line(res, (0, int(1024/8)), (int(1280/4),int(1024/8)), (0, 0, 255), 2)
-                    cv2.imshow("cam {}".format(device_serial_number), line)
-
-                i.Release()
-                del i
-
-            except PySpin.SpinnakerException as ex:
-                print("Error: {}".format(ex))
+            if broadcaster is not None:
+                broadcaster.start()
+            capture = (thread, sync, broadcaster)
+            count += config.num_images
+
+        # between captures the preview triggers the cameras itself, at the preview rate only
+        if capture is None:
+            for j, cam in enumerate(cameras):
+                if not tap.due(j):
+                    continue
+                try:
+                    handles[j].trigger_software()
+                    i = cam.GetNextImage()
+
+                    if not i.IsIncomplete():
+                        tap.offer(j, i.GetNDArray(), handles[j].pixel_format)
+
+                    i.Release()
+                    del i
+
+                except CAMERA_ERRORS as ex:
+                    print("Error: {}".format(ex))
+
+        show_preview(tap, titles)
+
+
+# End of a SPACE capture, once its threads are done: frames still waiting for a partner are
+# orphans, the frame times are kept for the clock fit
+def finish_capture(thread, sync, broadcaster, stamps):
+    if broadcaster is not None:
+        broadcaster.stop()
+        broadcaster.join()
+        broadcaster.print_stats()
+    if sync is not None:
+        sync.flush()
+        for t in thread:
+            t.finish()
+        sync.print_stats()
+    for i, t in enumerate(thread):
+        stamps[i].append(t.stamps.recorded())
 
 def launch_display():
-    system = PySpin.System.GetInstance()
+    config = get_config()
+    if config.num_images == 0:
+        print('num_images: 0 captures until stopped, the display takes a number of frames per capture')
+        return False
+    enter_image_folder(config)
+    system = get_system(config.camera_backend, config.simulation)
 
     # Get current library version
     version = system.GetLibraryVersion()
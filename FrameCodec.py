@@ -0,0 +1,114 @@
+import threading
+import time
+import numpy as np
+
+# Lossless compression of the frames written to the hdf5 and zarr containers.
+# Frames are compressed a chunk at a time with Blosc (numcodecs), by the writer pool worker
+# that completes the chunk, so the compression of all the cameras runs on as many cores as
+# the pool has workers (writer_workers: 0 gives one per core). The disk then only sees the
+# compressed bytes, and the recording rate goes up by the compression ratio.
+#   lz4     - fastest, the default
+#   zstd    - better ratio, several times slower
+#   blosclz - Blosc's own, close to lz4
+#   zlib    - slowest, for archives
+# Shuffling regroups the bytes (byte) or bits (bit) of every pixel before compression, so the
+# high bits of 12/16-bit pixels, mostly alike, compress together. auto uses bit for 12/16-bit
+# pixels and none for 8-bit ones, where shuffling gains nothing.
+# In hdf5 the compressed chunks are written as they are (direct chunk write) with the Blosc
+# filter of hdf5plugin (id 32001): FrameReader decodes them itself, other readers need
+# hdf5plugin. Zarr arrays get the Blosc codec and are readable by any zarr.
+
+CODECS = ('lz4', 'zstd', 'blosclz', 'zlib')
+SHUFFLES = ('auto', 'none', 'byte', 'bit')
+SHUFFLE_CODES = {'none': 0, 'byte': 1, 'bit': 2}
+# Blosc compressor codes, in the cd_values of the hdf5 Blosc filter
+BLOSC_COMPRESSOR_CODES = {'blosclz': 0, 'lz4': 1, 'zlib': 4, 'zstd': 5}
+HDF5_BLOSC_FILTER = 32001
+
+
+# True when compression names one of the Blosc codecs above, the other container_compression
+# values (gzip, lzf, default) are handled by h5py and zarr themselves
+def is_codec(compression):
+    return compression in CODECS
+
+
+class CodecStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.raw_bytes = 0
+        self.stored_bytes = 0
+        self.seconds = 0.0
+        self.chunks = 0
+
+    def add(self, raw_bytes, stored_bytes, seconds):
+        with self.lock:
+            self.raw_bytes += raw_bytes
+            self.stored_bytes += stored_bytes
+            self.seconds += seconds
+            self.chunks += 1
+
+    # MB/s one worker compresses
+    def mb_per_s(self):
+        return self.raw_bytes / self.seconds / 1e6 if self.seconds else 0.0
+
+
+class FrameCodec:
+    def __init__(self, name='lz4', level=5, shuffle='auto'):
+        if name not in CODECS:
+            raise ValueError('Unknown codec %r, expected one of %s' % (name, CODECS))
+        if shuffle not in SHUFFLES:
+            raise ValueError('Unknown shuffle %r, expected one of %s' % (shuffle, SHUFFLES))
+        if not 0 <= level <= 9:
+            raise ValueError('Compression level must be between 0 and 9, got %r' % level)
+        self.name = name
+        self.level = level
+        self.shuffle = shuffle
+        self.blosc = {}
+
+    def shuffle_mode(self, dtype):
+        if self.shuffle == 'auto':
+            return 'bit' if dtype.itemsize > 1 else 'none'
+        return self.shuffle
+
+    # numcodecs Blosc compressor of the frames of dtype
+    def compressor(self, dtype):
+        blosc = self.blosc.get(dtype.itemsize)
+        if blosc is None:
+            from numcodecs import Blosc
+            blosc = Blosc(self.name, self.level, SHUFFLE_CODES[self.shuffle_mode(dtype)])
+            self.blosc[dtype.itemsize] = blosc
+        return blosc
+
+    # zarr codec of the frames arrays: a numcodecs compressor for zarr 2, a zarr.codecs one for zarr 3
+    def zarr_codec(self, dtype, zarr_version):
+        if zarr_version.startswith('2'):
+            return self.compressor(dtype)
+        from zarr.codecs import BloscCodec
+        shuffle = {'none': 'noshuffle', 'byte': 'shuffle', 'bit': 'bitshuffle'}[self.shuffle_mode(dtype)]
+        return BloscCodec(cname=self.name, clevel=self.level, shuffle=shuffle, typesize=dtype.itemsize)
+
+    # create_dataset arguments of an hdf5 frames dataset taking direct chunk writes
+    def hdf5_filter(self, dtype, chunk_bytes):
+        return {
+            'compression': HDF5_BLOSC_FILTER,
+            'compression_opts': (2, 2, dtype.itemsize, chunk_bytes, self.level,
+                                 SHUFFLE_CODES[self.shuffle_mode(dtype)], BLOSC_COMPRESSOR_CODES[self.name]),
+            'allow_unknown_filter': True,
+        }
+
+    # Compressed bytes of a C-contiguous array, timed into stats
+    def encode(self, array, stats=None):
+        start = time.perf_counter()
+        data = self.compressor(array.dtype).encode(array)
+        if stats is not None:
+            stats.add(array.nbytes, len(data), time.perf_counter() - start)
+        return data
+
+    def describe(self, dtype):
+        return '%s level %d, %s shuffle' % (self.name, self.level, self.shuffle_mode(dtype))
+
+
+# Array of a Blosc compressed chunk
+def decode_chunk(data, dtype, shape):
+    from numcodecs import Blosc
+    return np.frombuffer(Blosc().decode(data), dtype=dtype).reshape(shape)
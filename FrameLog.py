@@ -0,0 +1,210 @@
+import argparse
+import json
+import os
+import sys
+import threading
+import numpy as np
+from FrameRing import pixel_format_dtype, pixel_format_channels
+
+# Raw frame log, the fastest output of the acquisition (file_format: rawlog).
+# Each camera writes the raw sensor bytes of its frames into one preallocated file,
+# <file_name>_cam<N>.raw, one stride apart in the order they are written, where stride is
+# the frame size rounded up to ALIGNMENT, so every frame is one large aligned positional write.
+# Frame numbers need not be contiguous (continuous recording only keeps the frames around
+# events), the index gives the offset of frame i.
+# Next to it:
+#   <file_name>_cam<N>.idx  - one INDEX_DTYPE record per frame (offset, frame ID, device
+#                             timestamp, host monotonic time), written as frames are written
+#   <file_name>_cam<N>.json - geometry, pixel format, serial number and stride of the log
+# This replaces the <file_name>_t<N>.txt timestamp file for this format.
+# convert_log turns a log into TIFF files or an hdf5/zarr container afterwards:
+#   python FrameLog.py images/image__cam0 --to tif
+
+ALIGNMENT = 4096
+
+INDEX_DTYPE = np.dtype([
+    ('offset', '<u8'),
+    ('frame_id', '<i8'),
+    ('timestamp', '<u8'),    # device clock, ns
+    ('host_time', '<i8'),    # host time.monotonic_ns()
+    ('flags', '<u8'),        # FLAG_WRITTEN once the frame is in the log
+])
+FLAG_WRITTEN = 1
+
+O_BINARY = getattr(os, 'O_BINARY', 0)
+
+
+def align(nbytes, alignment=ALIGNMENT):
+    return (nbytes + alignment - 1) // alignment * alignment
+
+
+# Log file names of camera camnum for the base name filename
+def log_paths(base):
+    return base + '.raw', base + '.idx', base + '.json'
+
+
+class FrameLogSink:
+    # The log holds the frame times, no <file_name>_t<N>.txt file is needed
+    records_timestamps = True
+
+    def __init__(self, base, camnum, handles, num_frames=0):
+        self.base = base
+        self.raw_path, self.index_path, self.header_path = log_paths(base)
+        channels = pixel_format_channels(handles.pixel_format)
+        self.dtype = np.dtype(pixel_format_dtype(handles.pixel_format))
+        self.shape = (handles.height, handles.width) if channels == 1 else (handles.height, handles.width, channels)
+        self.frame_bytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        self.stride = align(self.frame_bytes)
+        self.header = {
+            'camera': camnum,
+            'serial': str(handles.serial),
+            'pixel_format': handles.pixel_format,
+            'width': handles.width,
+            'height': handles.height,
+            'channels': channels,
+            'dtype': self.dtype.str,
+            'frame_bytes': self.frame_bytes,
+            'stride': self.stride,
+            'alignment': ALIGNMENT,
+            'index_dtype': INDEX_DTYPE.descr,
+            'count': 0,
+        }
+        self.lock = threading.Lock()
+        self.last_index = -1
+        self.next_offset = 0
+        self.fd = os.open(self.raw_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC | O_BINARY, 0o666)
+        self.index_fd = os.open(self.index_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC | O_BINARY, 0o666)
+        self.preallocate(num_frames)
+        self.write_header()
+
+    # Reserve the disk space of num_frames frames up front so the file does not fragment
+    def preallocate(self, num_frames):
+        if num_frames <= 0:
+            return
+        if hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(self.fd, 0, num_frames * self.stride)
+                os.posix_fallocate(self.index_fd, 0, num_frames * INDEX_DTYPE.itemsize)
+                return
+            except OSError:
+                pass
+        os.ftruncate(self.fd, num_frames * self.stride)
+        os.ftruncate(self.index_fd, num_frames * INDEX_DTYPE.itemsize)
+
+    def write_header(self):
+        with open(self.header_path, 'w') as f:
+            json.dump(self.header, f, indent=2)
+
+    def _pwrite(self, fd, data, offset):
+        if hasattr(os, 'pwrite'):
+            os.pwrite(fd, data, offset)
+        else:
+            # no positional write on Windows, seek and write under the sink lock
+            with self.lock:
+                os.lseek(fd, offset, os.SEEK_SET)
+                os.write(fd, data)
+
+    def write(self, index, frame, frame_id, timestamp, host_time):
+        with self.lock:
+            offset = self.next_offset
+            self.next_offset += self.stride
+            if index > self.last_index:
+                self.last_index = index
+        self._pwrite(self.fd, np.ascontiguousarray(frame), offset)
+        record = np.array((offset, frame_id, timestamp, host_time, FLAG_WRITTEN), dtype=INDEX_DTYPE)
+        self._pwrite(self.index_fd, record.tobytes(), index * INDEX_DTYPE.itemsize)
+
+    # Trim the preallocated space to the frames written and record the frame count
+    def close(self):
+        count = self.last_index + 1
+        os.ftruncate(self.fd, self.next_offset)
+        os.ftruncate(self.index_fd, count * INDEX_DTYPE.itemsize)
+        os.close(self.fd)
+        os.close(self.index_fd)
+        self.header['count'] = count
+        self.write_header()
+
+
+class FrameLogStore:
+    def __init__(self, filename, num_frames=0):
+        self.filename = filename
+        self.num_frames = num_frames
+        self.sinks = []
+
+    def sink(self, camnum, handles):
+        sink = FrameLogSink(self.filename + '_cam%d' % camnum, camnum, handles, self.num_frames)
+        self.sinks.append(sink)
+        return sink
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+
+def read_header(base):
+    with open(log_paths(base)[2]) as f:
+        return json.load(f)
+
+
+# Index records of a log, entries without FLAG_WRITTEN were never written (dropped frames)
+def read_index(base):
+    return np.fromfile(log_paths(base)[1], dtype=INDEX_DTYPE)
+
+
+# Camera description of a log, standing in for CameraHandles when a log is converted
+class LogHandles:
+    def __init__(self, header):
+        self.serial = header['serial']
+        self.width = header['width']
+        self.height = header['height']
+        self.pixel_format = header['pixel_format']
+
+
+# Write the frames of a log as TIFF files ('NNNN_k.tif' in the current directory) or into an
+# hdf5/zarr container named out. Frames missing from the log are skipped.
+def convert_log(base, file_format='tif', out=None, chunk_frames=16, compression=None, level=5, shuffle='auto'):
+    from FrameStore import open_store
+    header = read_header(base)
+    index = read_index(base)
+    shape = (header['height'], header['width'])
+    if header['channels'] != 1:
+        shape += (header['channels'],)
+    raw = np.memmap(log_paths(base)[0], dtype=np.uint8, mode='r')
+
+    store = open_store(file_format, out or base, chunk_frames, compression, level=level, shuffle=shuffle)
+    sink = store.sink(header['camera'], LogHandles(header))
+    converted = 0
+    for i, record in enumerate(index):
+        if not record['flags'] & FLAG_WRITTEN:
+            continue
+        offset = int(record['offset'])
+        frame = raw[offset:offset + header['frame_bytes']].view(header['dtype']).reshape(shape)
+        sink.write(i, frame, record['frame_id'], record['timestamp'], record['host_time'])
+        converted += 1
+    store.close()
+    return converted
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Convert a raw frame log to TIFF files or an hdf5/zarr container.')
+    parser.add_argument('logs', nargs='+', help='log base names, e.g. images/image__cam0')
+    parser.add_argument('--to', default='tif', choices=['tif', 'hdf5', 'zarr'])
+    parser.add_argument('--out', default=None, help='container base name (default: the log base name)')
+    parser.add_argument('--chunk-frames', type=int, default=16)
+    parser.add_argument('--compression', default='none', help='none, lz4, zstd, blosclz, zlib, or gzip/lzf (hdf5)')
+    parser.add_argument('--level', type=int, default=5, help='level of the lz4/zstd/blosclz/zlib codecs')
+    parser.add_argument('--shuffle', default='auto', choices=['auto', 'none', 'byte', 'bit'])
+    args = parser.parse_args(argv)
+
+    for base in args.logs:
+        out = args.out + '_cam%d' % read_header(base)['camera'] if args.out and len(args.logs) > 1 else args.out
+        converted = convert_log(base, args.to, out, args.chunk_frames, args.compression, args.level, args.shuffle)
+        print('%s: %d frames converted to %s' % (base, converted, args.to))
+    return True
+
+
+if __name__ == '__main__':
+    if main():
+        sys.exit(0)
+    else:
+        sys.exit(1)
@@ -0,0 +1,323 @@
+import datetime
+import glob
+import os
+import re
+import struct
+import numpy as np
+from FrameStore import CONTAINER_EXTENSIONS, tiff_suffix
+from FrameCodec import HDF5_BLOSC_FILTER, decode_chunk
+from FrameLog import FLAG_WRITTEN, log_paths, read_header, read_index
+from Timestamps import timestamp_path, read_timestamps
+
+# Read back a recorded acquisition without loading it into memory.
+#   acq = open_acquisition('images', 'image_')
+#   left = acq.camera(0)[12]                  # frame 12 of camera 0
+#   for i, left, right in acq.pairs(): ...    # synchronized stereo pairs
+#   idx = acq.camera(0).between(t0, t1)       # frames in a time range
+# Frames are NumPy views on a memory map of the file wherever the bytes are stored as-is:
+# raw frame logs, uncompressed hdf5 chunks and uncompressed single-strip TIFF files.
+# Compressed hdf5, zarr and compressed TIFF frames are decoded on access, one frame at a time
+# (Blosc compressed hdf5 chunks, see FrameCodec.py, one chunk at a time).
+# Views are read-only, copy a frame before modifying it.
+
+TIFF_PATTERN = re.compile(r'^(\d+)_(\d+)\.tif$')
+
+
+class CameraFrames:
+    # frame_id is -1 and valid False for frames that were never written (dropped)
+    def __init__(self, camnum, serial, pixel_format, shape, dtype, frame_id, timestamp, host_time, valid):
+        self.camnum = camnum
+        self.serial = serial
+        self.pixel_format = pixel_format
+        self.shape = shape
+        self.dtype = dtype
+        self.frame_id = frame_id
+        self.timestamp = timestamp
+        self.host_time = host_time
+        self.valid = valid
+
+    def __len__(self):
+        return len(self.valid)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('frame %d out of range (%d frames)' % (index, len(self)))
+        if not self.valid[index]:
+            raise KeyError('frame %d of camera %d was not recorded' % (index, self.camnum))
+        return self.read(index)
+
+    def read(self, index):
+        raise NotImplementedError
+
+    # Indices of the recorded frames from start to stop
+    def indices(self, start=0, stop=None):
+        stop = len(self) if stop is None else min(stop, len(self))
+        return [i for i in range(start, stop) if self.valid[i]]
+
+    # Indices of the recorded frames with start <= time < end, time being clock
+    # ('timestamp': device clock, 'host_time': host clock), in ns
+    def between(self, start, end, clock='timestamp'):
+        times = np.asarray(getattr(self, clock))
+        return np.flatnonzero(np.asarray(self.valid) & (times >= start) & (times < end))
+
+    def frames(self, start=0, stop=None):
+        for i in self.indices(start, stop):
+            yield i, self.read(i)
+
+    def close(self):
+        pass
+
+
+# Raw frame log, the whole file is one memory map and frame i a view at its offset
+class RawLogFrames(CameraFrames):
+    def __init__(self, base):
+        header = read_header(base)
+        index = read_index(base)
+        shape = (header['height'], header['width'])
+        if header['channels'] != 1:
+            shape += (header['channels'],)
+        CameraFrames.__init__(self, header['camera'], header['serial'], header['pixel_format'], shape,
+                              np.dtype(header['dtype']), index['frame_id'], index['timestamp'],
+                              index['host_time'], (index['flags'] & FLAG_WRITTEN) != 0)
+        self.offset = index['offset']
+        self.frame_bytes = header['frame_bytes']
+        self.raw = np.memmap(log_paths(base)[0], dtype=np.uint8, mode='r') if len(index) else None
+
+    def read(self, index):
+        offset = int(self.offset[index])
+        return self.raw[offset:offset + self.frame_bytes].view(self.dtype).reshape(self.shape)
+
+    def close(self):
+        self.raw = None
+
+
+# Camera group of an hdf5 container. Unfiltered chunks are mapped straight from the file
+# (their position comes from the HDF5 chunk index), Blosc compressed chunks are read raw and
+# decoded here (h5py would need hdf5plugin), others are read through h5py.
+class HDF5Frames(CameraFrames):
+    def __init__(self, camnum, group, raw):
+        frames = group['frames']
+        frame_id = group['frame_id'][:]
+        CameraFrames.__init__(self, camnum, group.attrs.get('serial', ''), group.attrs.get('pixel_format', ''),
+                              frames.shape[1:], frames.dtype, frame_id, group['timestamp'][:],
+                              group['host_time'][:], frame_id >= 0)
+        self.frames = frames
+        self.raw = raw
+        self.chunk_frames = frames.chunks[0] if frames.chunks else None
+        plist = frames.id.get_create_plist()
+        self.mappable = (raw is not None and self.chunk_frames is not None and plist.get_nfilters() == 0
+                         and hasattr(frames.id, 'get_chunk_info_by_coord'))
+        self.blosc = plist.get_nfilters() == 1 and plist.get_filter(0)[0] == HDF5_BLOSC_FILTER
+        self.chunks = {}
+        self.decoded = (None, None)
+
+    def chunk(self, number):
+        view = self.chunks.get(number)
+        if view is None:
+            info = self.frames.id.get_chunk_info_by_coord((number * self.chunk_frames,) + (0,) * len(self.shape))
+            if info.byte_offset is None:
+                return None
+            view = self.raw[info.byte_offset:info.byte_offset + info.size].view(self.dtype)
+            view = view.reshape((self.chunk_frames,) + self.shape)
+            self.chunks[number] = view
+        return view
+
+    # Decoded Blosc chunk, the last one is kept for the frames that follow
+    def decode(self, number):
+        if self.decoded[0] != number:
+            offset = (number * self.chunk_frames,) + (0,) * len(self.shape)
+            filter_mask, data = self.frames.id.read_direct_chunk(offset)
+            self.decoded = (number, decode_chunk(data, self.dtype, (self.chunk_frames,) + self.shape))
+        return self.decoded[1]
+
+    def read(self, index):
+        if self.mappable:
+            number, k = divmod(index, self.chunk_frames)
+            view = self.chunk(number)
+            if view is not None:
+                return view[k]
+        if self.blosc:
+            number, k = divmod(index, self.chunk_frames)
+            return self.decode(number)[k]
+        return self.frames[index]
+
+
+# Camera group of a zarr container, frames are decoded from their chunk on access
+class ZarrFrames(CameraFrames):
+    def __init__(self, camnum, group):
+        frames = group['frames']
+        frame_id = group['frame_id'][:]
+        CameraFrames.__init__(self, camnum, group.attrs.get('serial', ''), group.attrs.get('pixel_format', ''),
+                              frames.shape[1:], frames.dtype, frame_id, group['timestamp'][:],
+                              group['host_time'][:], frame_id >= 0)
+        self.frames = frames
+
+    def read(self, index):
+        return self.frames[index]
+
+
+# Layout of a TIFF file: (dtype, shape, offset) when the image is stored uncompressed in one
+# contiguous run of strips, None otherwise
+def tiff_layout(path):
+    with open(path, 'rb') as f:
+        head = f.read(8)
+        if len(head) < 8 or head[:2] not in (b'II', b'MM'):
+            return None
+        order = '<' if head[:2] == b'II' else '>'
+        magic, ifd = struct.unpack(order + 'HI', head[2:8])
+        if magic != 42:
+            return None
+        f.seek(ifd)
+        count, = struct.unpack(order + 'H', f.read(2))
+        tags = {}
+        for _ in range(count):
+            tag, kind, n, value = struct.unpack(order + 'HHI4s', f.read(12))
+            size = {3: 2, 4: 4}.get(kind)
+            if size is None:
+                continue
+            fmt = order + str(n) + ('H' if kind == 3 else 'I')
+            if n * size <= 4:
+                tags[tag] = struct.unpack(fmt, value[:n * size])
+            else:
+                pos = f.tell()
+                f.seek(struct.unpack(order + 'I', value)[0])
+                tags[tag] = struct.unpack(fmt, f.read(n * size))
+                f.seek(pos)
+    if tags.get(259, (1,))[0] != 1 or 273 not in tags or 279 not in tags:
+        return None
+    offsets, counts = tags[273], tags[279]
+    if any(offsets[i] + counts[i] != offsets[i + 1] for i in range(len(offsets) - 1)):
+        return None
+    width, height = tags[256][0], tags[257][0]
+    samples = tags.get(277, (1,))[0]
+    bits = tags.get(258, (8,))[0]
+    if bits not in (8, 16):
+        return None
+    dtype = np.dtype(order + ('u1' if bits == 8 else 'u2'))
+    shape = (height, width) if samples == 1 else (height, width, samples)
+    return dtype, shape, offsets[0]
+
+
+# One camera of an acquisition saved as 'NNNN_k.tif' files
+# Frame times come from <file_name>_t<N>.bin (see Timestamps.py), or from the host wall clock
+# times of the <file_name>_t<N>.txt file of older acquisitions.
+class TiffFrames(CameraFrames):
+    def __init__(self, camnum, paths, base=None):
+        length = max(paths) + 1 if paths else 0
+        valid = np.zeros(length, dtype=bool)
+        valid[list(paths)] = True
+        frame_id = np.where(valid, np.arange(length), -1)
+        timestamp = np.zeros(length, dtype=np.uint64)
+        host_time = np.zeros(length, dtype=np.int64)
+        if base and os.path.exists(timestamp_path(base, camnum)):
+            records = read_timestamps(timestamp_path(base, camnum))
+            records = records[(records['index'] >= 0) & (records['index'] < length)]
+            frame_id[records['index']] = records['frame_id']
+            timestamp[records['index']] = records['timestamp']
+            host_time[records['index']] = records['host_time']
+        elif base and os.path.exists(base + '_t' + str(camnum) + '.txt'):
+            with open(base + '_t' + str(camnum) + '.txt') as t:
+                times = [line.strip().rstrip(',') for line in t if line.strip()]
+            for i, text in enumerate(times[-length:] if length else []):
+                host_time[i] = int(datetime.datetime.fromisoformat(text).timestamp() * 1e9)
+        self.paths = paths
+        first = paths[min(paths)] if paths else None
+        layout = tiff_layout(first) if first else None
+        shape, dtype = (layout[1], layout[0]) if layout else (None, None)
+        CameraFrames.__init__(self, camnum, '', '', shape, dtype, frame_id, timestamp, host_time, valid)
+
+    def read(self, index):
+        path = self.paths[index]
+        layout = tiff_layout(path)
+        if layout is not None:
+            dtype, shape, offset = layout
+            return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape)
+        import cv2
+        return cv2.imread(path, cv2.IMREAD_UNCHANGED)
+
+
+class Acquisition:
+    def __init__(self, cameras, closers=()):
+        self.cameras = cameras
+        self.closers = list(closers)
+
+    def camera(self, camnum):
+        return self.cameras[camnum]
+
+    def __getitem__(self, camnum):
+        return self.cameras[camnum]
+
+    def __len__(self):
+        return min(len(c) for c in self.cameras.values()) if self.cameras else 0
+
+    # Frames of the same trigger on cameras left and right
+    def pair(self, index, left=0, right=1):
+        return self.cameras[left][index], self.cameras[right][index]
+
+    # Synchronized stereo pairs (index, left, right), skipping frames missing on either camera
+    def pairs(self, start=0, stop=None, left=0, right=1):
+        a, b = self.cameras[left], self.cameras[right]
+        stop = len(self) if stop is None else min(stop, len(self))
+        for i in range(start, stop):
+            if a.valid[i] and b.valid[i]:
+                yield i, a.read(i), b.read(i)
+
+    def close(self):
+        for camera in self.cameras.values():
+            camera.close()
+        for close in self.closers:
+            close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Open the acquisition saved under base name filename in directory path, whatever its
+# file_format: raw frame logs, hdf5 or zarr container, or TIFF files.
+def open_acquisition(path, filename=None):
+    if filename is None:
+        if path.endswith(CONTAINER_EXTENSIONS['hdf5']) or path.endswith(CONTAINER_EXTENSIONS['zarr']):
+            path, filename = os.path.split(os.path.abspath(path))
+            filename = os.path.splitext(filename)[0]
+        else:
+            filename = ''
+    base = os.path.join(path, filename)
+
+    logs = sorted(glob.glob(glob.escape(base) + '_cam*.json'))
+    if logs:
+        cameras = {}
+        for header in logs:
+            frames = RawLogFrames(header[:-len('.json')])
+            cameras[frames.camnum] = frames
+        return Acquisition(cameras)
+
+    if os.path.exists(base + CONTAINER_EXTENSIONS['hdf5']):
+        import h5py
+        h5 = h5py.File(base + CONTAINER_EXTENSIONS['hdf5'], 'r')
+        raw = np.memmap(base + CONTAINER_EXTENSIONS['hdf5'], dtype=np.uint8, mode='r')
+        cameras = {int(name[3:]): HDF5Frames(int(name[3:]), h5[name], raw) for name in h5 if name.startswith('cam')}
+        return Acquisition(cameras, [h5.close])
+
+    if os.path.exists(base + CONTAINER_EXTENSIONS['zarr']):
+        import zarr
+        root = zarr.open_group(base + CONTAINER_EXTENSIONS['zarr'], mode='r')
+        names = [name for name in root.group_keys() if name.startswith('cam')]
+        return Acquisition({int(name[3:]): ZarrFrames(int(name[3:]), root[name]) for name in names})
+
+    # TIFF files: camera 0 (primary) saves 'NNNN_1.tif', camera 1 'NNNN_0.tif', camera k > 1 'NNNN_k.tif'
+    paths = {}
+    for name in os.listdir(path):
+        match = TIFF_PATTERN.match(name)
+        if match:
+            camnum = tiff_suffix(int(match.group(2)))
+            paths.setdefault(camnum, {})[int(match.group(1)) - 1] = os.path.join(path, name)
+    cameras = {camnum: TiffFrames(camnum, p, base)
+               for camnum, p in paths.items() if p}
+    if not cameras:
+        raise FileNotFoundError('No acquisition found for %r in %s' % (filename, path))
+    return Acquisition(cameras)
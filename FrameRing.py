@@ -0,0 +1,118 @@
+import queue
+from multiprocessing import shared_memory
+import numpy as np
+
+
+# NumPy dtype holding one pixel of the given Spinnaker pixel format name.
+# 8 bit formats fit in uint8, deeper formats (10/12/14/16 bit) are unpacked to uint16.
+def pixel_format_dtype(pixel_format):
+    if pixel_format.endswith('8') or pixel_format.endswith('8Packed'):
+        return np.uint8
+    return np.uint16
+
+
+# Number of channels of an image of the given pixel format (debayering is not done here,
+# Bayer formats are stored as a single raw channel)
+def pixel_format_channels(pixel_format):
+    if pixel_format.startswith(('RGB', 'BGR')):
+        return 3
+    return 1
+
+
+def frame_shape(height, width, channels=1):
+    if channels == 1:
+        return (height, width)
+    return (height, width, channels)
+
+
+# Per camera ring of preallocated frames.
+# The capture loop takes a free slot, copies the driver buffer into it once and
+# releases the driver image right away. The slot is given back by the writer when
+# the frame has been written, so memory use stays constant for the whole acquisition.
+class FrameRing:
+    def __init__(self, slots, height, width, dtype=np.uint8, channels=1):
+        self.shape = frame_shape(height, width, channels)
+        self.dtype = np.dtype(dtype)
+        # one contiguous allocation, touched once so the pages are resident before capture starts
+        self.frames = self._allocate(slots)
+        self.free = queue.Queue()
+        for slot in range(slots):
+            self.free.put(slot)
+
+    def _allocate(self, slots):
+        return np.zeros((slots,) + self.shape, dtype=self.dtype)
+
+    @classmethod
+    def for_format(cls, slots, height, width, pixel_format):
+        return cls(slots, height, width, pixel_format_dtype(pixel_format), pixel_format_channels(pixel_format))
+
+    def __len__(self):
+        return len(self.frames)
+
+    @property
+    def frame_nbytes(self):
+        return self.frames[0].nbytes
+
+    # Wait for a free slot, returns None if none got free within timeout seconds
+    def acquire(self, timeout=None):
+        try:
+            return self.free.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def release(self, slot):
+        self.free.put(slot)
+
+    # Copy a raw image buffer (flat or shaped) into a slot, the only copy of the frame
+    def copy_in(self, slot, data):
+        np.copyto(self.frames[slot], np.asarray(data).reshape(self.shape), casting='unsafe')
+        return self.frames[slot]
+
+    def free_slots(self):
+        return self.free.qsize()
+
+
+# Frame ring in a shared memory block, for the process-per-camera acquisition (see ProcessCapture.py).
+# The parent process creates it and passes spec() to the camera process, which maps the same
+# block with attach(): the camera process copies frames in, the parent writes them out, only slot
+# numbers travel between the processes. Each side keeps its own free list (the parent's is unused),
+# the camera process gets its slots back through its control pipe.
+class SharedFrameRing(FrameRing):
+    def __init__(self, slots, height, width, dtype=np.uint8, channels=1, name=None):
+        self.name = name
+        self.channels = channels
+        FrameRing.__init__(self, slots, height, width, dtype, channels)
+
+    def _allocate(self, slots):
+        nbytes = slots * int(np.prod(self.shape)) * self.dtype.itemsize
+        self.owner = self.name is None
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+            self.name = self.shm.name
+        else:
+            self.shm = shared_memory.SharedMemory(name=self.name)
+        frames = np.ndarray((slots,) + self.shape, dtype=self.dtype, buffer=self.shm.buf)
+        if self.owner:
+            frames.fill(0)
+        return frames
+
+    # Everything attach needs, picklable
+    def spec(self):
+        height, width = self.shape[:2]
+        return (len(self.frames), height, width, self.dtype.str, self.channels, self.name)
+
+    @classmethod
+    def attach(cls, spec):
+        slots, height, width, dtype, channels, name = spec
+        return cls(slots, height, width, dtype, channels, name)
+
+    # Unmap the block, the creating process also frees it. No frame view may be used afterwards.
+    def close(self):
+        self.frames = None
+        try:
+            self.shm.close()
+        except BufferError:
+            # a frame view is still referenced somewhere, the mapping goes away with the process
+            pass
+        if self.owner:
+            self.shm.unlink()
@@ -0,0 +1,328 @@
+import os
+import threading
+import time
+import numpy as np
+from CameraBackend import save_tiff
+from FrameRing import pixel_format_dtype, pixel_format_channels
+from FrameLog import FrameLogStore
+from FrameCodec import FrameCodec, CodecStats, is_codec
+
+# Output stores of an acquisition. A store is opened once per run and gives one sink per
+# camera; the writer pool calls sink.write(index, frame, frame_id, timestamp, host_time)
+# for every frame, from any worker thread and in any order.
+#   tif  - one TIFF file per frame, '000' + str(index + 1) + '_' + suffix + '.tif', the suffix is 1
+#          for camera 0 and 0 for camera 1 (as before), the camera number for the other cameras
+#   hdf5 - <file_name>.h5, one group per camera
+#   zarr - <file_name>.zarr directory, one group per camera
+#   rawlog - <file_name>_cam<N>.raw raw frame log with a binary index, see FrameLog.py
+# In the containers each camera group holds a chunked (n, height, width) 'frames' array and
+# 'frame_id' (camera frame counter, -1 for a frame that was never written), 'timestamp'
+# (device clock, ns) and 'host_time' (host time.monotonic_ns()) arrays, with the camera serial
+# number and pixel format as attributes. Frames are buffered and written one chunk at a time.
+# compression is none, a Blosc codec of FrameCodec.py (lz4, zstd, blosclz, zlib) compressing the
+# chunks in the writer pool workers, or for hdf5 gzip or lzf and for zarr default.
+
+STORE_FORMATS = ('tif', 'hdf5', 'zarr', 'rawlog')
+CONTAINER_EXTENSIONS = {'hdf5': '.h5', 'zarr': '.zarr'}
+# A batch still incomplete when the batch STALE_CHUNKS chunks after it starts has lost frames
+# (dropped by the writer pool or the synchronizer, or by the camera): it is written with the
+# missing frames marked by frame_id -1 instead of waiting for the close
+STALE_CHUNKS = 4
+
+
+# Suffix of the TIFF files of camera camnum, and camera number of a suffix: the stereo pair
+# keeps its '_1' (primary) and '_0' files, the cameras beyond it use their number
+def tiff_suffix(camnum):
+    return 1 - camnum if camnum < 2 else camnum
+
+
+# TIFF files, one per frame
+class TiffSink:
+    records_timestamps = False
+
+    def __init__(self, camnum, handles):
+        self.suffix = tiff_suffix(camnum)
+        self.pixel_format = handles.pixel_format
+
+    def write(self, index, frame, frame_id, timestamp, host_time):
+        fullfilename = '000' + str(index + 1) + '_' + str(self.suffix) + '.tif'
+        save_tiff(frame, self.pixel_format, fullfilename)
+
+    def close(self):
+        pass
+
+
+class TiffStore:
+    def __init__(self, path=None):
+        self.path = path
+
+    def sink(self, camnum, handles):
+        return TiffSink(camnum, handles)
+
+    def close(self):
+        pass
+
+
+# Chunk of frames being filled before it is written to the container
+class FrameBatch:
+    def __init__(self, chunk_frames, shape, dtype):
+        self.frames = np.zeros((chunk_frames,) + shape, dtype=dtype)
+        self.frame_id = np.full(chunk_frames, -1, dtype=np.int64)
+        self.timestamp = np.zeros(chunk_frames, dtype=np.uint64)
+        self.host_time = np.zeros(chunk_frames, dtype=np.int64)
+        self.filled = 0
+
+    def reset(self):
+        self.frame_id.fill(-1)
+        self.filled = 0
+
+
+# Camera group of a container store. Frames are copied into a batch the size of one chunk,
+# the batch is written at once when it is complete (or at close), so the container only sees
+# whole-chunk writes. Batches are addressed by frame index, so frames written out of order
+# by the pool workers, or dropped, still land at the right place. Incomplete batches are
+# written once STALE_CHUNKS newer chunks have started, a frame arriving after its batch was
+# written is counted as late and dropped.
+# The worker completing a batch compresses and writes it outside the lock of the sink, the
+# other workers go on filling the next batch meanwhile.
+class ContainerSink:
+    records_timestamps = False
+
+    def __init__(self, store, arrays, chunk_frames, shape, dtype, camnum=0):
+        self.store = store
+        self.arrays = arrays
+        self.chunk_frames = chunk_frames
+        self.shape = shape
+        self.dtype = dtype
+        self.camnum = camnum
+        self.stats = CodecStats()
+        self.lock = threading.Lock()
+        self.batches = {}
+        self.spare = []
+        self.length = 0
+        self.last_index = -1
+        # batches below it are written, or were never started
+        self.written_below = 0
+        self.late = 0
+
+    def write(self, index, frame, frame_id, timestamp, host_time):
+        number, k = divmod(index, self.chunk_frames)
+        stale = []
+        with self.lock:
+            batch = self.batches.get(number)
+            if batch is None:
+                if number < self.written_below:
+                    self.late += 1
+                    return
+                batch = self.spare.pop() if self.spare else FrameBatch(self.chunk_frames, self.shape, self.dtype)
+                self.batches[number] = batch
+                if number - STALE_CHUNKS > self.written_below:
+                    self.written_below = number - STALE_CHUNKS
+                    stale = [(n, self.batches.pop(n)) for n in sorted(self.batches) if n < self.written_below]
+            batch.frames[k] = frame
+            batch.frame_id[k] = frame_id
+            batch.timestamp[k] = timestamp
+            batch.host_time[k] = host_time
+            batch.filled += 1
+            self.last_index = max(self.last_index, index)
+            if batch.filled == self.chunk_frames:
+                del self.batches[number]
+                stale.append((number, batch))
+        for number, batch in stale:
+            self._flush(number, batch)
+        if stale:
+            with self.lock:
+                for number, batch in stale:
+                    batch.reset()
+                    self.spare.append(batch)
+
+    # length: frames of the arrays at close, the batch past it is not written
+    def _flush(self, number, batch, length=None):
+        start = number * self.chunk_frames
+        end = start + self.chunk_frames if length is None else min(start + self.chunk_frames, length)
+        n = end - start
+        # compressed chunks are whole, the container keeps the frames past its length unread
+        data = self.store.encode(batch.frames, self.stats)
+        with self.store.lock:
+            if end > self.length:
+                self.length = end
+                for name, array in self.arrays.items():
+                    array.resize((end,) + array.shape[1:])
+            if data is not None:
+                self.store.write_chunk(self.arrays['frames'], start, data)
+            elif not self.store.concurrent_writes:
+                self.arrays['frames'][start:end] = batch.frames[:n]
+            self.arrays['frame_id'][start:end] = batch.frame_id[:n]
+            self.arrays['timestamp'][start:end] = batch.timestamp[:n]
+            self.arrays['host_time'][start:end] = batch.host_time[:n]
+        if data is None and self.store.concurrent_writes:
+            # the array compresses the chunk, in this worker
+            t = time.perf_counter()
+            self.arrays['frames'][start:end] = batch.frames[:n]
+            self.stats.add(batch.frames[:n].nbytes, 0, time.perf_counter() - t)
+
+    # Write the incomplete batches, the arrays end at the last frame written. They only grow:
+    # shrinking a filtered hdf5 dataset rewrites its last chunk through the filter.
+    def close(self):
+        with self.lock:
+            length = self.last_index + 1
+            for number, batch in sorted(self.batches.items()):
+                self._flush(number, batch, length)
+            self.batches = {}
+            self.spare = []
+            with self.store.lock:
+                for name, array in self.arrays.items():
+                    if array.shape[0] != length:
+                        array.resize((length,) + array.shape[1:])
+        if self.late:
+            print('Camera %d: %d frames arrived after their chunk was written, dropped' % (self.camnum, self.late))
+
+
+# Compression and its statistics, shared by the container stores
+class ContainerStore:
+    # the frames of a chunk may be written outside the store lock
+    concurrent_writes = False
+
+    def __init__(self, path, chunk_frames=16, compression=None, level=5, shuffle='auto'):
+        self.path = path
+        self.chunk_frames = chunk_frames
+        self.compression = compression
+        self.codec = FrameCodec(compression, level, shuffle) if is_codec(compression) else None
+        self.lock = threading.Lock()
+        self.sinks = []
+
+    # Compressed bytes of the frames of a chunk, None when the store writes them as they are
+    def encode(self, frames, stats):
+        return None
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+        if self.codec is not None:
+            self.print_stats()
+
+    def stored_bytes(self, sink):
+        return sink.stats.stored_bytes
+
+    def print_stats(self):
+        for sink in self.sinks:
+            stats = sink.stats
+            stored = self.stored_bytes(sink)
+            print('Camera %d: %s, %.1f MB in %.1f MB, ratio %.2f, %.0f MB/s per worker'
+                  % (sink.camnum, self.codec.describe(sink.dtype), stats.raw_bytes / 1e6, stored / 1e6,
+                     stats.raw_bytes / stored if stored else 0.0, stats.mb_per_s()))
+
+
+class HDF5Store(ContainerStore):
+    def __init__(self, path, chunk_frames=16, compression=None, level=5, shuffle='auto'):
+        import h5py
+        ContainerStore.__init__(self, path, chunk_frames, compression, level, shuffle)
+        self.file = h5py.File(path, 'w')
+        # h5py serializes all calls anyway, resizes and writes of all cameras share self.lock
+
+    def encode(self, frames, stats):
+        if self.codec is None:
+            return None
+        return self.codec.encode(frames, stats)
+
+    # Compressed chunk written as it is, its filter applied by the reader
+    def write_chunk(self, dataset, start, data):
+        dataset.id.write_direct_chunk((start,) + (0,) * (dataset.ndim - 1), data)
+
+    def sink(self, camnum, handles):
+        shape, dtype = frame_layout(handles)
+        b = self.chunk_frames
+        if self.codec is not None:
+            compression = self.codec.hdf5_filter(dtype, b * int(np.prod(shape)) * dtype.itemsize)
+        else:
+            compression = {'compression': None if self.compression in (None, 'none') else self.compression}
+        with self.lock:
+            group = self.file.create_group('cam%d' % camnum)
+            group.attrs['serial'] = str(handles.serial)
+            group.attrs['pixel_format'] = handles.pixel_format
+            arrays = {
+                'frames': group.create_dataset('frames', shape=(0,) + shape, maxshape=(None,) + shape,
+                                               chunks=(b,) + shape, dtype=dtype, **compression),
+                'frame_id': group.create_dataset('frame_id', shape=(0,), maxshape=(None,), chunks=(b * 64,),
+                                                 dtype=np.int64, fillvalue=-1),
+                'timestamp': group.create_dataset('timestamp', shape=(0,), maxshape=(None,), chunks=(b * 64,),
+                                                  dtype=np.uint64),
+                'host_time': group.create_dataset('host_time', shape=(0,), maxshape=(None,), chunks=(b * 64,),
+                                                  dtype=np.int64),
+            }
+        sink = ContainerSink(self, arrays, b, shape, dtype, camnum)
+        self.sinks.append(sink)
+        return sink
+
+    def close(self):
+        ContainerStore.close(self)
+        self.file.close()
+
+
+# With a codec, zarr compresses the frames of a chunk in the worker writing them, outside the
+# store lock (chunks of the arrays are independent, only the resizes share the lock)
+class ZarrStore(ContainerStore):
+    def __init__(self, path, chunk_frames=16, compression=None, level=5, shuffle='auto'):
+        import zarr
+        ContainerStore.__init__(self, path, chunk_frames, compression, level, shuffle)
+        self.zarr = zarr
+        self.concurrent_writes = self.codec is not None
+        zarr.open_group(path, mode='w')
+
+    def _array(self, path, shape, chunks, dtype, codec=False, fill_value=0):
+        path = os.path.join(self.path, path)
+        # zarr 2 takes a single compressor, zarr 3 a list of them in create_array
+        if self.zarr.__version__.startswith('2'):
+            kwargs = {'compressor': None} if self.compression == 'none' else {}
+            if codec:
+                kwargs = {'compressor': self.codec.zarr_codec(np.dtype(dtype), self.zarr.__version__)}
+            return self.zarr.open_array(path, mode='w', shape=shape, chunks=chunks, dtype=dtype,
+                                        fill_value=fill_value, **kwargs)
+        kwargs = {'compressors': None} if self.compression == 'none' else {}
+        if codec:
+            kwargs = {'compressors': self.codec.zarr_codec(np.dtype(dtype), self.zarr.__version__)}
+        return self.zarr.create_array(path, shape=shape, chunks=chunks, dtype=dtype, overwrite=True,
+                                      fill_value=fill_value, **kwargs)
+
+    def stored_bytes(self, sink):
+        frames = sink.arrays['frames']
+        return frames.nbytes_stored() if callable(frames.nbytes_stored) else frames.nbytes_stored
+
+    def sink(self, camnum, handles):
+        shape, dtype = frame_layout(handles)
+        b = self.chunk_frames
+        group = 'cam%d' % camnum
+        with self.lock:
+            self.zarr.open_group(os.path.join(self.path, group), mode='w',
+                                 attributes={'serial': str(handles.serial), 'pixel_format': handles.pixel_format})
+            arrays = {
+                'frames': self._array(group + '/frames', (0,) + shape, (b,) + shape, dtype, self.codec is not None),
+                'frame_id': self._array(group + '/frame_id', (0,), (b * 64,), np.int64, fill_value=-1),
+                'timestamp': self._array(group + '/timestamp', (0,), (b * 64,), np.uint64),
+                'host_time': self._array(group + '/host_time', (0,), (b * 64,), np.int64),
+            }
+        sink = ContainerSink(self, arrays, b, shape, dtype, camnum)
+        self.sinks.append(sink)
+        return sink
+
+
+# Shape and dtype of the frames of a camera, as held in its frame ring
+def frame_layout(handles):
+    channels = pixel_format_channels(handles.pixel_format)
+    shape = (handles.height, handles.width) if channels == 1 else (handles.height, handles.width, channels)
+    return shape, np.dtype(pixel_format_dtype(handles.pixel_format))
+
+
+# Open the output store of a run. filename is the base name of the container files,
+# num_frames the expected number of frames per camera (preallocated by the raw log).
+# level and shuffle apply to the Blosc codecs of the containers (see FrameCodec.py).
+def open_store(file_format, filename, chunk_frames=16, compression=None, num_frames=0, level=5, shuffle='auto'):
+    if file_format == 'tif':
+        return TiffStore()
+    if file_format == 'hdf5':
+        return HDF5Store(filename + CONTAINER_EXTENSIONS['hdf5'], chunk_frames, compression, level, shuffle)
+    if file_format == 'zarr':
+        return ZarrStore(filename + CONTAINER_EXTENSIONS['zarr'], chunk_frames, compression, level, shuffle)
+    if file_format == 'rawlog':
+        return FrameLogStore(filename, num_frames)
+    raise ValueError('Unknown file format %r, expected one of %s' % (file_format, STORE_FORMATS))
@@ -0,0 +1,173 @@
+import json
+import threading
+from collections import deque
+from Timestamps import OnlineClock
+
+# Frame synchronizer between the capture threads and the writer pool.
+# The capture threads push every frame here instead of submitting it to the writer. Frames of
+# all the cameras are matched into sets, by device timestamp (mapped to the host clock, within
+# tolerance_ns) or by frame ID (counted from the first frame of each camera). A complete set is
+# submitted to the writer under one index, so file NNNN_k of every camera comes from the same
+# trigger. Frames without a partner on every camera (dropped or duplicated frames) are orphans:
+# they are counted, logged and their ring slot is given back, they are not written.
+#
+# Streams of every camera arrive in time order, so when the heads of the per-camera queues are
+# further apart than the tolerance, the older heads can never be matched any more. At most
+# max_pending frames are kept per camera (they hold ring slots): a camera running ahead of the
+# others waits for them, up to WAIT_TIMEOUT seconds, then its oldest frames become orphans.
+# Once a camera has ended (end), the others no longer wait for it.
+
+SYNC_MODES = ('off', 'auto', 'timestamp', 'frame_id')
+MAX_LOGGED_ORPHANS = 10000
+WAIT_TIMEOUT = 1.0
+
+
+class PendingFrame:
+    __slots__ = ('key', 'frame', 'frame_id', 'timestamp', 'host_time', 'release', 't_start', 'stamps')
+
+    def __init__(self, key, frame, frame_id, timestamp, host_time, release, t_start, stamps):
+        self.key = key
+        self.frame = frame
+        self.frame_id = frame_id
+        self.timestamp = timestamp
+        self.host_time = host_time
+        self.release = release
+        self.t_start = t_start
+        self.stamps = stamps
+
+
+class FrameSynchronizer:
+    # sinks holds the output sink of every camera, in camera order. Written frames are numbered
+    # from first_index.
+    def __init__(self, writer, sinks, mode='timestamp', tolerance_ns=2000000, max_pending=8, first_index=0):
+        if mode not in ('timestamp', 'frame_id'):
+            raise ValueError('Unknown sync mode %r, expected timestamp or frame_id' % mode)
+        self.writer = writer
+        self.sinks = list(sinks)
+        self.mode = mode
+        self.tolerance = tolerance_ns if mode == 'timestamp' else 0
+        self.max_pending = max_pending
+        self.first_index = first_index
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        n = len(self.sinks)
+        self.pending = [deque() for _ in range(n)]
+        self.ended = [False] * n
+        self.clocks = [OnlineClock() for _ in range(n)]
+        self.first_frame_id = [None] * n
+        # statistics
+        self.sets = 0
+        self.orphan_count = [0] * n
+        self.orphans = []
+        self.max_skew = 0
+        self.total_skew = 0
+
+    # Called by the capture thread of camera camnum for every frame. release gives the ring slot
+    # back, stamps is the camera's TimestampLog: matched frames are logged under their output
+    # index, orphans under -1 (under the lock, the capture threads do not touch it meanwhile).
+    def push(self, camnum, frame, frame_id, timestamp, host_time, release, t_start=None, stamps=None):
+        with self.cond:
+            waiting = self.pending[camnum]
+            while len(waiting) >= self.max_pending and not any(self.ended):
+                if not self.cond.wait(WAIT_TIMEOUT):
+                    break
+            if self.mode == 'timestamp':
+                key = self.clocks[camnum].to_host(timestamp, host_time)
+            else:
+                if self.first_frame_id[camnum] is None:
+                    self.first_frame_id[camnum] = frame_id
+                key = frame_id - self.first_frame_id[camnum]
+            self.pending[camnum].append(PendingFrame(key, frame, frame_id, timestamp, host_time,
+                                                     release, t_start, stamps))
+            matched, orphans = self._match()
+            if matched or orphans:
+                self.cond.notify_all()
+        self._emit(matched, orphans)
+
+    # Called by the capture thread of camera camnum when it stops delivering frames
+    def end(self, camnum):
+        with self.cond:
+            self.ended[camnum] = True
+            self.cond.notify_all()
+
+    def _match(self):
+        matched, orphans = [], []
+        pending = self.pending
+        while all(pending):
+            keys = [q[0].key for q in pending]
+            latest = max(keys)
+            skew = latest - min(keys)
+            if skew <= self.tolerance:
+                index = self.first_index + self.sets
+                self.sets += 1
+                self.total_skew += skew
+                if skew > self.max_skew:
+                    self.max_skew = skew
+                entries = [q.popleft() for q in pending]
+                for entry in entries:
+                    if entry.stamps is not None:
+                        entry.stamps.append(index, entry.frame_id, entry.timestamp, entry.host_time)
+                matched.append((index, entries))
+            else:
+                for camnum, q in enumerate(pending):
+                    if q[0].key < latest - self.tolerance:
+                        orphans.append((camnum, q.popleft()))
+        for camnum, q in enumerate(pending):
+            while len(q) > self.max_pending:
+                orphans.append((camnum, q.popleft()))
+        self._log_orphans(orphans)
+        return matched, orphans
+
+    def _log_orphans(self, orphans):
+        for camnum, entry in orphans:
+            self.orphan_count[camnum] += 1
+            if len(self.orphans) < MAX_LOGGED_ORPHANS:
+                self.orphans.append((camnum, entry.frame_id, entry.timestamp, entry.host_time))
+            if entry.stamps is not None:
+                entry.stamps.append(-1, entry.frame_id, entry.timestamp, entry.host_time)
+
+    # Submit the matched sets and release the orphans, outside the lock since the writer may block
+    def _emit(self, matched, orphans):
+        for index, entries in matched:
+            for camnum, entry in enumerate(entries):
+                self.writer.submit(camnum, self.sinks[camnum].write, index, entry.frame, entry.frame_id,
+                                   entry.timestamp, entry.host_time, nbytes=entry.frame.nbytes,
+                                   release=entry.release, t_start=entry.t_start)
+        for camnum, entry in orphans:
+            entry.release()
+
+    # End of the run: the frames still waiting for a partner are orphans
+    def flush(self):
+        orphans = []
+        with self.lock:
+            for camnum, q in enumerate(self.pending):
+                while q:
+                    orphans.append((camnum, q.popleft()))
+            self._log_orphans(orphans)
+        self._emit([], orphans)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'mode': self.mode,
+                'tolerance_us': self.tolerance / 1e3 if self.mode == 'timestamp' else 0,
+                'sets': self.sets,
+                'orphans': {str(camnum): n for camnum, n in enumerate(self.orphan_count)},
+                'mean_skew_us': self.total_skew / self.sets / 1e3 if self.sets and self.mode == 'timestamp' else 0.0,
+                'max_skew_us': self.max_skew / 1e3 if self.mode == 'timestamp' else 0.0,
+            }
+
+    def print_stats(self):
+        s = self.stats()
+        print('Synchronizer (%s): %d matched sets, max skew %.1f us' % (s['mode'], s['sets'], s['max_skew_us']))
+        for camnum, n in s['orphans'].items():
+            if n:
+                print('  camera %s: %d orphan frames (dropped or duplicated, not written)' % (camnum, n))
+
+    # Statistics and the orphan log (camera, frame ID, device timestamp, host time)
+    def dump(self, path):
+        report = self.stats()
+        with self.lock:
+            report['orphan_frames'] = [list(map(int, o)) for o in self.orphans]
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,106 @@
+import json
+import math
+import threading
+import time
+from collections import deque
+
+# Pre-trigger history of the continuous recording mode (pretrigger_seconds, async mode).
+# PretriggerWriter stands in front of the writer pool: the capture paths and the synchronizer
+# submit their frames to it as they would to the pool. Between events the frames of each camera
+# are held, ring slot included, in a history of its last pre_frames frames, the oldest going
+# back to its ring unwritten when a new one comes in. trigger() hands the history of every
+# camera to the pool and lets the next post_frames frames of each camera through, then the
+# history fills again for the next event. Whatever the length of the run, the memory used is
+# the rings, which hold pre_frames slots more than for a normal run.
+
+
+# Frames covering seconds at rate frames per second
+def frames_for(seconds, rate):
+    return int(math.ceil(seconds * rate))
+
+
+class PretriggerWriter:
+    def __init__(self, writer, num_cameras, pre_frames, post_frames):
+        self.writer = writer
+        self.pre_frames = pre_frames
+        self.post_frames = post_frames
+        self.lock = threading.Lock()
+        # submitted tasks (func, args, nbytes, release, t_start) of each camera, oldest first
+        self.history = [deque() for _ in range(num_cameras)]
+        self.post_remaining = [0] * num_cameras
+        self.discarded = [0] * num_cameras
+        self.events = []
+
+    # Same call as WriterPool.submit
+    def submit(self, camnum, func, *args, nbytes=0, release=None, t_start=None):
+        evicted = None
+        with self.lock:
+            passing = self.post_remaining[camnum] > 0
+            if passing:
+                self.post_remaining[camnum] -= 1
+            else:
+                history = self.history[camnum]
+                history.append((func, args, nbytes, release, t_start))
+                if len(history) > self.pre_frames:
+                    evicted = history.popleft()
+                    self.discarded[camnum] += 1
+        if passing:
+            return self.writer.submit(camnum, func, *args, nbytes=nbytes, release=release, t_start=t_start)
+        if evicted is not None and evicted[3] is not None:
+            evicted[3]()
+        return True
+
+    # Record an event: write the history of every camera and the next post_frames frames.
+    # Blocks while the history is queued (the pool may be full), call it off the capture path.
+    def trigger(self, source=''):
+        host_time = time.monotonic_ns()
+        with self.lock:
+            flushed = [list(history) for history in self.history]
+            for history in self.history:
+                history.clear()
+            self.post_remaining = [self.post_frames] * len(self.history)
+            event = {
+                'event': len(self.events),
+                'source': source,
+                'host_time': host_time,
+                # frame index of the oldest frame written for the event (the first argument of
+                # the sink's write), None for a camera without history
+                'first_index': [tasks[0][1][0] if tasks else None for tasks in flushed],
+                'pre_frames': [len(tasks) for tasks in flushed],
+                'post_frames': self.post_frames,
+            }
+            self.events.append(event)
+        for camnum, tasks in enumerate(flushed):
+            for func, args, nbytes, release, t_start in tasks:
+                self.writer.submit(camnum, func, *args, nbytes=nbytes, release=release, t_start=t_start)
+        return event
+
+    # Give the frames still held back to their rings, at the end of the run
+    def discard(self):
+        with self.lock:
+            flushed = [list(history) for history in self.history]
+            for camnum, history in enumerate(self.history):
+                self.discarded[camnum] += len(history)
+                history.clear()
+        for tasks in flushed:
+            for task in tasks:
+                if task[3] is not None:
+                    task[3]()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'pre_frames': self.pre_frames,
+                'post_frames': self.post_frames,
+                'discarded': list(self.discarded),
+                'events': list(self.events),
+            }
+
+    def print_stats(self):
+        s = self.stats()
+        print('Continuous recording: %d events, %d pre-trigger and %d post-trigger frames each, %s frames discarded'
+              % (len(s['events']), s['pre_frames'], s['post_frames'], '/'.join(str(d) for d in s['discarded'])))
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.stats(), f, indent=2)
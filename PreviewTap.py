@@ -0,0 +1,106 @@
+import threading
+import time
+import numpy as np
+
+# Live preview tap on the acquisition rings.
+# The capture paths offer every frame right after copying it into the ring; the tap keeps one
+# frame per camera every 1 / fps seconds and ignores the others at the cost of a clock read.
+# A kept frame is downsampled by plain decimation to about width pixels before any colour
+# conversion (Bayer frames: one sample of each colour per 2x2 cell, a superpixel debayer), so
+# the copy is a few hundred kilobytes at most. Only the latest frame of each camera is held:
+# a frame the display did not take in time is replaced, never queued.
+
+PREVIEW_WINDOW = 'cam {}'
+# Bayer pattern -> offsets of the red, green and blue samples in a 2x2 cell
+BAYER_OFFSETS = {
+    'BayerRG': ((0, 0), (0, 1), (1, 1)),
+    'BayerGR': ((0, 1), (0, 0), (1, 0)),
+    'BayerGB': ((1, 0), (0, 0), (0, 1)),
+    'BayerBG': ((1, 1), (0, 1), (0, 0)),
+}
+
+
+# Small 8 bit image of frame, step pixels apart: grey for mono formats, BGR for Bayer and RGB
+def downsample(frame, pixel_format, step):
+    bayer = BAYER_OFFSETS.get(pixel_format[:7])
+    if bayer is not None:
+        step += step % 2
+        image = np.stack([frame[y::step, x::step] for y, x in reversed(bayer)], axis=-1)
+    elif frame.ndim == 3:
+        image = frame[::step, ::step]
+        if pixel_format.startswith('RGB'):
+            image = image[..., ::-1]
+    else:
+        image = frame[::step, ::step]
+    if image.dtype != np.uint8:
+        # deeper formats do not always use the full 16 bit range, stretch to the brightest pixel
+        peak = max(int(image.max()), 1)
+        return (image * (255.0 / peak)).astype(np.uint8)
+    # always a copy, the frame goes back to its ring
+    return np.array(image)
+
+
+class PreviewTap:
+    def __init__(self, num_cameras, fps=10.0, width=320):
+        self.period_ns = int(1e9 / fps) if fps > 0 else 0
+        self.width = width
+        self.lock = threading.Lock()
+        self.next_due = [0] * num_cameras
+        # latest (image, frame index, host time) of each camera and its sequence number
+        self.latest = [None] * num_cameras
+        self.sequence = [0] * num_cameras
+        self.shown = [0] * num_cameras
+
+    # True when camera camnum's next frame would be kept
+    def due(self, camnum):
+        return time.monotonic_ns() >= self.next_due[camnum]
+
+    # Called by camera camnum's capture path with every frame, while it still owns the ring slot
+    def offer(self, camnum, frame, pixel_format, index=0):
+        now = time.monotonic_ns()
+        if now < self.next_due[camnum]:
+            return False
+        self.next_due[camnum] = now + self.period_ns
+        step = max(1, -(-frame.shape[1] // self.width))
+        image = downsample(frame, pixel_format, step)
+        with self.lock:
+            self.latest[camnum] = (image, index, now)
+            self.sequence[camnum] += 1
+        return True
+
+    # Latest frame of camera camnum not shown yet, or None
+    def take(self, camnum):
+        with self.lock:
+            if self.sequence[camnum] == self.shown[camnum]:
+                return None
+            self.shown[camnum] = self.sequence[camnum]
+            return self.latest[camnum]
+
+
+# Show the new preview frames, titles holds the window title suffix of every camera.
+# Must run on the thread owning the windows (the main thread on most platforms).
+# OpenCV is imported by the runs showing a preview only.
+def show_preview(tap, titles):
+    import cv2
+    for camnum, title in enumerate(titles):
+        taken = tap.take(camnum)
+        if taken is None:
+            continue
+        image = taken[0]
+        if image.ndim == 2:
+            image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+        height, width = image.shape[:2]
+        # crosshair at the centre of the field
+        cv2.line(image, (width // 2, 0), (width // 2, height), (0, 0, 255), 1)
+        cv2.line(image, (0, height // 2), (width, height // 2), (0, 0, 255), 1)
+        cv2.imshow(PREVIEW_WINDOW.format(title), image)
+
+
+# Wait for the capture threads while showing their preview, returns once they are all done
+def wait_with_preview(threads, tap, titles):
+    import cv2
+    interval_ms = max(1, tap.period_ns // 2000000)
+    while any(t.is_alive() for t in threads):
+        show_preview(tap, titles)
+        cv2.waitKey(interval_ms)
+    cv2.destroyAllWindows()
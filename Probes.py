@@ -0,0 +1,172 @@
+import json
+import threading
+
+# Always-on timing probes of the capture hot path.
+# Each camera keeps one histogram per stage (trigger, grab, print, copy, enqueue, write)
+# and one of the grabs of the incomplete frames dropped by the capture loops (incomplete)
+# and of the grabs timing out on a lost software triggered frame (timeout)
+# of durations measured with time.monotonic_ns(). Histograms are log-linear (4 buckets per
+# power of two, ~19% resolution) in a fixed list, so recording a sample is a few integer
+# operations and memory does not grow with the run length.
+
+NUM_BUCKETS = 256
+
+
+def bucket_index(ns):
+    if ns < 8:
+        return max(ns, 0)
+    shift = ns.bit_length() - 3
+    return min(8 + (shift - 1) * 4 + (ns >> shift) - 4, NUM_BUCKETS - 1)
+
+
+# Smallest duration falling in bucket index
+def bucket_lower(index):
+    if index < 8:
+        return index
+    shift = (index - 8) // 4 + 1
+    return (4 + (index - 8) % 4) << shift
+
+
+class StageHistogram:
+    def __init__(self):
+        self.buckets = [0] * NUM_BUCKETS
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def record(self, ns):
+        self.buckets[bucket_index(ns)] += 1
+        self.count += 1
+        self.total += ns
+        if self.min is None or ns < self.min:
+            self.min = ns
+        if ns > self.max:
+            self.max = ns
+
+    # Add the samples of another histogram (e.g. recorded in a camera process)
+    def merge(self, other):
+        for index, n in enumerate(other.buckets):
+            self.buckets[index] += n
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        self.max = max(self.max, other.max)
+
+    # Upper bound of the bucket holding quantile q, in ns
+    def percentile(self, q):
+        if not self.count:
+            return 0
+        rank = q * self.count
+        seen = 0
+        for index, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= rank:
+                return min(bucket_lower(index + 1), self.max)
+        return self.max
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'mean_us': self.total / self.count / 1e3 if self.count else 0.0,
+            'min_us': (self.min or 0) / 1e3,
+            'p50_us': self.percentile(0.50) / 1e3,
+            'p90_us': self.percentile(0.90) / 1e3,
+            'p99_us': self.percentile(0.99) / 1e3,
+            'max_us': self.max / 1e3,
+            'total_s': self.total / 1e9,
+        }
+
+
+# Stage histograms of one camera. Capture stages are recorded by the camera's capture
+# thread only (the trigger stage by the trigger broadcaster when there is one), the write
+# stage is recorded by the writer pool under its lock. A camera process records its capture
+# stages on its own, they are merged into the parent's registry at the end of the run.
+# Stages are added as they are first recorded, under the lock, so that a snapshot taken
+# during the run (ThreadProbeReporter) iterates a copy of them.
+class CameraProbe:
+    def __init__(self, camnum):
+        self.camnum = camnum
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    def stage(self, stage):
+        hist = self.stages.get(stage)
+        if hist is None:
+            with self.lock:
+                hist = self.stages.setdefault(stage, StageHistogram())
+        return hist
+
+    def record(self, stage, ns):
+        hist = self.stages.get(stage)
+        if hist is None:
+            hist = self.stage(stage)
+        hist.record(ns)
+
+    # stages maps stage names to StageHistograms, as CameraProbe.stages
+    def merge(self, stages):
+        for stage, other in stages.items():
+            self.stage(stage).merge(other)
+
+    def as_dict(self):
+        with self.lock:
+            stages = list(self.stages.items())
+        return {stage: hist.as_dict() for stage, hist in stages}
+
+
+class ProbeRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cameras = {}
+
+    def camera(self, camnum):
+        with self.lock:
+            probe = self.cameras.get(camnum)
+            if probe is None:
+                probe = self.cameras[camnum] = CameraProbe(camnum)
+            return probe
+
+    def reset(self):
+        with self.lock:
+            self.cameras = {}
+
+    def snapshot(self):
+        with self.lock:
+            cameras = dict(self.cameras)
+        return {str(camnum): probe.as_dict() for camnum, probe in sorted(cameras.items())}
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.snapshot(), f, indent=2)
+
+    def print_summary(self):
+        for camnum, stages in self.snapshot().items():
+            print('Camera %s stage timings (us):' % camnum)
+            for stage, h in stages.items():
+                print('  %-8s n=%-6d mean %9.1f  p50 %9.1f  p99 %9.1f  max %9.1f' %
+                      (stage, h['count'], h['mean_us'], h['p50_us'], h['p99_us'], h['max_us']))
+
+
+# Registry shared by the capture threads and the writer pool
+PROBES = ProbeRegistry()
+
+
+# Writes a snapshot of the registry to a JSON file every interval seconds,
+# to watch the stage timings live during a run
+class ThreadProbeReporter(threading.Thread):
+    def __init__(self, registry, path, interval=1.0):
+        threading.Thread.__init__(self, daemon=True)
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.registry.dump(self.path)
+        self.registry.dump(self.path)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
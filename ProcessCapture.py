@@ -0,0 +1,526 @@
+import os
+import sys
+import time
+import threading
+import multiprocessing
+from collections import deque
+import AcquisitionMultipleCamera as acq
+from Config import get_config
+from CameraBackend import get_system, CameraHandles, CAMERA_ERRORS, is_grab_timeout
+from FrameRing import SharedFrameRing
+from FrameLog import LogHandles
+from Probes import PROBES, ThreadProbeReporter
+from Timestamps import TimestampLog, timestamp_path, estimate_clock
+from TriggerScheduler import TriggerTimetable, READY_TIMEOUT as LOCK_STEP_TIMEOUT
+from PreviewTap import wait_with_preview
+
+# Process-per-camera acquisition (acquisition_mode: processes).
+# Every camera is owned by its own process, which opens the camera system, configures its
+# camera and runs the trigger / grab / copy loop, so the per-frame Python work of the cameras
+# no longer competes for one GIL. The processes are spawned, not forked (no driver state is
+# inherited, and it is the only start method on Windows).
+# Frames are copied once from the driver buffer into a shared memory ring (SharedFrameRing)
+# created by this process. Only the slot number and the frame metadata go through the
+# camera's data pipe, frames are never pickled. Here a receiver thread per camera hands the
+# frames to the writer pool and the synchronizer as the capture threads do, and gives the
+# slots back over the camera's control pipe once the frames are written.
+#
+# Messages, camera process -> parent (data pipe):
+#   ('ready', info)       camera configured, info holds serial, width, height, pixel_format
+#   ('streaming',)        acquisition started
+#   ('frame', slot, index, frame_id, timestamp, host_time, t_start)
+#   ('error', text)
+#   ('done', status)      end of the capture, status holds the CPU time, lost frames,
+#                         missed trigger slots and the stage timings of the process
+# parent -> camera process (control pipe):
+#   ('start', ring spec)  map the ring and begin acquiring
+#   ('go', start_ns)      first trigger slot of the common timetable
+#   ('release', slot)     frame written, the slot is free again
+#   ('stop',)
+#
+# Software triggers cannot be fired from one thread across processes: with trigger_broadcast
+# every process triggers its camera on the same timetable (TriggerTimetable with the start
+# given by 'go', the monotonic clock is system wide), in lock step like the broadcaster (see
+# LockStep), so the cameras skip the same late slots and frame IDs stay aligned.
+
+# Longest wait of a camera process for a free ring slot or a control message
+CONTROL_TIMEOUT = 1.0
+# Longest wait for the camera processes to configure their camera
+READY_TIMEOUT = 60.0
+# Delay between the 'go' message and the first trigger slot
+START_DELAY_NS = 100000000
+
+
+# Lock step of the camera processes, the counterpart of the broadcaster's ready flags: each
+# process waits at the barrier until every camera has delivered its previous frame, the first
+# one out picks the next slot of the timetable for all of them. If a camera stops or stalls for
+# LOCK_STEP_TIMEOUT the barrier breaks and every process goes on with its own timetable.
+class LockStep:
+    def __init__(self, barrier, slot):
+        self.barrier = barrier
+        # shared multiprocessing.Value holding the slot picked for the next trigger
+        self.slot = slot
+        self.broken = False
+
+    def wait(self, timetable):
+        if not self.broken:
+            try:
+                if self.barrier.wait(LOCK_STEP_TIMEOUT) == 0:
+                    self.slot.value = timetable.next_slot()
+                self.barrier.wait(LOCK_STEP_TIMEOUT)
+                return timetable.sleep_until(self.slot.value)
+            except threading.BrokenBarrierError:
+                self.broken = True
+        return timetable.wait()
+
+    # This camera stops triggering, do not keep the others waiting
+    def abort(self):
+        self.broken = True
+        self.barrier.abort()
+
+
+# Capture loop of a camera process, talking to the parent over the data and control pipes
+class CameraWorker:
+    def __init__(self, camnum, handles, data, control):
+        self.camnum = camnum
+        self.handles = handles
+        self.cam = handles.cam
+        self.data = data
+        self.control = control
+        self.free = deque()
+        self.stopping = False
+        self.missed_slots = 0
+
+    # Handle the control messages waiting, for up to timeout seconds for the first one.
+    # Returns the first message other than a slot release or a stop.
+    def poll(self, timeout=0.0):
+        try:
+            while self.control.poll(timeout):
+                message = self.control.recv()
+                if message[0] == 'release':
+                    self.free.append(message[1])
+                elif message[0] == 'stop':
+                    self.stopping = True
+                else:
+                    return message
+                timeout = 0.0
+        except (EOFError, OSError):
+            # the parent is gone
+            self.stopping = True
+        return None
+
+    def wait_for(self, kind):
+        while not self.stopping:
+            message = self.poll(CONTROL_TIMEOUT)
+            if message is not None and message[0] == kind:
+                return message
+        return None
+
+    # Free ring slot, None when stopped
+    def acquire(self):
+        self.poll()
+        while not self.free and not self.stopping:
+            self.poll(CONTROL_TIMEOUT)
+        if self.stopping:
+            return None
+        return self.free.popleft()
+
+    # lock_step is the LockStep of the run's processes, None when they trigger as fast as they can
+    def run(self, num_images, framerate, lock_step):
+        start = self.wait_for('start')
+        if start is None:
+            if lock_step is not None:
+                lock_step.abort()
+            return False
+        ring = SharedFrameRing.attach(start[1])
+        self.free.extend(range(len(ring)))
+        try:
+            return self.capture(ring, num_images, framerate, lock_step)
+        finally:
+            if lock_step is not None:
+                lock_step.abort()
+            ring.close()
+
+    def capture(self, ring, num_images, framerate, lock_step):
+        camnum = self.camnum
+        probe = PROBES.camera(camnum)
+        primary = camnum == 0
+        trigger_software = self.handles.trigger_software
+        software_trigger = framerate != 'hardware'
+        if software_trigger and trigger_software is None:
+            self.data.send(('error', 'Unable to execute trigger. Aborting...'))
+            return False
+        get_next_image = self.cam.GetNextImage
+        # a software triggered frame lost leaves its index empty instead of blocking the process
+        grab_timeout = acq.grab_timeout_ms(framerate) if software_trigger else None
+        frame_info = self.handles.frame_info
+        send = self.data.send
+        next_progress = 0
+        print('Camera %d serial number set to %s...' % (camnum, self.handles.serial))
+
+        self.cam.BeginAcquisition()
+        send(('streaming',))
+        go = self.wait_for('go')
+        if go is None:
+            self.cam.EndAcquisition()
+            return False
+        timetable = None
+        if software_trigger and lock_step is not None:
+            timetable = TriggerTimetable(int(1e9 / float(framerate)), go[1])
+
+        result = True
+        for i in range(num_images):
+            try:
+                if timetable is not None:
+                    lock_step.wait(timetable)
+                t_start = time.monotonic_ns()
+
+                #  Retrieve next received image
+                if software_trigger:
+                    trigger_software()
+                    t_trigger = time.monotonic_ns()
+                    probe.record('trigger', t_trigger - t_start)
+                else:
+                    t_trigger = t_start
+                try:
+                    image_result = get_next_image(grab_timeout)
+                except CAMERA_ERRORS as ex:
+                    if grab_timeout is None or not is_grab_timeout(ex):
+                        raise
+                    probe.record('timeout', time.monotonic_ns() - t_trigger)
+                    self.poll()
+                    if self.stopping:
+                        break
+                    continue
+                t_grab = time.monotonic_ns()
+                probe.record('grab', t_grab - t_trigger)
+                # an incomplete frame (packets lost on the link) is dropped, its index stays empty
+                if image_result.IsIncomplete():
+                    image_result.Release()
+                    probe.record('incomplete', t_grab - t_trigger)
+                    continue
+
+                # Copy the frame into the shared ring and give the buffer back to the driver at once
+                slot = self.acquire()
+                if slot is None:
+                    image_result.Release()
+                    break
+                ring.copy_in(slot, image_result.GetNDArray())
+                frame_id, timestamp = frame_info(image_result)
+                image_result.Release()
+                t_copy = time.monotonic_ns()
+                probe.record('copy', t_copy - t_grab)
+
+                send(('frame', slot, i, frame_id, timestamp, t_grab, t_start))
+                t_enqueue = time.monotonic_ns()
+                probe.record('enqueue', t_enqueue - t_copy)
+
+                if primary and (t_enqueue >= next_progress or i + 1 == num_images):
+                    print('COLLECTING IMAGE ' + str(i + 1) + ' of ' + str(num_images), end='\r')
+                    sys.stdout.flush()
+                    next_progress = t_enqueue + acq.PROGRESS_INTERVAL_NS
+                    probe.record('print', time.monotonic_ns() - t_enqueue)
+
+            except CAMERA_ERRORS as ex:
+                send(('error', str(ex)))
+                result = False
+                break
+
+        if timetable is not None:
+            self.missed_slots = timetable.missed_slots
+        self.cam.EndAcquisition()
+        return result
+
+
+# Entry point of a camera process: open the camera with the given serial number on the
+# configured backend, configure it and run the capture loop
+def camera_process_main(camnum, serial, options, data, control):
+    if options.get('quiet'):
+        sys.stdout = open(os.devnull, 'w')
+    cpu_start = time.process_time()
+    system = get_system(options['backend'], options['settings'])
+    cam_list = system.GetCameras()
+    status = {'lost_frames': 0, 'missed_slots': 0}
+    try:
+        cams = [cam for cam in cam_list if cam.GetSerial() == serial]
+        if not cams:
+            data.send(('error', 'Camera %s not found' % serial))
+            return
+        cam = cams[0]
+        cam.Init()
+        try:
+            if not acq.configure_cam(cam, options['framerate']):
+                data.send(('error', 'Unable to configure camera %s' % serial))
+                return
+            handles = CameraHandles(cam)
+            data.send(('ready', {'serial': handles.serial, 'width': handles.width, 'height': handles.height,
+                                 'pixel_format': handles.pixel_format}))
+            worker = CameraWorker(camnum, handles, data, control)
+            lock_step = None
+            if options['barrier'] is not None:
+                lock_step = LockStep(options['barrier'], options['slot'])
+            worker.run(options['num_images'], options['framerate'], lock_step)
+            status['lost_frames'] = getattr(cam, 'lost_frames', 0)
+            status['missed_slots'] = worker.missed_slots
+        finally:
+            cam.DeInit()
+    except CAMERA_ERRORS as ex:
+        data.send(('error', str(ex)))
+    finally:
+        del cam_list
+        system.ReleaseInstance()
+        status['cpu_time'] = time.process_time() - cpu_start
+        status['stages'] = PROBES.camera(camnum).stages
+        try:
+            data.send(('done', status))
+        except OSError:
+            pass
+
+
+# Parent side of a camera process: spawns it, and once started receives its frames and
+# queues them for writing like ThreadCapture does (same stamps, clock, cpu_time and finish).
+class ThreadCameraProcess(threading.Thread):
+    def __init__(self, context, camnum, serial, options):
+        threading.Thread.__init__(self, daemon=True)
+        self.camnum = camnum
+        self.serial = serial
+        self.num_images = options['num_images']
+        # the lock step barrier is freed with its last reference here, keep it for the whole run
+        self.options = options
+        self.data, child_data = context.Pipe(duplex=False)
+        child_control, self.control = context.Pipe(duplex=False)
+        self.control_lock = threading.Lock()
+        self.process = context.Process(target=camera_process_main, name='Camera%d' % camnum, daemon=True,
+                                       args=(camnum, serial, options, child_data, child_control))
+        self.process.start()
+        # only the child holds these ends now, so the pipes report EOF when it exits
+        child_data.close()
+        child_control.close()
+        self.handles = None
+        self.writer = None
+        self.ring = None
+        self.sink = None
+        self.sync = None
+        self.preview = None
+        self.done = False
+        self.stamps = None
+        self.clock = None
+        # figures of the camera process, known once it is done
+        self.cpu_time = 0.0
+        self.lost_frames = 0
+        self.missed_slots = 0
+
+    def send(self, *message):
+        with self.control_lock:
+            if self.done:
+                return
+            try:
+                self.control.send(message)
+            except OSError:
+                self.done = True
+
+    def stop(self):
+        self.send('stop')
+
+    # Next message of the camera process, errors are printed; None once it is done
+    def receive(self, timeout=None):
+        while True:
+            try:
+                if timeout is not None and not self.data.poll(timeout):
+                    print('Camera %d: no answer from the camera process' % self.camnum)
+                    return None
+                message = self.data.recv()
+            except (EOFError, OSError):
+                print('Camera %d: the camera process ended unexpectedly' % self.camnum)
+                self.done = True
+                return None
+            if message[0] == 'error':
+                print('Camera %d error : %s' % (self.camnum, message[1]))
+            elif message[0] == 'done':
+                self._done(message[1])
+                return None
+            else:
+                return message
+
+    def _done(self, status):
+        with self.control_lock:
+            self.done = True
+        self.cpu_time = status.get('cpu_time', 0.0)
+        self.lost_frames = status.get('lost_frames', 0)
+        self.missed_slots = status.get('missed_slots', 0)
+        PROBES.camera(self.camnum).merge(status.get('stages', {}))
+
+    # Camera description once the process has configured its camera, None if it failed
+    def wait_ready(self, timeout=READY_TIMEOUT):
+        message = self.receive(timeout)
+        if message is None or message[0] != 'ready':
+            return None
+        self.handles = LogHandles(message[1])
+        return self.handles
+
+    # Give the camera process its ring, returns True once the camera streams
+    def begin(self, writer, ring, sink, sync=None, preview=None):
+        self.writer = writer
+        self.ring = ring
+        self.sink = sink
+        self.sync = sync
+        self.preview = preview
+        self.send('start', ring.spec())
+        message = self.receive(READY_TIMEOUT)
+        return message is not None and message[0] == 'streaming'
+
+    def release(self, slot):
+        self.send('release', slot)
+
+    def run(self):
+        camnum = self.camnum
+        # frame timestamps, written to <file_name>_t<N>.bin unless the output holds them (raw frame log)
+        path = None if self.sink.records_timestamps else timestamp_path(get_config().filename, camnum)
+        stamps = self.stamps = TimestampLog(path, self.num_images)
+        frames = self.ring.frames
+        write = self.sink.write
+        submit = self.writer.submit
+        sync = self.sync
+        preview = self.preview
+        pixel_format = self.handles.pixel_format
+        release = self.release
+
+        while True:
+            message = self.receive()
+            if message is None:
+                break
+            if message[0] != 'frame':
+                continue
+            _, slot, index, frame_id, timestamp, host_time, t_start = message
+            frame = frames[slot]
+            # the slot is not released before the frame is queued, the preview can still read it
+            if preview is not None:
+                preview.offer(camnum, frame, pixel_format, index)
+            if sync is None:
+                stamps.append(index, frame_id, timestamp, host_time)
+                submit(camnum, write, index, frame, frame_id, timestamp, host_time,
+                       nbytes=frame.nbytes, release=lambda slot=slot: release(slot), t_start=t_start)
+            else:
+                sync.push(camnum, frame, frame_id, timestamp, host_time,
+                          lambda slot=slot: release(slot), t_start, stamps)
+
+        if sync is None:
+            self.finish()
+        else:
+            sync.end(camnum)
+
+    # Save the remaining frame times and fit the camera clock to the host clock
+    def finish(self):
+        self.stamps.close()
+        recorded = self.stamps.recorded()
+        self.clock = estimate_clock(recorded['timestamp'], recorded['host_time'])
+
+    def close(self):
+        self.process.join(READY_TIMEOUT)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.data.close()
+        self.control.close()
+
+
+# Spawn one camera process per serial number. backend and settings select the camera system
+# the processes open. Arguments left to None take their params.yaml value (num_images,
+# framerate, camera_backend and simulation).
+def start_camera_processes(serials, num_images=None, framerate=None, backend=None, settings=None, quiet=False):
+    config = get_config()
+    num_images = config.num_images if num_images is None else num_images
+    framerate = config.framerate if framerate is None else framerate
+    backend = config.camera_backend if backend is None else backend
+    settings = dict(config.simulation if settings is None else settings)
+    if settings.get('trigger_epoch_ns') is None:
+        # one hardware trigger line for the simulated cameras of all the processes
+        settings['trigger_epoch_ns'] = time.monotonic_ns()
+    context = multiprocessing.get_context('spawn')
+    options = {
+        'backend': backend,
+        'settings': settings,
+        'num_images': num_images,
+        'framerate': framerate,
+        'barrier': None,
+        'slot': None,
+        'quiet': quiet,
+    }
+    if framerate != 'hardware' and config.trigger_broadcast:
+        options['barrier'] = context.Barrier(len(serials))
+        options['slot'] = context.Value('q', 0, lock=False)
+    return [ThreadCameraProcess(context, camnum, serial, options) for camnum, serial in enumerate(serials)]
+
+
+# Bring the camera processes up and start the capture: once every process has configured its
+# camera, map a shared ring and open a sink per camera, then give the common start time once
+# every camera streams. Returns the rings and the synchronizer of the run (see make_sync), or
+# None after stopping the processes when a camera failed to start. None arguments as above,
+# preview is the run's PreviewTap.
+def capture_with_processes(procs, writer, store, mode=None, framerate=None, slots=None, preview=None):
+    config = get_config()
+    mode = config.sync_mode if mode is None else mode
+    framerate = config.framerate if framerate is None else framerate
+    slots = config.ring_slots if slots is None else slots
+    rings, sinks = [], []
+    for proc in procs:
+        handles = proc.wait_ready()
+        if handles is None:
+            break
+        rings.append(acq.make_frame_ring(handles, slots, SharedFrameRing))
+        sinks.append(store.sink(proc.camnum, handles))
+    else:
+        sync = acq.make_sync(writer, sinks, mode, framerate=framerate)
+        if all(proc.begin(writer, rings[i], sinks[i], sync, preview) for i, proc in enumerate(procs)):
+            for proc in procs:
+                proc.start()
+            start_ns = time.monotonic_ns() + START_DELAY_NS
+            for proc in procs:
+                proc.send('go', start_ns)
+            return rings, sync
+
+    for proc in procs:
+        proc.stop()
+        proc.close()
+    for ring in rings:
+        ring.close()
+    return None
+
+
+# acquisition_mode: processes counterpart of run_multiple_cameras. The cameras of cam_list are
+# only used for their serial numbers, each camera process opens its own.
+def run_camera_processes(cam_list):
+    config = get_config()
+    writer = acq.make_writer_pool()
+    store = acq.make_store()
+    PROBES.reset()
+    reporter = None
+    if config.probe_live_interval:
+        reporter = ThreadProbeReporter(PROBES, config.filename + '_probes.json', config.probe_live_interval)
+        reporter.start()
+
+    procs = start_camera_processes([cam.GetSerial() for cam in cam_list])
+    tap = acq.make_preview_tap(len(procs))
+    started = capture_with_processes(procs, writer, store, preview=tap)
+    if started is None:
+        print('Unable to start the camera processes. Aborting...')
+        writer.close()
+        store.close()
+        if reporter is not None:
+            reporter.stop()
+        return False
+    rings, sync = started
+    for proc in procs:
+        print('Camera %d started acquiring images...' % proc.camnum)
+
+    if tap is not None:
+        wait_with_preview(procs, tap, [proc.handles.serial for proc in procs])
+    for proc in procs:
+        proc.join()
+    acq.finish_run(procs, writer, store, sync, reporter)
+    for proc in procs:
+        if proc.missed_slots:
+            print('Camera %d: %d trigger slots missed' % (proc.camnum, proc.missed_slots))
+        proc.close()
+    for ring in rings:
+        ring.close()
+    return True
@@ -0,0 +1,145 @@
+import json
+import threading
+import time
+import numpy as np
+from TriggerScheduler import TriggerTimetable
+
+# Sensor channels recorded alongside the frames (load, voltage, ...).
+# <file_name>_sensors.bin holds one record per sample: the host time.monotonic_ns() of the
+# reading, the clock of the frame host times, and one float32 value per channel, 8 + 4 bytes
+# per channel. <file_name>_sensors.json gives the channel names, units and sample rate.
+# The sampling thread only wakes up to read the channels and copy one record into its block,
+# which is written out every SENSOR_BLOCK samples, so kHz sampling costs the capture threads
+# a few microseconds of interpreter time per sample.
+#
+# Read a recording back with read_sensors, then sensors.at(times) gives the channels at any
+# host times and sensors.at_frames(frames, clock) at the exposure of every frame of a camera.
+
+SENSOR_BLOCK = 4096
+
+
+def sensor_path(filename):
+    return filename + '_sensors.bin'
+
+
+def sensor_header_path(filename):
+    return filename + '_sensors.json'
+
+
+def sensor_dtype(num_channels):
+    return np.dtype([('host_time', '<i8'), ('values', '<f4', (num_channels,))])
+
+
+# Sensor records of a run, appended to <filename>_sensors.bin every block samples
+class SensorLog:
+    def __init__(self, filename, names, units=None, sample_rate=0.0, block=SENSOR_BLOCK):
+        self.names = list(names)
+        self.units = list(units) if units is not None else [''] * len(self.names)
+        self.records = np.zeros(block, dtype=sensor_dtype(len(self.names)))
+        self.count = 0
+        self.samples = 0
+        self.file = None
+        if filename:
+            with open(sensor_header_path(filename), 'w') as f:
+                json.dump({'channels': self.names, 'units': self.units, 'sample_rate': sample_rate}, f, indent=2)
+            self.file = open(sensor_path(filename), 'wb')
+
+    def append(self, host_time, values):
+        record = self.records[self.count]
+        record['host_time'] = host_time
+        record['values'] = values
+        self.count += 1
+        self.samples += 1
+        if self.count == len(self.records):
+            self.flush()
+
+    def flush(self):
+        if self.file is not None and self.count:
+            self.file.write(self.records[:self.count].tobytes())
+            self.file.flush()
+        self.count = 0
+
+    def close(self):
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+# Samples the channels names at sample_rate into <filename>_sensors.bin until stop().
+# Subclasses implement read(), returning the values of the channels or None when there is no
+# reading yet, and may extend on_sample(host_time, values), called after every sample.
+class ThreadSensorRecorder(threading.Thread):
+    def __init__(self, filename, names, units=None, sample_rate=1000.0):
+        threading.Thread.__init__(self, daemon=True)
+        self.period_ns = int(1e9 / float(sample_rate))
+        self.log = SensorLog(filename, names, units, float(sample_rate))
+        self.stopping = threading.Event()
+        self.missed_samples = 0
+
+    def read(self):
+        raise NotImplementedError
+
+    def on_sample(self, host_time, values):
+        pass
+
+    def run(self):
+        timetable = TriggerTimetable(self.period_ns, spin_ns=0)
+        log = self.log
+        while not self.stopping.is_set():
+            timetable.wait()
+            values = self.read()
+            if values is None:
+                continue
+            host_time = time.monotonic_ns()
+            log.append(host_time, values)
+            self.on_sample(host_time, values)
+        self.missed_samples = timetable.missed_slots
+        log.close()
+
+    def stop(self):
+        self.stopping.set()
+
+
+class SensorData:
+    def __init__(self, names, units, sample_rate, records):
+        self.names = names
+        self.units = units
+        self.sample_rate = sample_rate
+        self.host_time = records['host_time']
+        self.values = records['values']
+
+    def __len__(self):
+        return len(self.host_time)
+
+    # Samples of a channel, by name or number
+    def channel(self, channel=0):
+        if not isinstance(channel, int):
+            channel = self.names.index(channel)
+        return self.values[:, channel]
+
+    # Channel linearly interpolated at host times (ns), NaN outside the recording
+    def at(self, host_times, channel=0):
+        return np.interp(np.asarray(host_times, dtype=np.float64), self.host_time.astype(np.float64),
+                         self.channel(channel).astype(np.float64), left=np.nan, right=np.nan)
+
+    # Channel at the middle of the exposure of every frame of a camera (a FrameReader
+    # CameraFrames), NaN for the frames not recorded. clock is the camera ClockModel (see
+    # load_clocks), without one the host arrival times of the frames are used, later than the
+    # exposure by the exposure and transfer time.
+    def at_frames(self, frames, clock=None, channel=0, exposure_us=0.0):
+        times = np.asarray(frames.host_time)
+        timestamp = np.asarray(frames.timestamp).astype(np.int64)
+        if clock is not None:
+            # frames without a device timestamp (chunk_timestamps off) keep their arrival time
+            times = np.where(timestamp > 0, clock.to_host(timestamp) + int(exposure_us * 500), times)
+        values = self.at(times, channel)
+        values[~np.asarray(frames.valid, dtype=bool)] = np.nan
+        return values
+
+
+def read_sensors(filename):
+    with open(sensor_header_path(filename)) as f:
+        header = json.load(f)
+    records = np.fromfile(sensor_path(filename), dtype=sensor_dtype(len(header['channels'])))
+    return SensorData(header['channels'], header['units'], header['sample_rate'], records)
@@ -0,0 +1,278 @@
+import argparse
+import itertools
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from CameraBackend import get_system, CameraHandles, CAMERA_ERRORS
+from CameraSetup import configure_nodes
+from Config import get_config
+
+# Stream buffer and USB bandwidth tuning of the connected cameras.
+# A run moves frames from the sensor over the USB link (DeviceLinkThroughputLimit, shared by
+# the cameras of a bus) into the stream buffers of the driver (StreamBufferCountManual, and
+# StreamBufferHandlingMode saying which frame goes when they are all full), where the
+# capture loop picks them up. Too few buffers and a stalled capture loop loses frames, link
+# limits adding up to more than the bus give incomplete frames, and a limit below what the
+# camera produces makes the camera drop frames.
+#
+# The tuner streams every combination of --buffer-counts, --handling-modes and --link-limits
+# on all the cameras at once, for --seconds each, with the trigger, frame rate and file
+# format of params.yaml and the frames written through the writer pool (to a temporary
+# directory) as in a run. It counts per camera the frames delivered, lost (gaps in the
+# frame IDs) and incomplete, and the MB/s delivered. The best combination is the one missing
+# the fewest frames, then with the fewest buffers and the lowest link limits (room left on
+# the bus). It is written per camera serial to the stream_tuning
+# section of params.yaml, which configure_cam applies over the stream_buffer_count,
+# stream_buffer_handling and link_throughput_limit_mbps defaults.
+#
+#   python StreamTuner.py --seconds 5
+#
+# With camera_backend: simulated, the simulated cameras model the link (simulation
+# link_bandwidth_mbps and device_buffer_frames, see CameraBackend.SimulatedLink). Link
+# limits default to 1.25 and 2 times the bandwidth a camera needs, and the limit it has.
+
+TUNER_DEFAULTS = {
+    'buffer_counts': [10, 30, 100],
+    'handling_modes': ['OldestFirst', 'NewestOnly'],
+    'seconds': 5.0,
+}
+# auto link limits, times the bandwidth a camera needs, then the camera's own limit
+LINK_LIMIT_FACTORS = (1.25, 2.0)
+# written to DeviceLinkThroughputLimit to read the camera's maximum back, integer nodes are
+# clamped to their range
+LINK_LIMIT_MAX = 10 ** 12
+GRAB_TIMEOUT_MS = 1000
+
+
+# Frames of one camera for a tuning measurement: grabbed, copied to the ring and written as
+# in a run, with the losses counted from the frame IDs
+class ThreadStreamProbe(threading.Thread):
+    def __init__(self, handles, camnum, writer, ring, sink, num_frames, broadcaster=None):
+        threading.Thread.__init__(self, daemon=True)
+        self.handles = handles
+        self.cam = handles.cam
+        self.camnum = camnum
+        self.writer = writer
+        self.ring = ring
+        self.sink = sink
+        self.num_frames = num_frames
+        self.broadcaster = broadcaster
+        self.received = 0
+        self.incomplete = 0
+        self.errors = 0
+        self.first_id = None
+        self.last_id = None
+        self.nbytes = 0
+        self.seconds = 0.0
+
+    def run(self):
+        ready = self.broadcaster.ready if self.broadcaster is not None else None
+        frame_info = self.handles.frame_info
+        ring = self.ring
+        self.cam.BeginAcquisition()
+        if ready is not None:
+            ready(self.camnum)
+        start = time.monotonic()
+        try:
+            for i in range(self.num_frames):
+                try:
+                    image = self.cam.GetNextImage(GRAB_TIMEOUT_MS)
+                except CAMERA_ERRORS:
+                    # no frame within the timeout, the stream has stalled
+                    self.errors += 1
+                    break
+                if ready is not None:
+                    ready(self.camnum)
+                if image.IsIncomplete():
+                    self.incomplete += 1
+                    image.Release()
+                    continue
+                slot = ring.acquire()
+                frame = ring.copy_in(slot, image.GetNDArray())
+                frame_id, timestamp = frame_info(image)
+                image.Release()
+                if self.first_id is None:
+                    self.first_id = frame_id
+                self.last_id = frame_id
+                self.received += 1
+                self.nbytes += frame.nbytes
+                self.writer.submit(self.camnum, self.sink.write, i, frame, frame_id, timestamp, time.monotonic_ns(),
+                                   nbytes=frame.nbytes, release=lambda slot=slot: ring.release(slot))
+        finally:
+            self.seconds = time.monotonic() - start
+            self.cam.EndAcquisition()
+
+    # Frames the camera produced and never delivered, from the gaps in the frame IDs
+    def lost(self):
+        if self.first_id is None:
+            return 0
+        return max(0, int(self.last_id) - int(self.first_id) + 1 - self.received - self.incomplete)
+
+    def stats(self):
+        return {
+            'received': self.received,
+            'lost': self.lost(),
+            'incomplete': self.incomplete,
+            'stalled': self.errors,
+            'fps': self.received / self.seconds if self.seconds else 0.0,
+            'mb_per_s': self.nbytes / 1e6 / self.seconds if self.seconds else 0.0,
+        }
+
+
+# Bandwidth a camera needs at rate frames per second, in MB/s
+def needed_mbps(handles, rate):
+    import AcquisitionMultipleCamera as acq
+    ring = acq.make_frame_ring(handles, 1)
+    return ring.frames[0].nbytes * rate / 1e6
+
+
+# Stream one combination on all the cameras: settings are the stream settings per serial
+def measure(cam_list, handles, settings, num_frames, framerate):
+    import AcquisitionMultipleCamera as acq
+    from FrameStore import open_store
+
+    config = get_config()
+    # the nodes go straight to the cameras, not to their user set
+    for i, cam in enumerate(cam_list):
+        serial = handles[i].serial
+        config.stream_tuning[serial] = settings[serial]
+        if not configure_nodes(cam, acq.camera_settings(framerate, serial, acq.sensor_size(cam))):
+            return None
+    workdir = tempfile.mkdtemp(prefix='dic_tune_')
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        writer = acq.make_writer_pool()
+        store = open_store(config.file_format, 'tune', config.container_chunk_frames, config.container_compression,
+                           num_frames, config.container_compression_level, config.container_shuffle)
+        broadcaster = acq.make_trigger_broadcaster(handles, framerate, num_frames)
+        probes = [ThreadStreamProbe(h, i, writer, acq.make_frame_ring(h), store.sink(i, h), num_frames, broadcaster)
+                  for i, h in enumerate(handles)]
+        for probe in probes:
+            probe.start()
+        if broadcaster is not None:
+            broadcaster.start()
+        for probe in probes:
+            probe.join()
+        if broadcaster is not None:
+            broadcaster.stop()
+            broadcaster.join()
+        writer.close()
+        store.close()
+        written = writer.stats()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+    results = []
+    for i, probe in enumerate(probes):
+        result = probe.stats()
+        result['dropped_writer'] = written.get(i, {}).get('dropped', 0)
+        results.append(result)
+    return results
+
+
+# Lower is better: frames missing, then buffers and link limits. Combinations missing no frame
+# all deliver what the cameras produce.
+def score(candidate, results):
+    missing = sum(r['lost'] + r['incomplete'] + r['dropped_writer'] + r['stalled'] for r in results)
+    return missing, candidate['buffer_count'], candidate['link']
+
+
+# Write the stream settings per serial to the stream_tuning section of params.yaml,
+# keeping its comments
+def save_tuning(path, tuning):
+    import ruamel.yaml
+    yaml = ruamel.yaml.YAML()
+    with open(path) as f:
+        cfg = yaml.load(f)
+    cfg['stream_tuning'] = tuning
+    with open(path, 'w') as f:
+        yaml.dump(cfg, f)
+
+
+def tune(buffer_counts, handling_modes, link_limits=None, seconds=5.0, save=True):
+    import AcquisitionMultipleCamera as acq
+
+    config = get_config()
+    system = get_system(config.camera_backend, config.simulation)
+    cam_list = system.GetCameras()
+    if not cam_list:
+        print('No camera to tune')
+        system.ReleaseInstance()
+        return None
+    framerate = config.framerate
+    rate = config.hardware_framerate if framerate == 'hardware' else float(framerate)
+    num_frames = max(int(seconds * rate), 1)
+    try:
+        for cam in cam_list:
+            cam.Init()
+            configure_nodes(cam, acq.camera_settings(framerate, cam.GetSerial(), acq.sensor_size(cam)))
+        handles = [CameraHandles(cam) for cam in cam_list]
+        # link limits of every camera, in MB/s: the given ones, or from what it needs
+        limits = {}
+        for cam, h in zip(cam_list, handles):
+            if link_limits:
+                limits[h.serial] = list(link_limits)
+            else:
+                needed = needed_mbps(h, rate)
+                limits[h.serial] = [round(needed * factor, 1) for factor in LINK_LIMIT_FACTORS]
+                cam.SetNodeValue('DeviceLinkThroughputLimit', LINK_LIMIT_MAX)
+                limits[h.serial].append(cam.GetNodeValue('DeviceLinkThroughputLimit') / 1e6)
+            print('Camera %s: %.1f MB/s needed at %.1f fps, link limits %s MB/s'
+                  % (h.serial, needed_mbps(h, rate), rate, ', '.join('%.1f' % l for l in limits[h.serial])))
+
+        num_links = len(next(iter(limits.values())))
+        best = None
+        for buffer_count, handling_mode, link in itertools.product(buffer_counts, handling_modes, range(num_links)):
+            candidate = {'buffer_count': buffer_count, 'handling_mode': handling_mode, 'link': link}
+            settings = {serial: {'buffer_count': buffer_count, 'handling_mode': handling_mode,
+                                 'link_limit_mbps': limits[serial][link]} for serial in limits}
+            results = measure(cam_list, handles, settings, num_frames, framerate)
+            if results is None:
+                print('%d buffers, %s, link %d: unable to configure the cameras' % (buffer_count, handling_mode, link))
+                continue
+            print('%3d buffers, %-20s link %s MB/s: %s' % (
+                buffer_count, handling_mode, '/'.join('%.1f' % limits[h.serial][link] for h in handles),
+                ', '.join('%.1f fps %.1f MB/s %d lost %d incomplete' % (r['fps'], r['mb_per_s'], r['lost'],
+                                                                        r['incomplete']) for r in results)))
+            key = score(candidate, results)
+            if best is None or key < best[0]:
+                best = (key, settings)
+    finally:
+        for cam in cam_list:
+            cam.DeInit()
+        del cam_list
+        system.ReleaseInstance()
+
+    if best is None:
+        return None
+    tuning = best[1]
+    for serial, settings in tuning.items():
+        print('Camera %s: %d buffers, %s, link limit %.1f MB/s (%d frames missing over the run)'
+              % (serial, settings['buffer_count'], settings['handling_mode'], settings['link_limit_mbps'], best[0][0]))
+    if save:
+        save_tuning(config.path, tuning)
+        print('Stream settings written to stream_tuning in params.yaml')
+    return tuning
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Find the stream buffer and link settings of the connected cameras.')
+    parser.add_argument('--buffer-counts', type=int, nargs='+', default=TUNER_DEFAULTS['buffer_counts'])
+    parser.add_argument('--handling-modes', nargs='+', default=TUNER_DEFAULTS['handling_modes'])
+    parser.add_argument('--link-limits', type=float, nargs='+', default=None,
+                        help='DeviceLinkThroughputLimit values to try, MB/s (default: from the bandwidth needed)')
+    parser.add_argument('--seconds', type=float, default=TUNER_DEFAULTS['seconds'], help='streaming time per combination')
+    parser.add_argument('--dry-run', action='store_true', help='do not write params.yaml')
+    args = parser.parse_args(argv)
+    return tune(args.buffer_counts, args.handling_modes, args.link_limits, args.seconds, not args.dry_run) is not None
+
+
+if __name__ == '__main__':
+    if main():
+        sys.exit(0)
+    else:
+        sys.exit(1)
@@ -0,0 +1,182 @@
+import json
+from collections import deque
+import numpy as np
+
+# Per-frame timestamps of a camera, written next to the frames as <file_name>_t<N>.bin:
+# one TIMESTAMP_DTYPE record per frame with the frame index, the camera frame ID, the device
+# timestamp latched by the camera at exposure start (ns) and the host time.monotonic_ns()
+# when GetNextImage returned. Records are written block by block during the run.
+#
+# The device clocks of the cameras are free running, estimate_clock fits each of them to the
+# host clock (offset and drift), so frames of different cameras can be compared on the host
+# time line. The fitted models of a run are saved to <file_name>_clock.json.
+
+TIMESTAMP_DTYPE = np.dtype([
+    ('index', '<i8'),
+    ('frame_id', '<i8'),
+    ('timestamp', '<u8'),
+    ('host_time', '<i8'),
+])
+
+
+def timestamp_path(filename, camnum):
+    return filename + '_t' + str(camnum) + '.bin'
+
+
+def clock_path(filename):
+    return filename + '_clock.json'
+
+
+# Timestamp records of one camera, kept in memory for the clock fit and appended to path
+# every block records (no file when path is None). With limit, at most the last limit records
+# are kept in memory (runs of unbounded length), the file still gets all of them.
+# The file of a previous run is replaced, append adds to it (the captures of the display).
+class TimestampLog:
+    def __init__(self, path=None, capacity=0, block=256, limit=0, append=False):
+        self.path = path
+        self.block = block
+        self.limit = max(limit, 2 * block) if limit else 0
+        self.records = np.zeros(max(min(capacity, self.limit) if self.limit else capacity, block), dtype=TIMESTAMP_DTYPE)
+        self.count = 0
+        self.flushed = 0
+        self.file = open(path, 'ab' if append else 'wb') if path else None
+
+    def append(self, index, frame_id, timestamp, host_time):
+        if self.count == len(self.records):
+            if self.limit and self.count >= self.limit:
+                self._drop_oldest(self.count // 2)
+            else:
+                self.records = np.concatenate((self.records, np.zeros_like(self.records)))
+        self.records[self.count] = (index, frame_id, timestamp, host_time)
+        self.count += 1
+        if self.file is not None and self.count - self.flushed >= self.block:
+            self.flush()
+
+    def _drop_oldest(self, n):
+        self.flush()
+        self.records[:self.count - n] = self.records[n:self.count]
+        self.count -= n
+        self.flushed = self.count
+
+    def flush(self):
+        if self.file is not None and self.count > self.flushed:
+            self.file.write(self.records[self.flushed:self.count].tobytes())
+            self.file.flush()
+        self.flushed = self.count
+
+    def close(self):
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def recorded(self):
+        return self.records[:self.count]
+
+
+def read_timestamps(path):
+    return np.fromfile(path, dtype=TIMESTAMP_DTYPE)
+
+
+# Linear model of a camera clock: host = host_ref + rate * (device - device_ref), in ns.
+# The reference points keep the fit exact in float64 whatever the camera uptime.
+# residual_ns is the spread of the host arrival times around the model (host side latency
+# jitter), the model itself follows the lowest latency frames.
+class ClockModel:
+    def __init__(self, device_ref, host_ref, rate, residual_ns=0.0, samples=0):
+        self.device_ref = int(device_ref)
+        self.host_ref = int(host_ref)
+        self.rate = float(rate)
+        self.residual_ns = float(residual_ns)
+        self.samples = int(samples)
+
+    # Device clock rate error against the host clock, positive when the camera clock runs fast
+    @property
+    def drift_ppm(self):
+        return (1.0 / self.rate - 1.0) * 1e6
+
+    # Host clock offset of the device clock at device time 0
+    @property
+    def offset_ns(self):
+        return self.host_ref - self.rate * self.device_ref
+
+    def to_host(self, timestamp):
+        delta = np.asarray(timestamp, dtype=np.int64) - self.device_ref
+        return self.host_ref + np.rint(delta * self.rate).astype(np.int64)
+
+    def as_dict(self):
+        return {
+            'device_ref': self.device_ref,
+            'host_ref': self.host_ref,
+            'rate': self.rate,
+            'offset_ns': self.offset_ns,
+            'drift_ppm': self.drift_ppm,
+            'residual_ns': self.residual_ns,
+            'samples': self.samples,
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['device_ref'], d['host_ref'], d['rate'], d.get('residual_ns', 0.0), d.get('samples', 0))
+
+
+# Fit the device clock to the host clock from (device timestamp, host arrival time) pairs.
+# Host arrival times are late by a varying transfer and scheduling delay, never early, so
+# the fit is refined on the frames below the lower quantile of the residuals: the model
+# tracks the fastest deliveries, whose delay is nearly constant. Returns None with fewer
+# than two valid frames.
+def estimate_clock(timestamp, host_time, quantile=0.25, iterations=3):
+    timestamp = np.asarray(timestamp, dtype=np.int64)
+    host_time = np.asarray(host_time, dtype=np.int64)
+    valid = (timestamp > 0) & (host_time > 0)
+    timestamp, host_time = timestamp[valid], host_time[valid]
+    if len(timestamp) < 2 or timestamp.min() == timestamp.max():
+        return None
+    device_ref, host_ref = int(timestamp[0]), int(host_time[0])
+    x = (timestamp - device_ref).astype(np.float64)
+    y = (host_time - host_ref).astype(np.float64)
+
+    keep = np.ones(len(x), dtype=bool)
+    for _ in range(iterations):
+        rate, intercept = np.polyfit(x[keep], y[keep], 1)
+        residual = y - (intercept + rate * x)
+        lower = residual <= np.quantile(residual, quantile)
+        if lower.sum() < 2 or np.ptp(x[lower]) == 0:
+            break
+        keep = lower
+    rate, intercept = np.polyfit(x[keep], y[keep], 1)
+    residual = y - (intercept + rate * x)
+    return ClockModel(device_ref, host_ref + intercept, rate, residual.std(), len(x))
+
+
+def save_clocks(path, clocks):
+    with open(path, 'w') as f:
+        json.dump({str(camnum): clock.as_dict() for camnum, clock in sorted(clocks.items()) if clock is not None},
+                  f, indent=2)
+
+
+def load_clocks(path):
+    with open(path) as f:
+        return {int(camnum): ClockModel.from_dict(d) for camnum, d in json.load(f).items()}
+
+
+# Running estimate of the host time of device timestamps during a run, for the frame
+# synchronizer. The offset is the lowest (host arrival - device timestamp) of the last window
+# frames, i.e. the fastest recent delivery, so it follows a slow drift without a full fit.
+class OnlineClock:
+    def __init__(self, window=256):
+        self.window = window
+        self.count = 0
+        # (frame number, offset) with increasing offsets, the head is the window minimum
+        self.candidates = deque()
+
+    def to_host(self, timestamp, host_time):
+        offset = host_time - timestamp
+        candidates = self.candidates
+        while candidates and candidates[-1][1] >= offset:
+            candidates.pop()
+        candidates.append((self.count, offset))
+        if self.count - candidates[0][0] >= self.window:
+            candidates.popleft()
+        self.count += 1
+        return timestamp + candidates[0][1]
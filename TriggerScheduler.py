@@ -0,0 +1,181 @@
+import json
+import threading
+import time
+import numpy as np
+from Probes import PROBES, StageHistogram
+from CameraBackend import CAMERA_ERRORS
+
+# Lock-step software trigger for all the cameras of a run, when no hardware trigger is wired.
+# One thread fires TriggerSoftware on every camera back to back, on a fixed timetable
+# t0 + k / framerate of the monotonic clock: a late trigger does not shift the following ones,
+# so the run holds the configured frame rate, and slots missed by more than a period are
+# skipped rather than fired in a burst.
+# Each camera's capture thread calls ready(camnum) once it is streaming and after every frame
+# it receives; a trigger is only fired once every camera is ready for it (lock step).
+# For every trigger the broadcaster records the lateness against the timetable and the skew
+# between the first and the last camera (midpoints of the TriggerSoftware calls).
+# A trigger failing stops the broadcaster: the capture threads see it stopped when their
+# next frame does not come, and end the run.
+
+# Sleep until this long before a trigger, then spin, time.sleep being too coarse on its own
+SPIN_NS = 2000000
+# Longest wait for a camera to deliver the previous frame before triggering anyway
+READY_TIMEOUT = 5.0
+
+TRIGGER_DTYPE = np.dtype([
+    ('index', '<i8'),
+    ('scheduled', '<i8'),    # timetable slot, host monotonic ns
+    ('fired', '<i8'),        # first TriggerSoftware call, host monotonic ns
+    ('skew', '<i8'),         # first to last camera, ns
+])
+
+
+def trigger_path(filename):
+    return filename + '_triggers.bin'
+
+
+# Trigger slots start + k * period_ns of the host monotonic clock (system wide, so camera
+# processes given the same start fire on the same slots). wait() sleeps until the next slot and
+# returns its time; slots already missed by more than a period are skipped and counted.
+# The last spin_ns before a slot are spent spinning rather than sleeping (0: sleep only).
+class TriggerTimetable:
+    def __init__(self, period_ns, start=None, spin_ns=SPIN_NS):
+        self.period_ns = period_ns
+        self.spin_ns = spin_ns
+        self.start = time.monotonic_ns() + period_ns if start is None else start
+        self.slot = 0
+        self.missed_slots = 0
+
+    # Number of the next slot that can still be met
+    def next_slot(self):
+        period = self.period_ns
+        late = time.monotonic_ns() - (self.start + self.slot * period)
+        if late > period:
+            # too late for this slot, go to the next one of the timetable
+            return self.slot + late // period
+        return self.slot
+
+    # Sleep until slot, then spin, returns the slot time
+    def sleep_until(self, slot):
+        if slot > self.slot:
+            self.missed_slots += slot - self.slot
+        self.slot = slot + 1
+        scheduled = self.start + slot * self.period_ns
+
+        delay = scheduled - time.monotonic_ns() - self.spin_ns
+        if delay > 0:
+            time.sleep(delay / 1e9)
+        while time.monotonic_ns() < scheduled:
+            pass
+        return scheduled
+
+    def wait(self):
+        return self.sleep_until(self.next_slot())
+
+
+class ThreadTriggerBroadcaster(threading.Thread):
+    # triggers holds the resolved TriggerSoftware command of every camera (CameraHandles.trigger_software)
+    def __init__(self, triggers, framerate, num_triggers):
+        threading.Thread.__init__(self, daemon=True)
+        self.triggers = list(triggers)
+        self.period_ns = int(1e9 / float(framerate))
+        self.num_triggers = num_triggers
+        self.ready_flags = [threading.Semaphore(0) for _ in self.triggers]
+        self.stopped = threading.Event()
+        self.records = np.zeros(num_triggers, dtype=TRIGGER_DTYPE)
+        self.count = 0
+        self.timetable = None
+        self.stalls = 0
+        self.error = None
+        self.skew = StageHistogram()
+        self.lateness = StageHistogram()
+
+    # Camera camnum can take the next trigger
+    def ready(self, camnum):
+        self.ready_flags[camnum].release()
+
+    def stop(self):
+        self.stopped.set()
+
+    def _wait_ready(self):
+        for flag in self.ready_flags:
+            if not flag.acquire(timeout=READY_TIMEOUT):
+                # the camera lost a trigger or a frame, fire anyway so the run does not hang
+                self.stalls += 1
+            if self.stopped.is_set():
+                return False
+        return True
+
+    def run(self):
+        triggers = self.triggers
+        timetable = None
+        probes = [PROBES.camera(camnum) for camnum in range(len(triggers))]
+        mids = [0] * len(triggers)
+
+        for k in range(self.num_triggers):
+            if not self._wait_ready():
+                break
+            if timetable is None:
+                timetable = self.timetable = TriggerTimetable(self.period_ns)
+            scheduled = timetable.wait()
+
+            fired = time.monotonic_ns()
+            before = fired
+            for camnum, trigger in enumerate(triggers):
+                try:
+                    trigger()
+                except CAMERA_ERRORS as ex:
+                    self.error = 'camera %d: %s' % (camnum, ex)
+                    print('Trigger broadcaster stopped, trigger of %s' % self.error)
+                    self.stop()
+                    return
+                after = time.monotonic_ns()
+                probes[camnum].record('trigger', after - before)
+                mids[camnum] = (before + after) // 2
+                before = after
+            skew = max(mids) - min(mids)
+
+            self.records[k] = (k, scheduled, fired, skew)
+            self.count = k + 1
+            self.skew.record(skew)
+            self.lateness.record(max(fired - scheduled, 0))
+
+    def recorded(self):
+        return self.records[:self.count]
+
+    @property
+    def missed_slots(self):
+        return self.timetable.missed_slots if self.timetable is not None else 0
+
+    # Frame rate actually held, from the first to the last trigger
+    def achieved_rate(self):
+        fired = self.recorded()['fired']
+        if len(fired) < 2:
+            return 0.0
+        return (len(fired) - 1) * 1e9 / (fired[-1] - fired[0])
+
+    def stats(self):
+        return {
+            'triggers': self.count,
+            'target_fps': 1e9 / self.period_ns,
+            'achieved_fps': self.achieved_rate(),
+            'missed_slots': self.missed_slots,
+            'stalls': self.stalls,
+            'error': self.error,
+            'skew': self.skew.as_dict(),
+            'lateness': self.lateness.as_dict(),
+        }
+
+    def print_stats(self):
+        s = self.stats()
+        print('Trigger broadcaster: %d triggers at %.2f fps (target %.2f), %d slots missed, %d stalls' %
+              (s['triggers'], s['achieved_fps'], s['target_fps'], s['missed_slots'], s['stalls']))
+        print('  camera skew p50 %.1f us, p99 %.1f us, max %.1f us; lateness p99 %.1f us' %
+              (s['skew']['p50_us'], s['skew']['p99_us'], s['skew']['max_us'], s['lateness']['p99_us']))
+
+    # Summary to path (JSON) and the per-trigger records to path_bin
+    def dump(self, path, path_bin=None):
+        with open(path, 'w') as f:
+            json.dump(self.stats(), f, indent=2)
+        if path_bin is not None:
+            self.recorded().tofile(path_bin)
@@ -0,0 +1,209 @@
+import threading
+import queue
+import time
+from collections import deque
+
+# Policies applied by WriterPool.submit when the write queue is full:
+#   block       - the capture thread waits until a worker frees a slot
+#   drop_oldest - the oldest queued frame is discarded to make room
+#   drop_newest - the frame being submitted is discarded
+FULL_POLICIES = ('block', 'drop_oldest', 'drop_newest')
+
+# Number of most recent trigger-to-disk latencies kept per camera
+LATENCY_SAMPLES = 100000
+
+
+# Value at quantile q of a sorted list
+def percentile(values, q):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class WriterStats:
+    # Per camera counters, only modified while holding WriterPool.lock
+    def __init__(self):
+        self.submitted = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.pending = 0
+        self.peak_pending = 0
+        self.bytes = 0
+        self.write_time = 0.0
+        self.first_write = None
+        self.last_write = None
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+
+    def as_dict(self):
+        elapsed = 0.0
+        if self.first_write is not None:
+            elapsed = self.last_write - self.first_write
+        latencies = sorted(self.latencies)
+        return {
+            'submitted': self.submitted,
+            'written': self.written,
+            'dropped': self.dropped,
+            'failed': self.failed,
+            'queue_depth': self.pending,
+            'peak_queue_depth': self.peak_pending,
+            'bytes': self.bytes,
+            'fps': self.written / elapsed if elapsed > 0 else 0.0,
+            'mb_per_s': self.bytes / elapsed / 1e6 if elapsed > 0 else 0.0,
+            'mean_write_ms': 1000 * self.write_time / self.written if self.written else 0.0,
+            'latency_ms': {
+                'p50': percentile(latencies, 0.50) / 1e6,
+                'p90': percentile(latencies, 0.90) / 1e6,
+                'p99': percentile(latencies, 0.99) / 1e6,
+                'max': latencies[-1] / 1e6 if latencies else 0.0,
+            },
+        }
+
+
+# Worker thread of the pool, runs the queued write tasks until it gets the stop sentinel
+class ThreadWriterWorker(threading.Thread):
+    def __init__(self, pool):
+        threading.Thread.__init__(self, daemon=True)
+        self.pool = pool
+
+    def run(self):
+        cpu_start = time.thread_time()
+        while True:
+            task = self.pool.queue.get()
+            if task is None:
+                self.pool.queue.task_done()
+                break
+            self.pool._run_task(task)
+            self.pool.queue.task_done()
+        with self.pool.lock:
+            self.pool.cpu_time += time.thread_time() - cpu_start
+
+
+# Shared writer subsystem: a fixed number of worker threads fed by a bounded queue.
+# Replaces the former ThreadWrite, which started one thread per frame.
+class WriterPool:
+    # probes is an optional Probes.ProbeRegistry receiving the 'write' stage timings
+    def __init__(self, num_workers=4, queue_depth=64, full_policy='block', probes=None):
+        if full_policy not in FULL_POLICIES:
+            raise ValueError('Unknown writer full policy %r, expected one of %s' % (full_policy, FULL_POLICIES))
+        if num_workers < 1 or queue_depth < 1:
+            raise ValueError('Writer pool needs at least one worker and a queue depth of at least one')
+
+        self.full_policy = full_policy
+        self.probes = probes
+        self.queue = queue.Queue(maxsize=queue_depth)
+        self.lock = threading.Lock()
+        self.stats_per_cam = {}
+        # CPU seconds used by the workers, known once the pool is closed
+        self.cpu_time = 0.0
+        self.workers = [ThreadWriterWorker(self) for _ in range(num_workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def _cam_stats(self, camnum):
+        stats = self.stats_per_cam.get(camnum)
+        if stats is None:
+            stats = self.stats_per_cam[camnum] = WriterStats()
+        return stats
+
+    # Queue a write of a frame from camera camnum. func(*args) performs the write,
+    # release() (if given) is called once the frame is written or dropped so that
+    # the caller can give the frame memory back. t_start is the time.monotonic_ns()
+    # of the trigger of the frame, used for the trigger-to-disk latency.
+    # Returns False when the frame was dropped.
+    def submit(self, camnum, func, *args, nbytes=0, release=None, t_start=None):
+        task = (camnum, func, args, nbytes, release, t_start)
+        with self.lock:
+            stats = self._cam_stats(camnum)
+            stats.submitted += 1
+            stats.pending += 1
+            stats.peak_pending = max(stats.peak_pending, stats.pending)
+
+        if self.full_policy == 'block':
+            self.queue.put(task)
+            return True
+
+        while True:
+            try:
+                self.queue.put_nowait(task)
+                return True
+            except queue.Full:
+                if self.full_policy == 'drop_newest':
+                    self._drop(task)
+                    return False
+            # drop_oldest: discard the head of the queue and try again
+            try:
+                oldest = self.queue.get_nowait()
+            except queue.Empty:
+                continue
+            if oldest is None:
+                # never swallow a stop sentinel
+                self.queue.task_done()
+                self.queue.put(oldest)
+                continue
+            self._drop(oldest)
+            self.queue.task_done()
+
+    def _drop(self, task):
+        camnum, func, args, nbytes, release, t_start = task
+        with self.lock:
+            stats = self._cam_stats(camnum)
+            stats.dropped += 1
+            stats.pending -= 1
+        if release is not None:
+            release()
+
+    def _run_task(self, task):
+        camnum, func, args, nbytes, release, t_start = task
+        start = time.perf_counter()
+        try:
+            func(*args)
+            ok = True
+        except Exception as ex:
+            print('Error while writing frame of camera %s: %s' % (camnum, ex))
+            ok = False
+        finally:
+            if release is not None:
+                release()
+        end = time.perf_counter()
+        end_ns = time.monotonic_ns()
+
+        with self.lock:
+            stats = self._cam_stats(camnum)
+            stats.pending -= 1
+            if not ok:
+                stats.failed += 1
+                return
+            stats.written += 1
+            stats.bytes += nbytes
+            stats.write_time += end - start
+            if stats.first_write is None:
+                stats.first_write = start
+            stats.last_write = end
+            if t_start is not None:
+                stats.latencies.append(end_ns - t_start)
+            if self.probes is not None:
+                self.probes.camera(camnum).record('write', int((end - start) * 1e9))
+
+    def queue_depth(self):
+        return self.queue.qsize()
+
+    def stats(self):
+        with self.lock:
+            return {camnum: s.as_dict() for camnum, s in self.stats_per_cam.items()}
+
+    def print_stats(self):
+        for camnum, s in sorted(self.stats().items()):
+            print('Camera %s: %d written, %d dropped, %d failed, peak queue depth %d, %.1f fps, %.1f MB/s' %
+                  (camnum, s['written'], s['dropped'], s['failed'], s['peak_queue_depth'], s['fps'], s['mb_per_s']))
+
+    # Wait for all queued frames to be written
+    def flush(self):
+        self.queue.join()
+
+    # Write the remaining frames and stop the workers
+    def close(self):
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
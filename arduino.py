@@ -1,50 +1,319 @@
-"""from pyfirmata import Arduino, util"""
-
-import pyfirmata
+import json
+import threading
 import time
-from scipy import signal
-import matplotlib.pyplot as plt
 import numpy as np
-from AcquisitionMultipleCamera import read_config
-import os
-
-# Change cwd to script folder
-abspath = os.path.abspath(__file__)
-dname = os.path.dirname(abspath)
-os.chdir(dname)
-
-# afin de lire la valeur du framerate directement depuis le fichier yaml
-
-cfg = read_config('params.yaml')
-framerate = cfg['framerate']
-
-
-'''Square signal'''
-t = np.linspace(0, 1, 500, endpoint=False)
-signal = 1+signal.square(2 * np.pi * 5 * t)
-plt.plot(t, signal)
-plt.ylim(-1, 3)
-# naming the x,y axis
-plt.xlabel('Amplitude')
-plt.ylabel('Time')
-plt.title('Square signal')
-# function to show the plot
-plt.show()
-
-board = pyfirmata.Arduino('COM6')
-it = pyfirmata.util.Iterator(board)
-it.start()
-
-tension_input = board.get_pin('a:0:i')
-trigger = board.get_pin('a:1:i')
-
-while True:
-    tension_value = tension_input.read()
-    print(tension_value)
-    tension_V = tension_value * (5.0 / 1023.0)
-    print(tension_value + " V")
-    time.sleep(0.1)
-
-if tension_V == 5:
-    # trouver comment insérer les fonctions python acquérir image etc
-    trigger.write(signal)
\ No newline at end of file
+import AcquisitionMultipleCamera as acq
+from Config import get_config, enter_image_folder, ARDUINO_BACKENDS
+from TriggerScheduler import TriggerTimetable
+from SensorLog import ThreadSensorRecorder
+
+# Trigger / sync service of the Arduino voltage monitor (StandardFirmata on the board).
+# A sampling thread reads the analog inputs arduino_channels at arduino_sample_rate and records
+# them, in volts, as the sensor channels A<N> of the run (<file_name>_sensors.bin, see
+# SensorLog.py), on the clock of the frame times. The first channel drives the run: the
+# acquisition starts when it rises to arduino_start_volts and stops when it falls back to
+# arduino_stop_volts. With arduino_trigger_pin set, the board also outputs the square wave
+# triggering the cameras on that digital pin, at framerate (hardware_framerate when framerate
+# is hardware), while the acquisition runs.
+#
+# In async mode the thresholds send start and stop (or, with continuous recording, trigger
+# events) to the acquisition controller; in the other modes the run starts on the threshold
+# and takes num_images frames. Firmata reports the analog inputs at most every millisecond,
+# and a 57600 baud link carries about 1900 readings a second for all the channels together.
+# arduino_backend: simulated replaces the board with SimulatedFirmataBoard.
+# The arduino_* settings come from get_config() (see Config.py).
+
+# Load profile of the simulated board, the same on every analog input: rest, ramp up to
+# peak_volts, hold, ramp down, rest again
+ARDUINO_SIMULATION_DEFAULTS = {
+    'rest_s': 1.0,
+    'ramp_s': 1.0,
+    'hold_s': 2.0,
+    'peak_volts': 5.0,
+    'noise_volts': 0.01,
+    'seed': 0,
+}
+
+
+class SimulatedPin:
+    def __init__(self, board, kind, number):
+        self.board = board
+        self.kind = kind
+        self.number = number
+        self.reporting = False
+        self.value = 0
+        # digital outputs: number of rising edges written
+        self.rising_edges = 0
+
+    def enable_reporting(self):
+        self.reporting = True
+
+    def disable_reporting(self):
+        self.reporting = False
+
+    # 10 bit reading scaled to 0..1 like pyfirmata, as of the last report
+    def read(self):
+        if self.kind == 'a':
+            return self.board.analog_value(self.number) if self.reporting else None
+        return self.value
+
+    def write(self, value):
+        if value and not self.value:
+            self.rising_edges += 1
+        self.value = value
+
+
+# Stand-in for pyfirmata.Arduino with the calls the service makes
+class SimulatedFirmataBoard:
+    def __init__(self, settings=None, vref=5.0):
+        self.settings = dict(ARDUINO_SIMULATION_DEFAULTS)
+        self.settings.update(settings or {})
+        self.vref = vref
+        self.rng = np.random.default_rng(self.settings['seed'])
+        self.lock = threading.Lock()
+        self.t0 = time.monotonic_ns()
+        self.sampling_ns = 19000000
+        self.pins = {}
+
+    def get_pin(self, spec):
+        kind, number, mode = spec.split(':')
+        pin = SimulatedPin(self, kind, int(number))
+        self.pins[spec] = pin
+        return pin
+
+    def samplingOn(self, interval_ms=19):
+        self.sampling_ns = int(interval_ms * 1e6)
+
+    def profile(self, t):
+        s = self.settings
+        t -= s['rest_s']
+        if t <= 0:
+            return 0.0
+        if t < s['ramp_s']:
+            return s['peak_volts'] * t / s['ramp_s']
+        t -= s['ramp_s']
+        if t < s['hold_s']:
+            return s['peak_volts']
+        t -= s['hold_s']
+        if t < s['ramp_s']:
+            return s['peak_volts'] * (1 - t / s['ramp_s'])
+        return 0.0
+
+    def analog_value(self, number):
+        # the board reports every sampling interval, a read gets the last report
+        elapsed = time.monotonic_ns() - self.t0
+        reported = elapsed - elapsed % self.sampling_ns
+        with self.lock:
+            volts = self.profile(reported / 1e9) + self.rng.normal(0.0, self.settings['noise_volts'])
+        return min(max(round(volts / self.vref * 1023), 0), 1023) / 1023.0
+
+    def exit(self):
+        pass
+
+
+# backend, port and settings default to arduino_backend, arduino_port and arduino_simulation
+def open_board(backend=None, port=None, settings=None):
+    config = get_config()
+    backend = backend or config.arduino_backend
+    port = port or config.arduino_port
+    if backend == 'simulated':
+        return SimulatedFirmataBoard(settings if settings is not None else config.arduino_simulation,
+                                     config.arduino_vref)
+    if backend != 'firmata':
+        print('Unknown arduino_backend %r, expected one of %s' % (backend, ARDUINO_BACKENDS))
+        return None
+    try:
+        import pyfirmata
+        import pyfirmata.util
+    except ImportError:
+        print('pyfirmata is not installed, the Arduino cannot be used (arduino_backend: simulated runs without it)')
+        return None
+    board = pyfirmata.Arduino(port)
+    # the iterator thread reads the reports of the board into its pins
+    pyfirmata.util.Iterator(board).start()
+    return board
+
+
+# Square wave on a digital pin of the board, rising edges at rate per second
+class ThreadSquareWave(threading.Thread):
+    def __init__(self, pin, rate):
+        threading.Thread.__init__(self, daemon=True)
+        self.pin = pin
+        self.half_period_ns = int(1e9 / float(rate) / 2)
+        self.stopping = threading.Event()
+        self.pulses = 0
+        self.missed_edges = 0
+
+    def run(self):
+        timetable = TriggerTimetable(self.half_period_ns)
+        level = 0
+        while not self.stopping.is_set():
+            slot = timetable.next_slot()
+            # skipped slots must keep the phase, the edge of an odd slot is a falling one
+            if (slot - timetable.slot) % 2:
+                slot += 1
+            timetable.sleep_until(slot)
+            level = 1 - level
+            self.pin.write(level)
+            self.pulses += level
+        self.pin.write(0)
+        self.missed_edges = timetable.missed_slots
+
+    def stop(self):
+        self.stopping.set()
+
+
+class ThreadArduinoService(ThreadSensorRecorder):
+    # board is a pyfirmata.Arduino or a SimulatedFirmataBoard, the readings are logged as
+    # <filename>_sensors.bin (no log when filename is None), trigger_pin is the digital output
+    # of the square wave (0: none)
+    def __init__(self, board, channels=(0,), sample_rate=500, vref=5.0, filename=None, start_volts=None,
+                 stop_volts=None, trigger_pin=0, trigger_rate=None):
+        ThreadSensorRecorder.__init__(self, filename, ['A%d' % channel for channel in channels],
+                                      ['V'] * len(channels), sample_rate)
+        self.board = board
+        self.channels = list(channels)
+        self.vref = vref
+        self.start_volts = start_volts
+        self.stop_volts = stop_volts
+        self.trigger_pin = trigger_pin
+        self.trigger_rate = trigger_rate
+        self.pins = [board.get_pin('a:%d:i' % channel) for channel in self.channels]
+        self.trigger = board.get_pin('d:%d:o' % trigger_pin) if trigger_pin else None
+        self.started = threading.Event()
+        # called on the sampling thread when the first channel crosses the thresholds
+        self.on_start = []
+        self.on_stop = []
+        self.recording = False
+        self.events = []
+        self.wave = None
+        self.pulses = 0
+        self.missed_edges = 0
+
+    def run(self):
+        for pin in self.pins:
+            pin.enable_reporting()
+        self.board.samplingOn(max(1, self.period_ns // 1000000))
+        ThreadSensorRecorder.run(self)
+        self.stop_wave()
+
+    def read(self):
+        values = [pin.read() for pin in self.pins]
+        if None in values:
+            # no report from the board yet
+            return None
+        return [value * self.vref for value in values]
+
+    def on_sample(self, host_time, values):
+        self._check_thresholds(host_time, values[0])
+
+    def _check_thresholds(self, host_time, volts):
+        if not self.recording and self.start_volts is not None and volts >= self.start_volts:
+            self.recording = True
+            self.events.append({'event': 'start', 'host_time': host_time, 'volts': volts})
+            print('Arduino: %.2f V, starting' % volts)
+            self.started.set()
+            for callback in self.on_start:
+                callback()
+        elif self.recording and self.stop_volts is not None and volts <= self.stop_volts:
+            self.recording = False
+            self.events.append({'event': 'stop', 'host_time': host_time, 'volts': volts})
+            print('Arduino: %.2f V, stopping' % volts)
+            for callback in self.on_stop:
+                callback()
+
+    # Square wave trigger of the cameras, when the service has a trigger pin. It runs until
+    # stop_wave or the end of the service.
+    def start_wave(self):
+        if self.trigger is not None and self.wave is None:
+            self.wave = ThreadSquareWave(self.trigger, self.trigger_rate)
+            self.wave.start()
+
+    def stop_wave(self):
+        if self.wave is not None:
+            self.wave.stop()
+            self.wave.join()
+            self.pulses += self.wave.pulses
+            self.missed_edges += self.wave.missed_edges
+            self.wave = None
+
+    # Thresholds of an async run: start and stop commands, or trigger events of a continuous
+    # recording (which runs from the start, with the square wave)
+    def attach(self, controller):
+        if get_config().pretrigger_seconds:
+            self.start_wave()
+            self.on_start.append(lambda: controller.post('trigger arduino'))
+        else:
+            controller.autostart = False
+            self.on_start.append(self.start_wave)
+            self.on_start.append(lambda: controller.post('start'))
+            self.on_stop.append(lambda: controller.post('stop'))
+            self.on_stop.append(self.stop_wave)
+
+    def close(self):
+        self.board.exit()
+
+    def stats(self):
+        return {
+            'channels': self.channels,
+            'sample_rate': 1e9 / self.period_ns,
+            'samples': self.log.samples,
+            'missed_samples': self.missed_samples,
+            'trigger_pulses': self.pulses,
+            'missed_trigger_edges': self.missed_edges,
+            'events': self.events,
+        }
+
+    def print_stats(self):
+        s = self.stats()
+        print('Arduino: %d samples of %d channels at %.0f Hz (%d missed), %d trigger pulses, %d threshold events'
+              % (s['samples'], len(s['channels']), s['sample_rate'], s['missed_samples'], s['trigger_pulses'],
+                 len(s['events'])))
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.stats(), f, indent=2)
+
+
+def make_arduino_service(board=None):
+    if board is None:
+        board = open_board()
+        if board is None:
+            return None
+    config = get_config()
+    framerate = config.framerate
+    rate = config.hardware_framerate if framerate == 'hardware' else float(framerate)
+    return ThreadArduinoService(board, config.arduino_channels, config.arduino_sample_rate, config.arduino_vref,
+                                config.filename, config.arduino_start_volts, config.arduino_stop_volts,
+                                config.arduino_trigger_pin, rate)
+
+
+# Acquisition started (and in async mode stopped) by the voltage on the Arduino
+def launch_triggered_acquisition():
+    config = get_config()
+    # the analog recording is written next to the frames
+    enter_image_folder(config)
+    service = make_arduino_service()
+    if service is None:
+        return False
+    service.start()
+    try:
+        if config.acquisition_mode == 'async':
+            result = acq.launch_acquisition(service)
+        else:
+            # the run takes num_images frames, the square wave goes on until it is done
+            service.on_start.append(service.start_wave)
+            print('Waiting for %.2f V on A%d...' % (config.arduino_start_volts, config.arduino_channels[0]))
+            service.started.wait()
+            result = acq.launch_acquisition()
+    finally:
+        service.stop()
+        service.join()
+        service.close()
+    service.print_stats()
+    service.dump(config.filename + '_analog.json')
+    return result
+
+
+if __name__ == '__main__':
+    launch_triggered_acquisition()
@@ -1,28 +1,43 @@
-import os
-import PySpin
 import sys
-from AcquisitionMultipleCamera import launch_acquisition
-from DisplayCameras import launch_display
+from Config import get_config, ConfigError
 
 
+# Each choice imports only the modules it runs (no OpenCV without the display, no pyfirmata
+# without the Arduino)
 def main():
+    # params.yaml is checked before anything starts
+    try:
+        get_config()
+    except (ConfigError, FileNotFoundError) as ex:
+        print('Error in params.yaml: %s' % ex)
+        return False
 
     print("1 : AcquisitionMultipleCamera to take multiple pictures from 1 or 2 cameras")
     print("2 : AcquireAndDisplay to display one or 2 cameras")
+    print("3 : AcquisitionMultipleCamera started by the voltage on the Arduino")
     code = input("Choose which code you want to launch : ")
 
     if code == "1":
 
         # launch the AcquisitionMultipleCamera code
+        from AcquisitionMultipleCamera import launch_acquisition
 
-        launch_acquisition()
+        return launch_acquisition()
 
 
     if code == "2":
 
         # launch DisplayCameras code
+        from DisplayCameras import launch_display
 
-        launch_display()
+        return launch_display()
+
+    if code == "3":
+
+        # launch the acquisition from the Arduino trigger service
+        from arduino import launch_triggered_acquisition
+
+        return launch_triggered_acquisition()
 
 if __name__ == '__main__':
     if main():